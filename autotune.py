@@ -0,0 +1,273 @@
+import os
+import json
+import math
+import time
+import hashlib
+import logging
+import argparse
+import platform
+from datetime import datetime, timezone
+
+import numpy as np
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 'load' applies the settings tuned for this host (AUTOTUNE_PATH) at startup when there are any, 'startup' tunes
+# them first when there aren't (a few seconds to a minute, once per host), 'off' leaves the settings as they are
+AUTOTUNE = os.environ.get("AUTOTUNE", "load").lower()
+MODES = ['off', 'load', 'startup']
+# Tuned settings of every host they were tuned on, keyed by host fingerprint
+AUTOTUNE_PATH = os.environ.get("AUTOTUNE_PATH", "autotune.json")
+# Largest 95th percentile forward pass latency of a batch of the longest typical request the tuner may choose
+AUTOTUNE_LATENCY_CEILING_MS = float(os.environ.get("AUTOTUNE_LATENCY_CEILING_MS", 1000))
+# Typical request lengths the forward passes and the log-mel front-end are timed on
+AUTOTUNE_LENGTHS_SECONDS = [float(seconds) for seconds in os.environ.get("AUTOTUNE_LENGTHS_SECONDS", "5,10").split(',')
+                            if seconds.strip()]
+# Timed passes of every configuration and length, after one untimed pass
+AUTOTUNE_REPEATS = int(os.environ.get("AUTOTUNE_REPEATS", 3))
+# The settings tuned, applied as environment defaults: any of them set in the environment is kept, and not tuned
+TUNED_SETTINGS = ['TORCH_THREADS', 'TORCH_INTEROP_THREADS', 'INFERENCE_MAX_BATCH_SIZE', 'CPU_EXECUTOR_WORKERS']
+BATCH_SIZES = [1, 2, 4, 8, 16]
+# Configurations within this share of the best throughput count as equally fast; the one with the fewest threads
+# and the smallest batches is chosen
+THROUGHPUT_TOLERANCE = 0.05
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def cpu_model():
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+def host_fingerprint():
+    """Description of the host (the part of it the tuned settings depend on) and its fingerprint"""
+    import torch
+    host = {
+        'machine': platform.machine(),
+        'cpu': cpu_model(),
+        'cores': available_cores(),
+        'memory_gb': round(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2 ** 30),
+        'torch': torch.__version__,
+    }
+    return host, hashlib.sha256(json.dumps(host, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def fixed_setting(name):
+    return int(os.environ[name]) if os.environ.get(name) else None
+
+
+def measure_model(model, threads, batch_size, lengths_seconds, repeats):
+    """Throughput (seconds of audio per second) and latency of forward passes of batches of every length"""
+    import torch
+    from dataset.spectogram import spectogram_configs as cfg
+    from windowed_inference import seconds_to_frames
+
+    torch.set_num_threads(threads)
+    rng = np.random.default_rng(0)
+    (latencies, audio_seconds) = ([], 0.0)
+    for seconds in lengths_seconds:
+        features = rng.standard_normal((batch_size, cfg.audio_channels, seconds_to_frames(seconds), cfg.mel_bins))
+        x = torch.from_numpy(features.astype(np.float32) - 40)
+        with torch.no_grad():
+            model(x)
+            for _ in range(repeats):
+                started_at = time.perf_counter()
+                model(x)
+                latencies.append(time.perf_counter() - started_at)
+                audio_seconds += batch_size * seconds
+    return {'threads': threads, 'batch_size': batch_size, 'throughput': audio_seconds / sum(latencies),
+            'p50_ms': float(np.percentile(latencies, 50)) * 1000, 'p95_ms': float(np.percentile(latencies, 95)) * 1000}
+
+
+def measure_front_end(lengths_seconds, repeats):
+    """Seconds of audio per second the log-mel front-end extracts on one thread, as a decoding process runs it"""
+    import torch
+    from dataset.spectogram import spectogram_configs as cfg
+    from dataset.spectogram.torch_frontend import log_mel
+
+    torch.set_num_threads(1)
+    rng = np.random.default_rng(0)
+    (busy_seconds, audio_seconds) = (0.0, 0.0)
+    for seconds in lengths_seconds:
+        waveform = rng.standard_normal((int(seconds * cfg.working_sample_rate), cfg.audio_channels)).astype(np.float32)
+        log_mel(waveform, compact=True)
+        for _ in range(repeats):
+            started_at = time.perf_counter()
+            log_mel(waveform, compact=True)
+            busy_seconds += time.perf_counter() - started_at
+            audio_seconds += seconds
+    return audio_seconds / busy_seconds
+
+
+def choose(results, front_end_throughput, cores, latency_ceiling_ms, cpu_workers=None):
+    """
+    The configuration with the best throughput of the whole pipeline within the latency ceiling (the fastest one
+    when none is). Decoding processes get the cores the forward passes leave, as many as keep up with them.
+    """
+    for result in results:
+        needed = math.ceil(result['throughput'] / front_end_throughput)
+        result['cpu_workers'] = cpu_workers or max(1, min(needed, cores - result['threads']))
+        result['pipeline_throughput'] = min(result['throughput'], result['cpu_workers'] * front_end_throughput)
+    within = [result for result in results if result['p95_ms'] <= latency_ceiling_ms]
+    if not within:
+        within = [min(results, key=lambda result: result['p95_ms'])]
+        logger.warning(f"No configuration stays within {latency_ceiling_ms:g} ms, choosing the fastest one "
+                       f"({within[0]['p95_ms']:.0f} ms)")
+    best = max(result['pipeline_throughput'] for result in within)
+    return min([result for result in within if result['pipeline_throughput'] >= best * (1 - THROUGHPUT_TOLERANCE)],
+               key=lambda result: (result['threads'], result['batch_size']))
+
+
+def tune(latency_ceiling_ms=AUTOTUNE_LATENCY_CEILING_MS, lengths_seconds=None, repeats=AUTOTUNE_REPEATS):
+    """
+    Time the served model (random weights, optimized as MODEL_OPTIMIZE says) at every thread count and batch size,
+    and the log-mel front-end, on synthetic inputs of typical lengths; the settings of the configuration chosen.
+    Batch sizes of a thread count are tried until one exceeds the ceiling.
+    """
+    import torch
+    from models.DcaseNet import DcaseNet_v3
+    from models.optimization import MODEL_OPTIMIZE, optimize_for_inference
+
+    lengths_seconds = lengths_seconds or AUTOTUNE_LENGTHS_SECONDS
+    (host, fingerprint) = host_fingerprint()
+    cores = host['cores']
+    fixed = {name: fixed_setting(name) for name in TUNED_SETTINGS}
+    thread_counts = [fixed['TORCH_THREADS']] if fixed['TORCH_THREADS'] else \
+        sorted({2 ** i for i in range(cores.bit_length()) if 2 ** i <= cores} | {cores})
+    batch_sizes = [fixed['INFERENCE_MAX_BATCH_SIZE']] if fixed['INFERENCE_MAX_BATCH_SIZE'] else BATCH_SIZES
+
+    previous_threads = torch.get_num_threads()
+    started_at = time.perf_counter()
+    try:
+        model = DcaseNet_v3(1).eval()
+        if MODEL_OPTIMIZE:
+            model = optimize_for_inference(model)
+        results = []
+        for threads in thread_counts:
+            for batch_size in batch_sizes:
+                result = measure_model(model, threads, batch_size, lengths_seconds, repeats)
+                results.append(result)
+                logger.info(f"Autotune: {threads} threads, batch size {batch_size}: {result['throughput']:.1f} s/s, "
+                            f"p95 {result['p95_ms']:.0f} ms")
+                if result['p95_ms'] > latency_ceiling_ms:
+                    break
+        front_end_throughput = measure_front_end(lengths_seconds, repeats)
+    finally:
+        torch.set_num_threads(previous_threads)
+    chosen = choose(results, front_end_throughput, cores, latency_ceiling_ms, fixed['CPU_EXECUTOR_WORKERS'])
+    settings = {
+        'TORCH_THREADS': chosen['threads'],
+        # Forward passes run no inter-op parallel work; torch's default would start a pool of a thread per core
+        'TORCH_INTEROP_THREADS': fixed['TORCH_INTEROP_THREADS'] or 1,
+        'INFERENCE_MAX_BATCH_SIZE': chosen['batch_size'],
+        'CPU_EXECUTOR_WORKERS': chosen['cpu_workers'],
+    }
+    logger.info(f"Autotuned in {time.perf_counter() - started_at:.1f}s: {settings}")
+    return {
+        'fingerprint': fingerprint,
+        'host': host,
+        'tuned_at': datetime.now(timezone.utc).isoformat(),
+        'latency_ceiling_ms': latency_ceiling_ms,
+        'lengths_seconds': lengths_seconds,
+        'front_end_throughput': front_end_throughput,
+        'results': results,
+        'settings': settings,
+    }
+
+
+def load_tunings(path=AUTOTUNE_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_tuning(tuning, path=AUTOTUNE_PATH):
+    """Add the tuning of a host to the file, replaced atomically so that processes tuning at once don't corrupt it"""
+    tunings = load_tunings(path)
+    tunings[tuning['fingerprint']] = tuning
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(tunings, f, indent=2)
+    os.replace(temp_path, path)
+
+
+def set_torch_threads():
+    """torch's intra-op and inter-op thread counts, as TORCH_THREADS and TORCH_INTEROP_THREADS say"""
+    import torch
+    if fixed_setting('TORCH_THREADS'):
+        torch.set_num_threads(fixed_setting('TORCH_THREADS'))
+    if fixed_setting('TORCH_INTEROP_THREADS') and torch.get_num_interop_threads() != fixed_setting('TORCH_INTEROP_THREADS'):
+        try:
+            torch.set_num_interop_threads(fixed_setting('TORCH_INTEROP_THREADS'))
+        except RuntimeError as e:
+            # Fixed once inter-op work started
+            logger.warning(f"Inter-op threads left at {torch.get_num_interop_threads()}: {str(e)}")
+
+
+def apply_tuned_settings(mode=AUTOTUNE, path=AUTOTUNE_PATH):
+    """
+    Set the settings tuned for this host as environment defaults, so call it before the modules reading them are
+    imported; with AUTOTUNE=startup they are tuned first when they weren't, or were for another ceiling or lengths.
+    Then sets torch's thread counts. The tuned settings in effect, None when none were applied.
+    """
+    if mode not in MODES:
+        raise ValueError(f"AUTOTUNE can be one of {MODES}, '{mode}' given")
+    if mode == 'off':
+        set_torch_threads()
+        return None
+    (_, fingerprint) = host_fingerprint()
+    tuning = load_tunings(path).get(fingerprint)
+    if tuning is not None and (tuning['latency_ceiling_ms'] != AUTOTUNE_LATENCY_CEILING_MS or
+                               tuning['lengths_seconds'] != AUTOTUNE_LENGTHS_SECONDS):
+        logger.info(f"Settings of {path} were tuned for another latency ceiling or lengths")
+        tuning = None
+    if tuning is None and mode == 'startup':
+        tuning = tune()
+        save_tuning(tuning, path)
+    if tuning is not None:
+        for (name, value) in tuning['settings'].items():
+            os.environ.setdefault(name, str(value))
+    set_torch_threads()
+    return {name: os.environ[name] for name in tuning['settings']} if tuning is not None else None
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    parser = argparse.ArgumentParser(description='Tune thread counts, the micro-batch limit and the decoding pool '
+                                                 'size for this host and save them for the server (AUTOTUNE=load)')
+    parser.add_argument('--latency_ceiling_ms', type=float, default=AUTOTUNE_LATENCY_CEILING_MS)
+    parser.add_argument('--lengths', type=float, nargs='*', default=AUTOTUNE_LENGTHS_SECONDS,
+                        help='Typical request lengths in seconds')
+    parser.add_argument('--repeats', type=int, default=AUTOTUNE_REPEATS)
+    parser.add_argument('--output', default=AUTOTUNE_PATH)
+    parser.add_argument('--dry_run', action='store_true', help="Print the settings, don't save them")
+    args = parser.parse_args()
+
+    tuning = tune(args.latency_ceiling_ms, args.lengths, args.repeats)
+    print(f"\nHost {tuning['fingerprint']}: {tuning['host']}")
+    print(f"Log-mel front-end: {tuning['front_end_throughput']:.0f} s of audio/s per process")
+    print(f"{'threads':>7} {'batch':>5} {'audio s/s':>9} {'p50 (ms)':>8} {'p95 (ms)':>8} {'decoders':>8} {'pipeline s/s':>12}")
+    for result in tuning['results']:
+        print(f"{result['threads']:>7} {result['batch_size']:>5} {result['throughput']:>9.1f} {result['p50_ms']:>8.0f} "
+              f"{result['p95_ms']:>8.0f} {result['cpu_workers']:>8} {result['pipeline_throughput']:>12.1f}")
+    print('\n' + '\n'.join(f"{name}={value}" for (name, value) in tuning['settings'].items()))
+    if not args.dry_run:
+        save_tuning(tuning, args.output)
+        print(f"Saved to {args.output}")
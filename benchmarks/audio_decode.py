@@ -0,0 +1,117 @@
+"""
+Time to get the audio of a video as samples at cfg.working_sample_rate, per decoder:
+    legacy  ffmpeg CLI writing a WAV file, read back with soundfile (the old read_audio_from_video)
+    pipe    ffmpeg CLI streaming raw float32 into a pipe (decode_audio_ffmpeg)
+    pyav    in-process decoding of the audio stream only (decode_audio_pyav)
+and how far the new decoders' log-mel features are from the legacy ones.
+
+Usage (from the repository root):
+    python -m benchmarks.audio_decode --videos clip1.mp4 clip2.mov
+    python -m benchmarks.audio_decode --durations 5 30 120   # synthetic videos
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import av
+import numpy as np
+
+from dataset.spectogram import spectogram_configs as cfg
+from dataset.dataset_utils import (decode_audio_ffmpeg, decode_audio_pyav, fit_audio_channels, pad_to_fft_size,
+                                   read_multichannel_audio)
+from dataset.spectogram.preprocess import multichannel_complex_to_log_mel, multichannel_stft
+
+
+def legacy_read_audio_from_video(video_path, cache_dir):
+    audio_path = os.path.join(cache_dir, f"{os.path.splitext(os.path.basename(video_path))[0]}.wav")
+    subprocess.run(['ffmpeg', '-nostdin', '-loglevel', 'error', '-y', '-i', video_path,
+                    '-vn', '-ac', '1', '-ar', str(cfg.working_sample_rate), '-f', 'wav', audio_path], check=True)
+    audio = read_multichannel_audio(audio_path)
+    os.remove(audio_path)
+    return audio
+
+
+def write_synthetic_video(path, seconds, sample_rate=48000, fps=30):
+    """A 640x360 h264 video with a stereo AAC track of noise and a few clicks"""
+    rng = np.random.default_rng(0)
+    container = av.open(path, mode='w')
+    video = container.add_stream('h264', rate=fps)
+    video.width, video.height, video.pix_fmt = 640, 360, 'yuv420p'
+    audio = container.add_stream('aac', rate=sample_rate, layout='stereo')
+
+    image = rng.integers(0, 255, (360, 640, 3), dtype=np.uint8)
+    for _ in range(seconds * fps):
+        for packet in video.encode(av.VideoFrame.from_ndarray(image, format='rgb24')):
+            container.mux(packet)
+
+    samples = (rng.standard_normal((2, seconds * sample_rate)) * 0.05).astype(np.float32)
+    samples[:, ::sample_rate] = 0.9
+    frame_size = 1024
+    for start in range(0, samples.shape[1], frame_size):
+        frame = av.AudioFrame.from_ndarray(np.ascontiguousarray(samples[:, start:start + frame_size]),
+                                           format='fltp', layout='stereo')
+        frame.sample_rate = sample_rate
+        frame.pts = start
+        for packet in audio.encode(frame):
+            container.mux(packet)
+    for stream in [video, audio]:
+        for packet in stream.encode(None):
+            container.mux(packet)
+    container.close()
+
+
+def time_decoder(decode, repeats):
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        audio = decode()
+        durations.append(time.perf_counter() - start)
+    return audio, float(np.median(durations))
+
+
+def log_mel(audio):
+    return multichannel_complex_to_log_mel(multichannel_stft(audio))
+
+
+def benchmark(video_path, repeats, cache_dir):
+    decoders = {'pyav': lambda: pad_to_fft_size(fit_audio_channels(decode_audio_pyav(video_path)))}
+    if shutil.which('ffmpeg'):
+        decoders['legacy'] = lambda: legacy_read_audio_from_video(video_path, cache_dir)
+        decoders['pipe'] = lambda: pad_to_fft_size(fit_audio_channels(decode_audio_ffmpeg(video_path)))
+
+    results = {name: time_decoder(decode, repeats) for name, decode in decoders.items()}
+    seconds = results['pyav'][0].shape[0] / cfg.working_sample_rate
+    print(f"{os.path.basename(video_path)}: {seconds:.1f}s of audio")
+    reference = log_mel(results['legacy'][0]) if 'legacy' in results else None
+    for name, (audio, duration) in results.items():
+        line = f"  {name:>6}: {duration * 1000:8.1f} ms ({seconds / duration:6.0f}x realtime), {audio.dtype}"
+        if reference is not None and name != 'legacy':
+            features = log_mel(audio)
+            frames = min(features.shape[1], reference.shape[1])
+            diff = np.abs(features[:, :frames] - reference[:, :frames])
+            line += (f", frames {features.shape[1]} vs {reference.shape[1]}, "
+                     f"log-mel abs diff mean {diff.mean():.4f} dB, max {diff.max():.3f} dB")
+        print(line)
+    if 'legacy' not in results:
+        print("  ffmpeg is not on PATH, legacy and pipe decoders skipped")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Audio decoding time per decoder')
+    parser.add_argument('--videos', nargs='*', default=[])
+    parser.add_argument('--durations', type=int, nargs='*', default=[5, 30, 120],
+                        help='Seconds of the synthetic videos used when no --videos are given')
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        videos = args.videos
+        if not videos:
+            for seconds in args.durations:
+                videos.append(os.path.join(work_dir, f"synthetic_{seconds}s.mp4"))
+                write_synthetic_video(videos[-1], seconds)
+        for video_path in videos:
+            benchmark(video_path, args.repeats, work_dir)
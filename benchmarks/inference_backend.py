@@ -0,0 +1,96 @@
+"""
+Cold against warm latency of each inference backend: startup cost (compilation and warm-up of every bucket),
+latency of the first request of each length without warm-up, latency of requests after warm-up, and the largest
+output difference to the eager model. Every backend runs in a fresh process, so nothing is warm from the previous one.
+
+Without --ckpt the model has random weights.
+
+Usage (from the repository root):
+    python -m benchmarks.inference_backend --ckpt model_checkpoint.pt --backends eager script compile
+    python -m benchmarks.inference_backend --lengths 3 7 20 --buckets 5 10 30 --batch_buckets 1
+"""
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+import numpy as np
+import torch
+
+from dataset.spectogram import spectogram_configs as cfg
+from inference_backend import BACKENDS, InferenceBackend
+from models.DcaseNet import DcaseNet_v3
+from windowed_inference import forward_batch
+
+
+def load_model(ckpt):
+    torch.manual_seed(0)
+    model = DcaseNet_v3(1)
+    if ckpt:
+        model.load_state_dict(torch.load(ckpt, map_location='cpu')['model'])
+    return model.eval()
+
+
+def requests(lengths):
+    rng = np.random.default_rng(0)
+    return [rng.standard_normal((cfg.audio_channels, int(seconds * cfg.frames_per_second), cfg.mel_bins))
+            .astype(np.float32) - 40 for seconds in lengths]
+
+
+def timed_forward(model, features):
+    start = time.perf_counter()
+    output = forward_batch(model, [features], 'cpu')[0]
+    return output, (time.perf_counter() - start) * 1000
+
+
+def run_trial(args, backend, warm_up):
+    model = load_model(args.ckpt)
+    start = time.perf_counter()
+    inference_model = InferenceBackend(model, 'cpu', backend, args.buckets, args.batch_buckets)
+    if warm_up:
+        inference_model.warm_up()
+    startup_seconds = time.perf_counter() - start
+
+    first, again, max_diff = [], [], 0.0
+    for features in requests(args.lengths):
+        (output, latency) = timed_forward(inference_model, features)
+        first.append(latency)
+        again.append(timed_forward(inference_model, features)[1])
+        max_diff = max(max_diff, (output - forward_batch(model, [features], 'cpu')[0]).abs().max().item())
+    print(json.dumps({'startup_seconds': startup_seconds, 'first_ms': first, 'again_ms': again,
+                      'max_diff': max_diff, 'calls': inference_model.calls}))
+
+
+def trial(backend, warm_up):
+    output = subprocess.run([sys.executable, '-m', 'benchmarks.inference_backend', *sys.argv[1:],
+                             '--trial', backend, str(int(warm_up))], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cold and warm latency of the inference backends')
+    parser.add_argument('--ckpt', default=None)
+    parser.add_argument('--backends', nargs='*', default=['eager', 'script'], choices=BACKENDS)
+    parser.add_argument('--lengths', type=float, nargs='*', default=[3, 7, 20], help='Request lengths in seconds')
+    parser.add_argument('--buckets', type=float, nargs='*', default=[5, 10, 30], help='Length buckets in seconds')
+    parser.add_argument('--batch_buckets', type=int, nargs='*', default=[1])
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--trial', nargs=2, metavar=('BACKEND', 'WARM_UP'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    if args.trial:
+        run_trial(args, args.trial[0], bool(int(args.trial[1])))
+        sys.exit(0)
+
+    lengths = ' '.join(f"{seconds:g}s" for seconds in args.lengths)
+    print(f"Request latencies (ms) for {lengths}: first request of each length / the same request again")
+    print(f"{'backend':>8} {'warm-up':>7} {'startup (s)':>11} {'first (ms)':>22} {'again (ms)':>22} {'max diff':>9}")
+    for backend in args.backends:
+        for warm_up in [False, True]:
+            result = trial(backend, warm_up)
+            first = ' '.join(f"{latency:.0f}" for latency in result['first_ms'])
+            again = ' '.join(f"{latency:.0f}" for latency in result['again_ms'])
+            print(f"{backend:>8} {'yes' if warm_up else 'no':>7} {result['startup_seconds']:>11.2f} {first:>22} "
+                  f"{again:>22} {result['max_diff']:>9.5f}")
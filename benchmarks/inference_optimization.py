@@ -0,0 +1,98 @@
+"""
+Numerical equivalence and speed of optimize_for_inference (batch norms folded into the convolutions, DcaseNet_v3
+outputs left at the rate of its time steps): largest per-frame output difference over inputs of several lengths,
+single and padded batches, windowed inference with every stitch policy and its impact times, and the latency of
+the original and optimized models. Exits with an error when an output differs by more than --tolerance.
+
+Without --ckpt the models have random weights and random batch norm statistics, so the folding is not trivial.
+
+Usage (from the repository root):
+    python -m benchmarks.inference_optimization --ckpt model_checkpoint.pt
+"""
+import sys
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from dataset.spectogram import spectogram_configs as cfg
+from models.DcaseNet import DcaseNet_v3
+from models.checkpoints import load_dcasenet
+from models.optimization import optimize_for_inference, to_frame_rate, verify_optimized
+from models.spectogram_models import Cnn_AvgPooling
+from video_processing import detect_impact_time
+from windowed_inference import STITCH_POLICIES, WindowConfig, windowed_forward
+
+
+def randomized(model):
+    torch.manual_seed(0)
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.running_mean.uniform_(-1, 1)
+            module.running_var.uniform_(0.5, 2)
+            module.weight.data.uniform_(0.5, 1.5)
+            module.bias.data.uniform_(-0.5, 0.5)
+    return model.eval()
+
+
+def load_models(ckpt):
+    if ckpt:
+        return {'checkpoint': load_dcasenet(ckpt, 'cpu')}
+    return {'DcaseNet_v3': randomized(DcaseNet_v3(1)),
+            'DcaseNet_v3 causal': randomized(DcaseNet_v3(1, causal=True)),
+            'Cnn_AvgPooling': randomized(Cnn_AvgPooling(1))}
+
+
+def latency_ms(model, x, repeats):
+    with torch.no_grad():
+        model(x)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            model(x)
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Equivalence and speed of optimize_for_inference')
+    parser.add_argument('--ckpt', default=None)
+    parser.add_argument('--lengths', type=int, nargs='*', default=[241, 960, 2401], help='Input lengths in frames')
+    parser.add_argument('--window_seconds', type=float, default=4)
+    parser.add_argument('--overlap_seconds', type=float, default=1)
+    parser.add_argument('--latency_seconds', type=float, default=10)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--tolerance', type=float, default=1e-4)
+    args = parser.parse_args()
+    torch.set_num_threads(1)
+
+    failed = False
+    rng = np.random.default_rng(0)
+    for (name, model) in load_models(args.ckpt).items():
+        optimized = optimize_for_inference(model)
+        max_diff = max(verify_optimized(model, optimized, length, float('inf')) for length in args.lengths)
+        failed |= max_diff > args.tolerance
+        print(f"{name}: largest per-frame difference {max_diff:.2e} over {args.lengths} frames")
+
+        if isinstance(model, DcaseNet_v3):
+            features = rng.standard_normal((1, int(3.5 * args.window_seconds * cfg.frames_per_second) + 1,
+                                            cfg.mel_bins)).astype(np.float32)
+            for policy in STITCH_POLICIES:
+                window_config = WindowConfig(args.window_seconds, args.overlap_seconds, policy)
+                expected = windowed_forward(model, features, 'cpu', window_config)
+                output = windowed_forward(optimized, features, 'cpu', window_config)
+                diff = (to_frame_rate(output, optimized.frame_rate_factor) - expected).abs().max().item()
+                (expected_impact, impact) = (detect_impact_time(expected),
+                                             detect_impact_time(output, optimized.frame_rate_factor))
+                failed |= diff > args.tolerance or expected_impact != impact
+                print(f"  windowed ({policy}): largest difference {diff:.2e}, impact {expected_impact:.3f}s "
+                      f"-> {impact:.3f}s")
+
+        x = torch.from_numpy(rng.standard_normal((1, cfg.audio_channels, int(args.latency_seconds * cfg.frames_per_second),
+                                                  cfg.mel_bins)).astype(np.float32))
+        (original_ms, optimized_ms) = (latency_ms(model, x, args.repeats), latency_ms(optimized, x, args.repeats))
+        print(f"  {args.latency_seconds:g}s input: {original_ms:.1f} ms -> {optimized_ms:.1f} ms "
+              f"({original_ms / optimized_ms:.2f}x)")
+
+    if failed:
+        print(f"Optimized models differ from the originals (tolerance {args.tolerance})")
+        sys.exit(1)
@@ -0,0 +1,70 @@
+"""
+End-to-end latency of live detection: audio is fed to a LiveDetector in real time, in chunks of the given
+durations, and the latency of every output step is the time from when the audio of its first frame was captured
+to when its probability was computed. That is the algorithmic latency (STFT half window and convolution lookahead),
+plus the wait for the chunk to fill, plus the compute time of the step.
+
+Without --ckpt the causal model has random weights, which doesn't change the latency.
+
+Usage (from the repository root):
+    python -m benchmarks.live_latency --ckpt causal_checkpoint.pt --chunk_ms 10 20 50
+"""
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from dataset.spectogram import spectogram_configs as cfg
+from live_detection import LiveDetector, algorithmic_latency_seconds
+from models.checkpoints import load_dcasenet
+from models.DcaseNet import DcaseNet_v3
+
+
+def load_model(ckpt):
+    if ckpt:
+        return load_dcasenet(ckpt, 'cpu')
+    torch.manual_seed(0)
+    return DcaseNet_v3(1, causal=True).eval()
+
+
+def run(model, chunk_ms, seconds):
+    rng = np.random.default_rng(0)
+    audio = (rng.standard_normal(int(seconds * cfg.working_sample_rate)) * 0.05).astype(np.float32)
+    chunk = int(chunk_ms / 1000 * cfg.working_sample_rate)
+    detector = LiveDetector(model)
+    latencies = []
+    compute = 0.0
+    stream_start = time.perf_counter()
+    for start in range(0, audio.shape[0], chunk):
+        end = min(start + chunk, audio.shape[0])
+        # Wait until the chunk was "captured"
+        captured = stream_start + end / cfg.working_sample_rate
+        time.sleep(max(0.0, captured - time.perf_counter()))
+        steps = detector.frames // 2
+        push_start = time.perf_counter()
+        detector.push(audio[start:end])
+        emitted = time.perf_counter()
+        compute += emitted - push_start
+        for step in range(steps, detector.frames // 2):
+            first_sample = 2 * step * cfg.hop_size
+            latencies.append(emitted - (stream_start + first_sample / cfg.working_sample_rate))
+    return np.array(latencies) * 1000, compute / seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Live detection latency')
+    parser.add_argument('--ckpt', default=None, help='Causal checkpoint (train.py --causal)')
+    parser.add_argument('--chunk_ms', type=float, nargs='*', default=[10, 20, 50])
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--threads', type=int, default=1)
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    model = load_model(args.ckpt)
+    print(f"Algorithmic latency: {algorithmic_latency_seconds() * 1000:.1f} ms")
+    print(f"{'chunk (ms)':>10} {'median (ms)':>11} {'p95 (ms)':>8} {'max (ms)':>8} {'real-time factor':>16}")
+    for chunk_ms in args.chunk_ms:
+        (latencies, real_time_factor) = run(model, chunk_ms, args.seconds)
+        print(f"{chunk_ms:>10g} {np.median(latencies):>11.1f} {np.percentile(latencies, 95):>8.1f} "
+              f"{latencies.max():>8.1f} {real_time_factor:>16.3f}")
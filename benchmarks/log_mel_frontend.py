@@ -0,0 +1,58 @@
+"""
+Cost per second of audio of the log-mel front-end: the librosa per-channel STFT loop
+(preprocess.multichannel_stft + multichannel_complex_to_log_mel) against the vectorized torch front-end,
+for single clips and batches, and the largest difference between their features.
+
+Usage (from the repository root):
+    python -m benchmarks.log_mel_frontend --seconds 5 60 --batch_sizes 1 8 --threads 1 4
+"""
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from dataset.spectogram import spectogram_configs as cfg
+from dataset.spectogram import torch_frontend
+from dataset.spectogram.preprocess import multichannel_complex_to_log_mel, multichannel_stft
+
+
+def librosa_log_mel(waveform):
+    return multichannel_complex_to_log_mel(multichannel_stft(waveform))
+
+
+def ms_per_audio_second(fn, audio_seconds, repeats):
+    fn()  # warm-up, builds the cached window and mel basis
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats / audio_seconds * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Log-mel front-end cost per second of audio')
+    parser.add_argument('--seconds', type=float, nargs='+', default=[5, 60])
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, torch.get_num_threads()])
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'clip (s)':>8} {'batch':>5} {'threads':>7} {'librosa ms/s':>12} {'torch ms/s':>10} {'speedup':>7} {'max diff (dB)':>13}")
+    for seconds in args.seconds:
+        for batch_size in args.batch_sizes:
+            # Slightly different lengths, as the clips of a real batch
+            clips = [(rng.standard_normal((int(seconds * cfg.working_sample_rate) + i * cfg.hop_size,
+                                           cfg.audio_channels)) * 0.1).astype(np.float32) for i in range(batch_size)]
+            audio_seconds = sum(clip.shape[0] for clip in clips) / cfg.working_sample_rate
+
+            max_diff = max(np.abs(reference - features).max() for reference, features
+                           in zip([librosa_log_mel(clip) for clip in clips], torch_frontend.batch_log_mel(clips)))
+            for threads in args.threads:
+                torch.set_num_threads(threads)
+                librosa_cost = ms_per_audio_second(lambda: [librosa_log_mel(clip) for clip in clips],
+                                                   audio_seconds, args.repeats)
+                torch_cost = ms_per_audio_second(lambda: torch_frontend.batch_log_mel(clips),
+                                                 audio_seconds, args.repeats)
+                print(f"{seconds:>8.0f} {batch_size:>5} {threads:>7} {librosa_cost:>12.2f} {torch_cost:>10.2f} "
+                      f"{librosa_cost / torch_cost:>6.1f}x {max_diff:>13.5f}")
@@ -0,0 +1,136 @@
+"""
+PyTorch against ONNX Runtime for DcaseNet_v3: startup time (imports, model load and the first request), RSS after
+startup, peak RSS, median latency of requests of the given lengths, and the largest per-frame output difference.
+Every backend runs in a fresh process. The onnx process imports only onnxruntime and numpy, i.e. what a container
+without PyTorch runs the model with (the server's log-mel front-end still uses torch).
+
+Without --ckpt the model has random weights. The checkpoint is exported next to it (export_onnx.py) when its .onnx
+is missing.
+
+Usage (from the repository root):
+    python -m benchmarks.onnx_backend --ckpt model_checkpoint.pt --lengths 5 30 --threads 1 4
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+
+import numpy as np
+
+# As in spectogram_configs, which imports torch (through utils.common) and so can't be imported by the onnx trial
+FRAMES_PER_SECOND = 44100 / 183
+CHANNELS = 2
+MEL_BINS = 64
+
+
+def rss_mb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_trial(backend, path, lengths, repeats, threads):
+    start = time.perf_counter()
+    if backend == 'torch':
+        import torch
+        from models.checkpoints import load_dcasenet
+        torch.set_num_threads(threads)
+        model = load_dcasenet(path, 'cpu')
+
+        def forward(x):
+            with torch.no_grad():
+                return model(torch.from_numpy(x)).numpy()
+    else:
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+        def forward(x):
+            return session.run(None, {'log_mel': x})[0]
+
+    rng = np.random.default_rng(0)
+    inputs = [rng.standard_normal((1, CHANNELS, int(seconds * FRAMES_PER_SECOND), MEL_BINS)).astype(np.float32)
+              for seconds in lengths]
+    outputs = [forward(inputs[0])]
+    startup_seconds = time.perf_counter() - start
+    startup_rss = rss_mb()
+
+    latencies = []
+    for (i, x) in enumerate(inputs):
+        durations = []
+        for _ in range(repeats):
+            request_start = time.perf_counter()
+            output = forward(x)
+            durations.append(time.perf_counter() - request_start)
+        if i > 0:
+            outputs.append(output)
+        latencies.append(float(np.median(durations)) * 1000)
+    print(json.dumps({'startup_seconds': startup_seconds, 'startup_rss_mb': startup_rss,
+                      'peak_rss_mb': peak_rss_mb(), 'latency_ms': latencies,
+                      'outputs': [output[0, :, 0].tolist() for output in outputs]}))
+
+
+def trial(backend, path, args, threads):
+    command = [sys.executable, '-m', 'benchmarks.onnx_backend', '--trial', backend, path,
+               '--lengths', *[str(seconds) for seconds in args.lengths], '--repeats', str(args.repeats),
+               '--threads', str(threads)]
+    output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def prepare_models(ckpt, work_dir):
+    """Paths of the checkpoint and its export"""
+    import torch
+    from models.DcaseNet import DcaseNet_v3
+    from models.checkpoints import checkpoint_version, load_dcasenet
+    from models.onnx_models import export_onnx, onnx_path
+
+    if not ckpt:
+        torch.manual_seed(0)
+        ckpt = os.path.join(work_dir, 'random.pt')
+        torch.save({'model': DcaseNet_v3(1).state_dict()}, ckpt)
+    exported = onnx_path(ckpt)
+    if not os.path.exists(exported):
+        export_onnx(load_dcasenet(ckpt, 'cpu'), exported, 2, checkpoint_version(ckpt))
+    return ckpt, exported
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PyTorch against ONNX Runtime inference')
+    parser.add_argument('--ckpt', default=None)
+    parser.add_argument('--lengths', type=float, nargs='*', default=[5, 30], help='Request lengths in seconds')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--threads', type=int, nargs='*', default=[1])
+    parser.add_argument('--trial', nargs=2, metavar=('BACKEND', 'PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.trial:
+        run_trial(*args.trial, args.lengths, args.repeats, args.threads[0])
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        (ckpt, exported) = prepare_models(args.ckpt, work_dir)
+        latency_columns = ' '.join(f"{f'{seconds:g}s (ms)':>10}" for seconds in args.lengths)
+        print(f"{'backend':>8} {'threads':>7} {'startup (s)':>11} {'RSS (MB)':>8} {'peak RSS (MB)':>13} "
+              f"{latency_columns} {'max diff':>9}")
+        for threads in args.threads:
+            results = {'torch': trial('torch', ckpt, args, threads), 'onnx': trial('onnx', exported, args, threads)}
+            max_diff = max(float(np.abs(np.array(a) - np.array(b)).max())
+                           for (a, b) in zip(results['torch']['outputs'], results['onnx']['outputs']))
+            for (backend, result) in results.items():
+                latencies = ' '.join(f"{latency:>10.1f}" for latency in result['latency_ms'])
+                print(f"{backend:>8} {threads:>7} {result['startup_seconds']:>11.2f} {result['startup_rss_mb']:>8.0f} "
+                      f"{result['peak_rss_mb']:>13.0f} {latencies} "
+                      f"{max_diff if backend == 'onnx' else 0:>9.2e}")
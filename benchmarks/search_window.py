@@ -0,0 +1,59 @@
+"""
+Time to decode a video and compute its log-mel features, whole or only a search window of it,
+and how close the window's features are to those of the whole video's audio cut to the window.
+
+Usage (from the repository root):
+    python -m benchmarks.search_window --videos swing.mp4 --windows 0:4 1.5:3.5
+    python -m benchmarks.search_window --duration 30   # a synthetic video
+"""
+import os
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+from benchmarks.audio_decode import write_synthetic_video
+from dataset.dataset_utils import pad_to_fft_size, read_audio_from_video
+from dataset.spectogram import spectogram_configs as cfg
+from dataset.spectogram import torch_frontend
+from dataset.spectogram.preprocess import extract_log_mel_from_video
+
+
+def timed(fn, repeats):
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        durations.append(time.perf_counter() - start)
+    return result, float(np.median(durations))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Whole video against search window feature extraction')
+    parser.add_argument('--videos', nargs='*', default=[])
+    parser.add_argument('--duration', type=int, default=30, help='Seconds of the synthetic video used when no --videos are given')
+    parser.add_argument('--windows', nargs='*', default=['0:4', '0:8', '10:14'], help='start:end seconds')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        videos = args.videos
+        if not videos:
+            videos.append(os.path.join(work_dir, f"synthetic_{args.duration}s.mp4"))
+            write_synthetic_video(videos[-1], args.duration)
+
+        for video_path in videos:
+            whole, whole_seconds = timed(lambda: extract_log_mel_from_video(video_path), args.repeats)
+            whole_audio = read_audio_from_video(video_path)[:, :1]
+            print(f"{os.path.basename(video_path)}: whole {whole.shape[1] * cfg.hop_size / cfg.working_sample_rate:.1f}s in "
+                  f"{whole_seconds * 1000:.0f} ms")
+            for window in args.windows:
+                (start, end) = (float(value) for value in window.split(':'))
+                features, seconds = timed(lambda: extract_log_mel_from_video(video_path, start, end), args.repeats)
+                reference = torch_frontend.log_mel(pad_to_fft_size(
+                    whole_audio[round(start * cfg.working_sample_rate):round(end * cfg.working_sample_rate)]), compact=True)
+                frames = min(features.shape[1], reference.shape[1])
+                diff = np.abs(features[:, :frames] - reference[:, :frames])
+                print(f"  [{start:g}, {end:g}]s: {seconds * 1000:6.0f} ms ({whole_seconds / seconds:4.1f}x faster), "
+                      f"log-mel abs diff mean {diff.mean():.4f} dB, median {np.median(diff):.4f} dB")
@@ -0,0 +1,116 @@
+"""
+Peak RSS of getting the log-mel features of a recording against its duration: all at once
+(extract_log_mel_from_video) or in blocks while decoding (stream_log_mel_from_video), optionally followed by
+windowed inference with a randomly initialized DcaseNet_v3 (--model). Also checks that both give the same features.
+
+Usage (from the repository root):
+    python -m benchmarks.streaming_features --videos long_clip.mp4
+    python -m benchmarks.streaming_features --durations 60 600 1800 --model   # synthetic audio files
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+
+import av
+import numpy as np
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def write_synthetic_audio(path, seconds, sample_rate=48000):
+    """A stereo AAC file of noise with a click every second, written a second at a time"""
+    rng = np.random.default_rng(0)
+    container = av.open(path, mode='w')
+    stream = container.add_stream('aac', rate=sample_rate, layout='stereo')
+    frame_size = 1024
+    for second in range(seconds):
+        samples = (rng.standard_normal((2, sample_rate)) * 0.05).astype(np.float32)
+        samples[:, 0] = 0.9
+        for start in range(0, sample_rate, frame_size):
+            frame = av.AudioFrame.from_ndarray(np.ascontiguousarray(samples[:, start:start + frame_size]),
+                                               format='fltp', layout='stereo')
+            frame.sample_rate = sample_rate
+            frame.pts = second * sample_rate + start
+            for packet in stream.encode(frame):
+                container.mux(packet)
+    for packet in stream.encode(None):
+        container.mux(packet)
+    container.close()
+
+
+def run_trial(mode, path, model):
+    import torch
+    from dataset.spectogram.preprocess import extract_log_mel_from_video, stream_log_mel_from_video
+    from models.DcaseNet import DcaseNet_v3
+    from windowed_inference import windowed_forward, windowed_forward_stream
+
+    torch.set_num_threads(1)
+    if mode == 'parity':
+        whole = extract_log_mel_from_video(path)
+        streamed = np.concatenate(list(stream_log_mel_from_video(path)), axis=1)
+        print(json.dumps({'frames': [whole.shape[1], streamed.shape[1]],
+                          'max_diff': float(np.abs(whole - streamed).max())}))
+        return
+
+    dcasenet = DcaseNet_v3(1).eval() if model else None
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    if mode == 'whole':
+        features = extract_log_mel_from_video(path)
+        frames = features.shape[1]
+        if dcasenet is not None:
+            windowed_forward(dcasenet, features, 'cpu')
+    else:
+        blocks = stream_log_mel_from_video(path)
+        if dcasenet is not None:
+            frames = windowed_forward_stream(dcasenet, blocks, 'cpu').shape[0]
+        else:
+            frames = sum(block.shape[1] for block in blocks)
+    print(json.dumps({'frames': frames, 'seconds': time.perf_counter() - start,
+                      'baseline_rss_mb': baseline, 'peak_rss_mb': peak_rss_mb()}))
+
+
+def trial(mode, path, model):
+    # A fresh process per trial so peak RSS isn't inherited from the previous one
+    command = [sys.executable, '-m', 'benchmarks.streaming_features', '--trial', mode, path] + (['--model'] if model else [])
+    output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Peak RSS of whole and streaming feature extraction')
+    parser.add_argument('--videos', nargs='*', default=[])
+    parser.add_argument('--durations', type=int, nargs='*', default=[60, 600, 1800],
+                        help='Seconds of the synthetic audio files used when no --videos are given')
+    parser.add_argument('--model', action='store_true', help='Run windowed inference on the features too')
+    parser.add_argument('--trial', nargs=2, metavar=('MODE', 'PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.trial:
+        run_trial(*args.trial, args.model)
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        paths = args.videos
+        if not paths:
+            for seconds in args.durations:
+                paths.append(os.path.join(work_dir, f"synthetic_{seconds}s.m4a"))
+                write_synthetic_audio(paths[-1], seconds)
+
+        print(f"{'recording':>24} {'whole (s)':>9} {'whole peak RSS (MB)':>19} {'stream (s)':>10} "
+              f"{'stream peak RSS (MB)':>20} {'max diff (dB)':>13}")
+        for path in paths:
+            results = {mode: trial(mode, path, args.model) for mode in ['whole', 'stream', 'parity']}
+            if len(set(results['parity']['frames'])) != 1:
+                print(f"  frame counts differ: {results['parity']['frames']}")
+            print(f"{os.path.basename(path)[-24:]:>24} {results['whole']['seconds']:>9.2f} "
+                  f"{results['whole']['peak_rss_mb']:>19.1f} {results['stream']['seconds']:>10.2f} "
+                  f"{results['stream']['peak_rss_mb']:>20.1f} {results['parity']['max_diff']:>13.5f}")
@@ -0,0 +1,99 @@
+"""
+Peak RSS of saving an uploaded video and handing it to storage, against the video size.
+Compares the old path (whole upload read into memory, then the file read again for storage)
+with the chunked path used by POST /tasks.
+
+The chunked path calls the real upload_video of a storage client: the SQLite backend's storage directory by
+default, which is a local file copy, or the configured Supabase project with --backend supabase (uploads a test file
+and deletes it). The old path is a simulation: it reads the upload and the file into memory as the previous code and
+storage client did, without sending anything.
+
+Usage (from the repository root):
+    python -m benchmarks.upload_memory --sizes_mb 64 256 1024
+    python -m benchmarks.upload_memory --sizes_mb 256 --backend supabase
+"""
+import os
+import sys
+import json
+import asyncio
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from video_processing import UPLOAD_CHUNK_SIZE, copy_file_object
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def buffered_path(upload_file, output, client):
+    async def run():
+        content = await upload_file.read()
+        output.write(content)
+        output.flush()
+    asyncio.run(run())
+    # Simulated: the previous storage client was handed the file's bytes
+    with open(output.name, 'rb') as f:
+        file_content = f.read()
+    return len(file_content)
+
+
+def chunked_path(upload_file, output, client):
+    copy_file_object(upload_file.file, output, UPLOAD_CHUNK_SIZE)
+    output.flush()
+    file_name = f"upload-memory-{os.getpid()}.mp4"
+    client.upload_video(output.name, file_name)
+    client.delete_video(file_name)
+    return os.path.getsize(output.name)
+
+
+def open_storage_client(backend, storage_dir):
+    if backend == 'supabase':
+        from supabase_client import supabase
+        return supabase
+    from sqlite_client import SqliteClient
+    return SqliteClient(os.path.join(storage_dir, 'tasks.db'), storage_dir)
+
+
+def run_trial(mode, video_path, backend):
+    from fastapi import UploadFile
+
+    with tempfile.TemporaryDirectory() as storage_dir:
+        client = open_storage_client(backend, storage_dir)
+        baseline = peak_rss_mb()
+        with open(video_path, 'rb') as source, tempfile.NamedTemporaryFile() as output:
+            upload_file = UploadFile(file=source, filename=os.path.basename(video_path))
+            size = (buffered_path if mode == 'buffered' else chunked_path)(upload_file, output, client)
+    print(json.dumps({'mode': mode, 'backend': backend, 'bytes': size, 'baseline_rss_mb': baseline,
+                      'peak_rss_mb': peak_rss_mb()}))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Peak RSS of the upload path against the video size')
+    parser.add_argument('--sizes_mb', type=int, nargs='+', default=[16, 64, 256, 1024])
+    parser.add_argument('--backend', choices=['sqlite', 'supabase'], default='sqlite',
+                        help='Storage the chunked path uploads to')
+    parser.add_argument('--trial', nargs=2, metavar=('MODE', 'VIDEO_PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.trial:
+        run_trial(*args.trial, args.backend)
+        sys.exit(0)
+
+    print(f"{'size (MB)':>10} {'buffered peak RSS (MB)':>24} {'chunked peak RSS (MB)':>23}")
+    for size_mb in args.sizes_mb:
+        with tempfile.NamedTemporaryFile(suffix='.mp4') as video:
+            for _ in range(size_mb):
+                video.write(os.urandom(1024 * 1024))
+            video.flush()
+
+            peaks = {}
+            for mode in ['buffered', 'chunked']:
+                # A fresh process per trial so peak RSS isn't inherited from the previous one
+                output = subprocess.run([sys.executable, '-m', 'benchmarks.upload_memory', '--trial', mode, video.name,
+                                         '--backend', args.backend], capture_output=True, text=True, check=True).stdout
+                peaks[mode] = json.loads(output.strip().splitlines()[-1])['peak_rss_mb']
+        print(f"{size_mb:>10} {peaks['buffered']:>24.1f} {peaks['chunked']:>23.1f}")
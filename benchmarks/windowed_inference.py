@@ -0,0 +1,124 @@
+"""
+Windowed inference against whole-clip inference: largest output difference, impact time agreement,
+time and peak RSS per clip, for each stitch policy.
+
+Clips are the pickled features written by preprocess_data (--features), the audio of videos (--videos),
+or random features of the given --durations. Without --ckpt the model has random weights, which checks the
+windowing and stitching machinery but not the accuracy of a trained model.
+
+Usage (from the repository root):
+    python -m benchmarks.windowed_inference --ckpt model_checkpoint.pt --features data/features/*.pkl
+    python -m benchmarks.windowed_inference --durations 60 300 --window_seconds 30 --overlap_seconds 4
+"""
+import sys
+import json
+import time
+import pickle
+import argparse
+import resource
+import subprocess
+
+import numpy as np
+import torch
+
+from dataset.spectogram import spectogram_configs as cfg
+from models.DcaseNet import DcaseNet_v3
+from video_processing import detect_impact_time
+from windowed_inference import STITCH_POLICIES, WindowConfig, forward_batch, windowed_forward
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load_model(ckpt):
+    torch.manual_seed(0)
+    model = DcaseNet_v3(1)
+    if ckpt:
+        model.load_state_dict(torch.load(ckpt, map_location='cpu')['model'])
+    return model.eval()
+
+
+def load_clips(args):
+    clips = []
+    for path in args.features:
+        with open(path, 'rb') as f:
+            clips.append((path, np.asarray(pickle.load(f)['features'], dtype=np.float32)))
+    if args.videos:
+        from dataset.spectogram.preprocess import extract_log_mel_from_video
+        clips += [(path, extract_log_mel_from_video(path)) for path in args.videos]
+    if not clips:
+        rng = np.random.default_rng(0)
+        for seconds in args.durations:
+            frames = int(seconds * cfg.frames_per_second)
+            features = rng.standard_normal((cfg.audio_channels, frames, cfg.mel_bins)).astype(np.float32) - 40
+            # A loud event, so the impact time is well defined
+            features[:, frames // 3:frames // 3 + 20] += 30
+            clips.append((f"random {seconds}s", features))
+    return clips
+
+
+def run_trial(args, clip_index, mode):
+    (_, features) = load_clips(args)[clip_index]
+    model = load_model(args.ckpt)
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    if mode == 'whole':
+        output = forward_batch(model, [features], 'cpu')[0]
+    else:
+        window_config = WindowConfig(args.window_seconds, args.overlap_seconds, mode)
+        output = windowed_forward(model, features, 'cpu', window_config, args.max_batch_size)
+    seconds = time.perf_counter() - start
+    print(json.dumps({'seconds': seconds, 'baseline_rss_mb': baseline, 'peak_rss_mb': peak_rss_mb(),
+                      'output': output[:, 0].tolist()}))
+
+
+def trial(args, clip_index, mode):
+    # A fresh process per trial, and no forward pass in this one, since Linux keeps the peak RSS
+    # of the parent in the child
+    output = subprocess.run([sys.executable, '-m', 'benchmarks.windowed_inference', *sys.argv[1:],
+                             '--trial', str(clip_index), mode], capture_output=True, text=True, check=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result['output'] = torch.tensor(result['output'])[:, None]
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Windowed against whole-clip inference')
+    parser.add_argument('--ckpt', default=None)
+    parser.add_argument('--features', nargs='*', default=[])
+    parser.add_argument('--videos', nargs='*', default=[])
+    parser.add_argument('--durations', type=float, nargs='*', default=[20, 60, 300])
+    parser.add_argument('--window_seconds', type=float, default=30)
+    parser.add_argument('--overlap_seconds', type=float, default=4)
+    parser.add_argument('--max_batch_size', type=int, default=8)
+    parser.add_argument('--trial', nargs=2, metavar=('CLIP_INDEX', 'MODE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    torch.set_num_threads(1)
+
+    if args.trial:
+        run_trial(args, int(args.trial[0]), args.trial[1])
+        sys.exit(0)
+
+    print(f"{'clip':>24} {'mode':>7} {'windows':>7} {'max diff':>9} {'impact (s)':>10} {'time (s)':>8} {'peak RSS (MB)':>13}")
+    agreements = {policy: 0 for policy in STITCH_POLICIES}
+    clips = load_clips(args)
+    for clip_index, (name, features) in enumerate(clips):
+        result = trial(args, clip_index, 'whole')
+        whole = result['output']
+        whole_impact = detect_impact_time(whole)
+        print(f"{name[-24:]:>24} {'whole':>7} {1:>7} {'':>9} {whole_impact:>10.3f} {result['seconds']:>8.2f} "
+              f"{result['peak_rss_mb']:>13.1f}")
+        for policy in STITCH_POLICIES:
+            window_config = WindowConfig(args.window_seconds, args.overlap_seconds, policy)
+            result = trial(args, clip_index, policy)
+            output = result['output']
+            impact = detect_impact_time(output)
+            # Within one output frame
+            agreements[policy] += abs(impact - whole_impact) <= cfg.hop_size / cfg.working_sample_rate
+            print(f"{'':>24} {policy:>7} {len(window_config.spans(features.shape[1])):>7} "
+                  f"{(output - whole).abs().max().item():>9.5f} {impact:>10.3f} {result['seconds']:>8.2f} "
+                  f"{result['peak_rss_mb']:>13.1f}")
+    for policy, agreed in agreements.items():
+        print(f"{policy}: impact time within one frame of whole-clip inference for {agreed}/{len(clips)} clips")
@@ -0,0 +1,141 @@
+"""
+Forward-pass throughput of DcaseNet_v3 on N cores, served the ways serve.py can:
+    pinned    N processes of one thread, each pinned to a core of its own (serve.py's default)
+    threads   one process of N threads
+    unpinned  N processes of torch's default thread count (all cores each): what N uvicorn workers would do
+Every process maps the weights from one shared file (models/shared_weights.py), as serve.py's workers do, and
+reports its proportional set size (PSS, shared pages split between the processes mapping them); outputs of all
+processes are compared with those of the first.
+
+Without --ckpt the model has random weights.
+
+Usage (from the repository root):
+    python -m benchmarks.worker_scaling --ckpt model_checkpoint.pt --cores 1 2 4 --seconds 10
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+# As in spectogram_configs
+FRAMES_PER_SECOND = 44100 / 183
+CHANNELS = 2
+MEL_BINS = 64
+
+
+def pss_mb():
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return float('nan')
+
+
+def run_trial(path, threads, cpus, length, start_at, seconds):
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    import torch
+    from models.shared_weights import map_shared_weights
+    if threads:
+        torch.set_num_threads(threads)
+    model = map_shared_weights(path)
+
+    x = torch.from_numpy(np.random.default_rng(0).standard_normal(
+        (1, CHANNELS, int(length * FRAMES_PER_SECOND), MEL_BINS)).astype(np.float32))
+    with torch.no_grad():
+        output = model(x)
+        time.sleep(max(0.0, start_at - time.time()))
+        passes = 0
+        end_at = start_at + seconds
+        while time.time() < end_at:
+            model(x)
+            passes += 1
+    print(json.dumps({'passes': passes, 'pss_mb': pss_mb(), 'output': output[0, :, 0].tolist()}))
+
+
+def trial_processes(mode, cores, args):
+    """Commands of the processes of a trial on the first `cores` cores"""
+    available = sorted(os.sched_getaffinity(0))
+    common = ['--length', str(args.length), '--seconds', str(args.seconds)]
+    if mode == 'threads':
+        return [['--threads', str(cores)] + common]
+    if mode == 'pinned':
+        return [['--threads', '1', '--cpus', str(available[i % len(available)])] + common for i in range(cores)]
+    return [['--threads', '0'] + common for _ in range(cores)]
+
+
+def trial(path, mode, cores, args):
+    # Every process loads its model first, then they all start at once
+    start_at = time.time() + args.startup_seconds
+    processes = [subprocess.Popen([sys.executable, '-m', 'benchmarks.worker_scaling', '--trial', path,
+                                   '--start-at', str(start_at)] + command, stdout=subprocess.PIPE, text=True)
+                 for command in trial_processes(mode, cores, args)]
+    results = []
+    for process in processes:
+        (output, _) = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(f"{mode} trial process failed with code {process.returncode}")
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return results
+
+
+def prepare_weights(ckpt, work_dir):
+    """Path of the shared weights of the served model of the checkpoint"""
+    import torch
+    from models.DcaseNet import DcaseNet_v3
+    from models.checkpoints import load_dcasenet
+    from models.optimization import load_optimized
+    from models.shared_weights import write_shared_weights
+
+    if not ckpt:
+        torch.manual_seed(0)
+        ckpt = os.path.join(work_dir, 'random.pt')
+        torch.save({'model': DcaseNet_v3(1).state_dict()}, ckpt)
+    model = load_dcasenet(ckpt, 'cpu')
+    path = os.path.join(work_dir, 'shared.pt')
+    write_shared_weights(load_optimized(model, 'cpu'), path)
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Throughput of pinned worker processes against threads')
+    parser.add_argument('--ckpt', default=None)
+    parser.add_argument('--cores', type=int, nargs='*', default=[len(os.sched_getaffinity(0))])
+    parser.add_argument('--modes', nargs='*', default=['pinned', 'threads', 'unpinned'])
+    parser.add_argument('--length', type=float, default=10, help='Request length in seconds')
+    parser.add_argument('--seconds', type=float, default=10, help='Duration of every trial')
+    parser.add_argument('--startup-seconds', type=float, default=15, help='Time processes get to load the model')
+    parser.add_argument('--trial', metavar='PATH', help=argparse.SUPPRESS)
+    parser.add_argument('--threads', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--cpus', default='', help=argparse.SUPPRESS)
+    parser.add_argument('--start-at', type=float, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.trial:
+        run_trial(args.trial, args.threads, [int(core) for core in args.cpus.split(',') if core], args.length,
+                  args.start_at, args.seconds)
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory(dir='/dev/shm' if os.path.isdir('/dev/shm') else None) as work_dir:
+        path = prepare_weights(args.ckpt, work_dir)
+        print(f"{'mode':>8} {'cores':>5} {'processes':>9} {'passes/s':>9} {'per core':>8} {'PSS/process (MB)':>16} "
+              f"{'max diff':>9}")
+        reference = None
+        for cores in args.cores:
+            for mode in args.modes:
+                results = trial(path, mode, cores, args)
+                outputs = [np.array(result['output']) for result in results]
+                if reference is None:
+                    reference = outputs[0]
+                max_diff = max(float(np.abs(output - reference).max()) for output in outputs)
+                throughput = sum(result['passes'] for result in results) / args.seconds
+                print(f"{mode:>8} {cores:>5} {len(results):>9} {throughput:>9.1f} {throughput / cores:>8.1f} "
+                      f"{np.mean([result['pss_mb'] for result in results]):>16.0f} {max_diff:>9.2e}")
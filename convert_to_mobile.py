@@ -1,28 +1,15 @@
 import os
-import re
 import torch
 from torch.utils.mobile_optimizer import optimize_for_mobile, MobileOptimizerType
 
 from models.DcaseNet import DcaseNet_v3
-
-epoch_regex = re.compile(r'.*_(\d+)\.pth(\.tar)?')
+from models.checkpoints import load_checkpoints
 
 
 def save_no_quantization(model):
     torchscript_model = torch.jit.script(model)
     torchscript_model_optimized = optimize_for_mobile(torchscript_model, optimization_blocklist={MobileOptimizerType.INSERT_FOLD_PREPACK_OPS})
     torchscript_model_optimized._save_for_lite_interpreter("model-no-quantization.ptl")
-    
-def get_epoch(path):
-    matches = epoch_regex.match(path)
-    if matches is not None:
-        return int(matches.group(1))
-    return 0
-    
-def load_checkpoints(path):
-    checkpoints = list(filter(lambda p: epoch_regex.match(p), os.listdir(path)))
-    checkpoints.sort(key=get_epoch)
-    return checkpoints
 
 def load_and_evaluate_model():
     model = DcaseNet_v3(1)
@@ -1,15 +1,41 @@
 import os
 import logging
+import threading
 from typing import Dict, List, Optional, Any
 from models.task_models import Task, TaskUpdate, TaskStatus
-from supabase_client import supabase
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# 'supabase' in production, 'sqlite' for a local stand-in (see sqlite_client.py)
+TASK_DB_BACKEND = os.getenv("TASK_DB_BACKEND", "supabase").lower()
+
+def create_client():
+    if TASK_DB_BACKEND == "sqlite":
+        from sqlite_client import SqliteClient
+        return SqliteClient()
+    elif TASK_DB_BACKEND == "supabase":
+        from supabase_client import supabase
+        return supabase
+    raise ValueError(f"Task database backend can be 'supabase' or 'sqlite' only, '{TASK_DB_BACKEND}' given")
+
 class TaskDatabase:
-    def __init__(self):
-        self.supabase = supabase
-        logger.info("Task database initialized with Supabase")
+    def __init__(self, client=None):
+        # Created on first use: importing and connecting the client isn't paid for at import and startup
+        self._client = client
+        self._client_lock = threading.Lock()
+
+    @property
+    def supabase(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = create_client()
+                    logger.info(f"Task database initialized with {type(self._client).__name__}")
+        return self._client
         
     def create_task(self, task: Task) -> Task:
         """Create a new task in the database"""
@@ -106,6 +132,85 @@ class TaskDatabase:
             logger.error(f"Failed to list tasks: {str(e)}")
             raise
     
+    def list_tasks_by_status(self, statuses: List[TaskStatus]) -> List[Task]:
+        """List tasks with any of the given statuses, oldest first"""
+        try:
+            results = self.supabase.list_tasks_by_status([s.value for s in statuses])
+            tasks = []
+            
+            for task_data in results:
+                # Convert status string back to enum
+                if isinstance(task_data["status"], str):
+                    task_data["status"] = TaskStatus(task_data["status"])
+                
+                tasks.append(Task.parse_obj(task_data))
+            
+            return tasks
+        except Exception as e:
+            logger.error(f"Failed to list tasks by status: {str(e)}")
+            raise
+    
+    def find_completed_task(self, content_sha256: str, model_version: str, search_start_seconds: Optional[float] = None,
+                            search_end_seconds: Optional[float] = None) -> Optional[Task]:
+        """Latest completed task with the same video content, search window and model version, None if there is none"""
+        try:
+            result = self.supabase.find_completed_task(content_sha256, model_version,
+                                                       search_start_seconds, search_end_seconds)
+            if result:
+                # Convert status string back to enum
+                if isinstance(result["status"], str):
+                    result["status"] = TaskStatus(result["status"])
+                return Task.parse_obj(result)
+            return None
+        except Exception as e:
+            logger.error(f"Failed to find completed task for {content_sha256}: {str(e)}")
+            raise
+    
+    def claim_task(self, worker_id: str, lease_seconds: int, max_attempts: int) -> Optional[Task]:
+        """Lease the oldest PENDING (or lease-expired) task to worker_id, None if there is nothing to do"""
+        try:
+            result = self.supabase.claim_task(worker_id, lease_seconds, max_attempts)
+            if result:
+                # Convert status string back to enum
+                if isinstance(result["status"], str):
+                    result["status"] = TaskStatus(result["status"])
+                return Task.parse_obj(result)
+            return None
+        except Exception as e:
+            logger.error(f"Failed to claim task: {str(e)}")
+            raise
+    
+    def renew_lease(self, task_id: str, worker_id: str, lease_seconds: int) -> bool:
+        """Heartbeat of a leased task; False once the lease was lost to another worker"""
+        try:
+            return self.supabase.renew_task_lease(task_id, worker_id, lease_seconds)
+        except Exception as e:
+            logger.error(f"Failed to renew lease of task {task_id}: {str(e)}")
+            raise
+    
+    def update_leased_task(self, task_id: str, worker_id: str, update_data: TaskUpdate) -> Optional[Task]:
+        """Update a task only if worker_id still holds its lease, None otherwise"""
+        try:
+            # Convert update data to dict, excluding unset values
+            update_dict = update_data.dict(exclude_unset=True)
+            
+            # If status is set, convert enum to string
+            if "status" in update_dict and update_dict["status"]:
+                update_dict["status"] = update_dict["status"].value
+            
+            result = self.supabase.update_leased_task(task_id, worker_id, update_dict)
+            
+            if result:
+                # Convert status string back to enum for our model
+                if isinstance(result["status"], str):
+                    result["status"] = TaskStatus(result["status"])
+                return Task.parse_obj(result)
+            
+            return None
+        except Exception as e:
+            logger.error(f"Failed to update leased task {task_id}: {str(e)}")
+            raise
+    
     def upload_video(self, file_path: str, file_name: str) -> str:
         """Upload a video to Supabase Storage and return the URL"""
         try:
@@ -1,15 +1,26 @@
 import os
 import json
+import itertools
+import subprocess
 from collections import defaultdict
 
 import librosa
 import numpy as np
-import pandas as pd
 import soundfile
 
+try:
+    import av
+except ImportError:
+    av = None
+
 from dataset.spectogram import spectogram_configs as cfg
 
 
+class NoAudioInRangeError(ValueError):
+    """A clip has no audio after the start of the range asked for, e.g. a search window past its end"""
+    pass
+
+
 def get_film_clap_paths_and_labels(data_root, time_margin=0.1):
     """
     Parses the Film_clap raw data and collect audio file paths , start_times and end_times of claps
@@ -43,6 +54,9 @@ def get_tau_sed_paths_and_labels(audio_dir, labels_data_dir):
     """
     Parses the Tau_sed raw data and collect audio file paths, start_times and end_times of claps
     """
+    # Imported here since only dataset preparation reads the labels, pandas would slow down the server's startup
+    import pandas as pd
+
     results = []
     for audio_fname in os.listdir(audio_dir):
         if not audio_fname.endswith('.wav'):
@@ -62,40 +76,226 @@ def get_tau_sed_paths_and_labels(audio_dir, labels_data_dir):
     return results
 
 
-def read_multichannel_audio(audio_path, target_fs=None):
+def fit_audio_channels(multichannel_audio):
     """
-    Read the audio samples in files and resample them to fit the desired sample ratre
+    Mix, duplicate or drop channels of (samples, channels) audio to get cfg.audio_channels channels.
+    Duplicated channels are a read-only broadcast view of a single channel, not a copy.
     """
-    (multichannel_audio, sample_rate) = soundfile.read(audio_path)
     if len(multichannel_audio.shape) == 1:
         multichannel_audio = multichannel_audio.reshape(-1, 1)
     if multichannel_audio.shape[1] < cfg.audio_channels:
-        multichannel_audio = np.repeat(multichannel_audio.mean(1).reshape(-1, 1), cfg.audio_channels, axis=1)
+        multichannel_audio = np.broadcast_to(multichannel_audio.mean(1).reshape(-1, 1),
+                                             (multichannel_audio.shape[0], cfg.audio_channels))
     elif cfg.audio_channels == 1:
         multichannel_audio = multichannel_audio.mean(1).reshape(-1, 1)
     elif multichannel_audio.shape[1] > cfg.audio_channels:
         multichannel_audio = multichannel_audio[:, :cfg.audio_channels]
+    return multichannel_audio
 
-    if target_fs is not None and sample_rate != target_fs:
 
-        channels_num = multichannel_audio.shape[1]
+def has_duplicate_channels(multichannel_audio):
+    """
+    True when all channels of (samples, channels) audio carry the same signal, e.g. a mono source
+    duplicated by fit_audio_channels or a stereo file recorded with one microphone
+    """
+    if multichannel_audio.shape[1] < 2:
+        return False
+    if multichannel_audio.strides[1] == 0:
+        return True
+    first = multichannel_audio[:, 0]
+    return all(np.array_equal(first, multichannel_audio[:, c]) for c in range(1, multichannel_audio.shape[1]))
 
-        multichannel_audio = np.array(
-            [librosa.resample(multichannel_audio[:, i], orig_sr=sample_rate, target_sr=target_fs) for i in range(channels_num)]
-        ).T
-        
+
+def pad_to_fft_size(multichannel_audio):
     if multichannel_audio.shape[0] < cfg.NFFT:
         pad_length = cfg.NFFT - multichannel_audio.shape[0]
         multichannel_audio = np.pad(multichannel_audio, ((0, pad_length), (0, 0)), 'constant')
-
     return multichannel_audio
 
 
-def read_audio_from_video(video_path):
-    audio_path = f"{os.path.splitext(video_path)[0]}.wav"
-    temp_dir = "/Users/ivkin/tmp/audio-cache"
-    audio_path = os.path.join(temp_dir, os.path.basename(audio_path))
-    if not os.path.exists(audio_path):
-        os.system(f"ffmpeg -i {video_path} -vn -ac 1 -ar {cfg.working_sample_rate} -f wav {audio_path}")
+def read_multichannel_audio(audio_path, target_fs=None, start=0.0, end=None):
+    """
+    Read the audio samples in files, or their [start, end] seconds, and resample them to fit the desired sample ratre
+    """
+    if start or end is not None:
+        # Only the frames of the window are read
+        file_rate = soundfile.info(audio_path).samplerate
+        (multichannel_audio, sample_rate) = soundfile.read(audio_path, start=round(start * file_rate),
+                                                           stop=None if end is None else round(end * file_rate))
+    else:
+        (multichannel_audio, sample_rate) = soundfile.read(audio_path)
+    multichannel_audio = fit_audio_channels(multichannel_audio)
+
+    if target_fs is not None and sample_rate != target_fs:
+
+        channels_num = multichannel_audio.shape[1]
+
+        if has_duplicate_channels(multichannel_audio):
+            # Resample the signal once and keep the duplicated channels a view
+            resampled = librosa.resample(np.ascontiguousarray(multichannel_audio[:, 0]), orig_sr=sample_rate, target_sr=target_fs)
+            multichannel_audio = np.broadcast_to(resampled.reshape(-1, 1), (resampled.shape[0], channels_num))
+        else:
+            multichannel_audio = np.array(
+                [librosa.resample(multichannel_audio[:, i], orig_sr=sample_rate, target_sr=target_fs) for i in range(channels_num)]
+            ).T
+        
+    return pad_to_fft_size(multichannel_audio)
+
+
+# Audio decoded before the start of a search window and dropped, so its first samples equal those of a full decode
+SEEK_PREROLL_SECONDS = 0.1
+
+
+def trim_blocks(blocks, skip, samples):
+    """
+    Blocks of a stream of sample blocks without its first skip samples, cut after samples samples (None for all).
+    Stops consuming blocks once samples samples were yielded.
+    """
+    for block in blocks:
+        if skip >= block.shape[0]:
+            skip -= block.shape[0]
+            continue
+        block = block[skip:]
+        skip = 0
+        if samples is not None:
+            block = block[:samples]
+            samples -= block.shape[0]
+        if block.shape[0]:
+            yield block
+        if samples == 0:
+            return
+
+
+def stream_audio_pyav(video_path, sample_rate=cfg.working_sample_rate, block_samples=None, start=0.0, end=None):
+    """
+    Decode only the audio stream of a video (or audio file) in-process, resampled to sample_rate and downmixed to mono
+    by averaging the channels (as the WAV files the models were trained on).
+    Yields float32 blocks of shape (block_samples,), one second by default; the last block may be shorter.
+    Only one block is held in memory at a time.
+    start, end: seconds of the audio to decode; the demuxer seeks to start and decoding stops at end
+    """
+    block_samples = block_samples or sample_rate
+    container = av.open(video_path)
+    try:
+        if not container.streams.audio:
+            raise ValueError(f"No audio stream in {video_path}")
+        stream = container.streams.audio[0]
+        stream.thread_type = 'AUTO'
+        # Planar output in block sized frames: converting each small decoded frame to NumPy dominates the decoding time.
+        # The channel layout is kept, libswresample's float downmix would scale mono by 1/sqrt(2) per channel instead of 1/2.
+        resampler = av.AudioResampler(format='fltp', rate=sample_rate, frame_size=block_samples)
+        stream_start = float(stream.start_time * stream.time_base) if stream.start_time is not None else 0.0
+        first_frame_time = []
+        if start > 0:
+            # Lands on the packet at or before start, a little earlier so the decoder's overlap and the resampler's
+            # filter are warmed up at start; the samples before start are dropped below
+            container.seek(int((stream_start + max(0.0, start - SEEK_PREROLL_SECONDS)) / stream.time_base), stream=stream)
+
+        def decode():
+            # Demuxing the audio stream alone skips decoding the video packets
+            for frame in container.decode(stream):
+                if not first_frame_time:
+                    first_frame_time.append(frame.time - stream_start if frame.time is not None else 0.0)
+                for resampled in resampler.resample(frame):
+                    yield resampled.to_ndarray().mean(0)
+            # Flush samples buffered in the resampler
+            for resampled in resampler.resample(None):
+                yield resampled.to_ndarray().mean(0)
+
+        blocks = decode()
+        skip = 0
+        if start > 0:
+            # The first frame after the seek tells how many samples precede start
+            first = next(blocks, None)
+            if first is None:
+                raise NoAudioInRangeError(f"No audio after {start}s in {video_path}")
+            skip = max(0, round((start - first_frame_time[0]) * sample_rate))
+            blocks = itertools.chain([first], blocks)
+        samples = None if end is None else round((end - start) * sample_rate)
+        decoded = 0
+        for block in trim_blocks(blocks, skip, samples):
+            decoded += block.shape[0]
+            yield block
+        if start > 0 and not decoded:
+            raise NoAudioInRangeError(f"No audio after {start}s in {video_path}")
+    finally:
+        container.close()
+
 
-    return read_multichannel_audio(audio_path)
\ No newline at end of file
+def decode_audio_pyav(video_path, sample_rate=cfg.working_sample_rate, start=0.0, end=None):
+    """
+    All the audio of a video, or its [start, end] seconds, decoded with stream_audio_pyav as float32 samples (samples,)
+    """
+    blocks = list(stream_audio_pyav(video_path, sample_rate, start=start, end=end))
+    if not blocks:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(blocks)
+
+
+def ffmpeg_audio_command(video_path, sample_rate, start=0.0, end=None):
+    # Input seeking, accurate to the sample when decoding
+    seek = ['-ss', f"{start:.6f}"] if start > 0 else []
+    duration = ['-t', f"{end - start:.6f}"] if end is not None else []
+    # rematrix_maxval 1 makes the float downmix average the channels, like the WAV (integer) output used to
+    return (['ffmpeg', '-nostdin', '-loglevel', 'error'] + seek + ['-i', video_path] + duration +
+            ['-vn', '-ac', '1', '-rematrix_maxval', '1.0', '-ar', str(sample_rate), '-f', 'f32le', '-'])
+
+
+def stream_audio_ffmpeg(video_path, sample_rate=cfg.working_sample_rate, block_samples=None, start=0.0, end=None):
+    """
+    Decode the audio stream of a video with the ffmpeg CLI into a pipe, yielding raw mono float32 blocks
+    at sample_rate as stream_audio_pyav does. Fallback for when PyAV is not installed.
+    """
+    block_bytes = (block_samples or sample_rate) * 4
+    process = subprocess.Popen(ffmpeg_audio_command(video_path, sample_rate, start, end),
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        decoded = 0
+        while True:
+            data = process.stdout.read(block_bytes)
+            if not data:
+                break
+            decoded += len(data)
+            yield np.frombuffer(data, dtype=np.float32)
+        stderr = process.stderr.read()
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to decode {video_path}: {stderr.decode(errors='replace').strip()}")
+        if start > 0 and not decoded:
+            raise NoAudioInRangeError(f"No audio after {start}s in {video_path}")
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+def decode_audio_ffmpeg(video_path, sample_rate=cfg.working_sample_rate, start=0.0, end=None):
+    """
+    Decode the audio stream of a video with the ffmpeg CLI into a pipe, as raw mono float32 at sample_rate.
+    Fallback for when PyAV is not installed.
+    """
+    result = subprocess.run(ffmpeg_audio_command(video_path, sample_rate, start, end),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to decode {video_path}: {result.stderr.decode(errors='replace').strip()}")
+    return np.frombuffer(result.stdout, dtype=np.float32)
+
+
+def stream_audio(video_path, block_samples=None, start=0.0, end=None):
+    """
+    Mono float32 blocks of the audio of a video or an audio file at cfg.working_sample_rate,
+    with memory independent of its duration. start, end: seconds of the audio to decode, end None for all of it
+    """
+    stream = stream_audio_pyav if av is not None else stream_audio_ffmpeg
+    return stream(video_path, cfg.working_sample_rate, block_samples, start, end)
+
+
+def read_audio_from_video(video_path, start=0.0, end=None):
+    """
+    Decode the audio of a video straight to float32 samples (samples, cfg.audio_channels) at cfg.working_sample_rate,
+    without intermediate files. start, end: seconds of the audio to decode, end None for all of it
+    """
+    decode = decode_audio_pyav if av is not None else decode_audio_ffmpeg
+    audio = decode(video_path, cfg.working_sample_rate, start, end)
+    if start > 0 and not audio.shape[0]:
+        raise NoAudioInRangeError(f"No audio after {start}s in {video_path}")
+    return pad_to_fft_size(fit_audio_channels(audio))
@@ -0,0 +1,52 @@
+import os
+import logging
+import functools
+
+import numpy as np
+
+import dataset.spectogram.spectogram_configs as cfg
+
+logger = logging.getLogger(__name__)
+
+# Mel filter bank of the log-mel front-end, written by `python -m dataset.spectogram.mel_basis`. Computing it imports
+# librosa's filters (scipy.signal and numba), which takes longer than the rest of the front-end's imports together.
+MEL_BASIS_PATH = os.environ.get("MEL_BASIS_PATH", os.path.join(os.path.dirname(__file__), "mel_basis.npz"))
+
+
+def mel_config():
+    return np.array([cfg.working_sample_rate, cfg.NFFT, cfg.mel_bins, cfg.mel_min_freq, cfg.mel_max_freq])
+
+
+def compute_mel_basis():
+    import librosa
+    return librosa.filters.mel(
+        sr=cfg.working_sample_rate,
+        n_fft=cfg.NFFT,
+        n_mels=cfg.mel_bins,
+        fmin=cfg.mel_min_freq,
+        fmax=cfg.mel_max_freq).T
+
+
+@functools.lru_cache(maxsize=None)
+def load_mel_basis():
+    """
+    (NFFT // 2 + 1, mel_bins) float32 mel filter bank, from MEL_BASIS_PATH when it was written for the current
+    configuration, computed otherwise
+    """
+    try:
+        with np.load(MEL_BASIS_PATH) as saved:
+            if np.array_equal(saved['config'], mel_config()):
+                return saved['mel_basis']
+        logger.warning(f"Mel basis {MEL_BASIS_PATH} was computed for another configuration, computing it again")
+    except FileNotFoundError:
+        logger.info(f"No precomputed mel basis at {MEL_BASIS_PATH}, computing it")
+    return compute_mel_basis()
+
+
+def save_mel_basis(path=MEL_BASIS_PATH):
+    np.savez(path, mel_basis=compute_mel_basis(), config=mel_config())
+
+
+if __name__ == '__main__':
+    save_mel_basis()
+    print(f"Mel basis written to {MEL_BASIS_PATH}")
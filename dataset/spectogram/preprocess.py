@@ -7,15 +7,10 @@ import soundfile
 from tqdm import tqdm
 
 import dataset.spectogram.spectogram_configs as cfg
-from dataset.dataset_utils import read_multichannel_audio
-from utils.plot_utils import plot_sample_features
-
-MEL_FILTER_BANK_MATRIX = librosa.filters.mel(
-    sr=cfg.working_sample_rate,
-    n_fft=cfg.NFFT,
-    n_mels=cfg.mel_bins,
-    fmin=cfg.mel_min_freq,
-    fmax=cfg.mel_max_freq).T
+from dataset.dataset_utils import read_multichannel_audio, read_audio_from_video, stream_audio
+from dataset.spectogram import torch_frontend
+from dataset.spectogram.mel_basis import load_mel_basis
+from utils.feature_cache import AUDIO, LOG_MEL, feature_cache, file_sha256
 
 
 def multichannel_stft(multichannel_signal):
@@ -38,13 +33,39 @@ def multichannel_stft(multichannel_signal):
 
 def multichannel_complex_to_log_mel(multichannel_complex_spectogram):
     multichannel_power_spectogram = np.abs(multichannel_complex_spectogram) ** 2
-    multichannel_mel_spectogram = np.dot(multichannel_power_spectogram, MEL_FILTER_BANK_MATRIX)
+    multichannel_mel_spectogram = np.dot(multichannel_power_spectogram, load_mel_basis())
     multichannel_logmel_spectogram = librosa.core.power_to_db(multichannel_mel_spectogram,
                                                               ref=1.0, amin=1e-10, top_db=None).astype(np.float32)
 
     return multichannel_logmel_spectogram
 
 
+def extract_log_mel_from_video(video_path, start=0.0, end=None):
+    """
+    Decode the audio track of a video, or its [start, end] seconds, and compute its log-mel features
+    (channels, frames, mel_bins).
+    Compact: a single channel when all channels are the same (a mono source), see torch_frontend.expand_channels.
+    Kept at module level so it can be shipped to a process pool.
+    """
+    return torch_frontend.log_mel(read_audio_from_video(video_path, start, end), compact=True)
+
+
+def warm_up_log_mel():
+    """
+    Log-mel features of a second of silence: imports and initializes the front-end in a process of a process pool
+    before a request needs it. Kept at module level so it can be shipped to a process pool.
+    """
+    torch_frontend.log_mel(np.zeros((cfg.working_sample_rate, cfg.audio_channels), dtype=np.float32), compact=True)
+
+
+def stream_log_mel_from_video(video_path, block_seconds=5, start=0.0, end=None):
+    """
+    Compact single channel log-mel features of a video, as extract_log_mel_from_video, yielded in blocks of about
+    block_seconds while the audio is decoded. Memory doesn't depend on the video's duration.
+    """
+    return torch_frontend.stream_log_mel(stream_audio(video_path, int(block_seconds * cfg.working_sample_rate), start, end))
+
+
 def calculate_scalar_of_tensor(x):
     if x.ndim == 2:
         axis = 0
@@ -64,10 +85,14 @@ def preprocess_data(audio_path_and_labels, output_dir, output_mean_std_file, pre
     all_features = []
 
     for (audio_path, start_times, end_times, audio_name) in tqdm(audio_path_and_labels):
-        multichannel_waveform = read_multichannel_audio(audio_path=audio_path, target_fs=cfg.working_sample_rate)
-        feature = multichannel_stft(multichannel_waveform)
+        content_sha256 = file_sha256(audio_path)
+        read_waveform = lambda: read_multichannel_audio(audio_path=audio_path, target_fs=cfg.working_sample_rate)
         if preprocess_mode == 'logMel':
-            feature = multichannel_complex_to_log_mel(feature)
+            # Cached compact, mono sources take one channel in the cache
+            feature = torch_frontend.expand_channels(feature_cache.get_or_compute(
+                LOG_MEL, content_sha256, lambda: torch_frontend.log_mel(read_waveform(), compact=True)))
+        else:
+            feature = multichannel_stft(feature_cache.get_or_compute(AUDIO, content_sha256, read_waveform))
         all_features.append(feature)
 
         output_path = os.path.join(output_dir, audio_name + f"_{preprocess_mode}_features_and_labels.pkl")
@@ -91,6 +116,7 @@ def analyze_data_sample(audio_path, start_times, end_times, audio_name, plot_pat
     A debug function that plots a single sample and analyzes how the spectogram configuration affect the feature final size
     """
     from dataset.spectogram.spectograms_dataset import create_event_matrix
+    from utils.plot_utils import plot_sample_features
     org_multichannel_audio, org_sample_rate = soundfile.read(audio_path)
 
     multichannel_audio = read_multichannel_audio(audio_path=audio_path, target_fs=cfg.working_sample_rate)
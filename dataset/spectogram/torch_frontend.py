@@ -0,0 +1,179 @@
+import functools
+
+import numpy as np
+import torch
+
+import dataset.spectogram.spectogram_configs as cfg
+from dataset.dataset_utils import has_duplicate_channels
+from dataset.spectogram.mel_basis import load_mel_basis
+
+# Frames (over all clips and channels) transformed per step
+CHUNK_FRAME_ROWS = 2048
+
+
+@functools.lru_cache(maxsize=None)
+def stft_window(device='cpu'):
+    """np.hanning(cfg.frame_size) zero-padded to cfg.NFFT on both sides, as librosa pads it"""
+    window = torch.from_numpy(np.hanning(cfg.frame_size)).to(torch.float32)
+    left = (cfg.NFFT - cfg.frame_size) // 2
+    return torch.nn.functional.pad(window, (left, cfg.NFFT - cfg.frame_size - left)).to(device)
+
+
+@functools.lru_cache(maxsize=None)
+def mel_basis(device='cpu'):
+    """(NFFT // 2 + 1, mel_bins), the filter bank of preprocess.multichannel_complex_to_log_mel"""
+    return torch.from_numpy(load_mel_basis()).to(torch.float32).to(device)
+
+
+def num_frames(num_samples):
+    return 1 + num_samples // cfg.hop_size
+
+
+def padded_log_mel(signals, device='cpu'):
+    """
+    Log-mel features (signals, frames, mel_bins) of all the full frames of already padded (signals, samples) signals
+    """
+    # Frames as a strided view (signals, frames, NFFT)
+    frames = signals.unfold(-1, cfg.NFFT, cfg.hop_size)
+    log_mel = torch.empty(frames.shape[0], frames.shape[1], cfg.mel_bins, device=device)
+    # A few thousand frames at a time keep the complex spectrogram in cache instead of materializing it whole
+    chunk_frames = max(1, CHUNK_FRAME_ROWS // max(1, frames.shape[0]))
+    with torch.no_grad():
+        for start in range(0, frames.shape[1], chunk_frames):
+            spectogram = torch.fft.rfft(frames[:, start:start + chunk_frames] * stft_window(device))
+            power = spectogram.real ** 2 + spectogram.imag ** 2
+            # librosa.power_to_db with ref=1.0, amin=1e-10, top_db=None
+            log_mel[:, start:start + chunk_frames] = 10.0 * torch.log10(
+                torch.clamp(torch.matmul(power, mel_basis(device)), min=1e-10))
+    return log_mel
+
+
+def batch_log_mel(waveforms, device='cpu', compact=False):
+    """
+    Log-mel features of a batch of clips in one vectorized pass over all clips and channels.
+    Equivalent to multichannel_complex_to_log_mel(multichannel_stft(waveform)) for each clip.
+    Channels carrying the same signal (a mono source duplicated to cfg.audio_channels) are transformed once.
+    Args:
+        waveforms: list of (samples, channels) arrays, lengths may differ
+        compact: return features of clips with duplicated channels as a single channel, to be
+            broadcast at the model input with expand_channels
+    Returns:
+        list of float32 (channels, frames, mel_bins) arrays; the channels of a clip with duplicated
+        channels are a read-only broadcast view, or a single channel when compact
+    """
+    padding = cfg.NFFT // 2
+    channels = [np.asarray(waveform).shape[1] for waveform in waveforms]
+    distinct = [1 if has_duplicate_channels(np.asarray(waveform)) else channels_num
+                for waveform, channels_num in zip(waveforms, channels)]
+    # Reflect padding per clip (librosa's center=True) before zero padding to the longest clip,
+    # so the frames of shorter clips don't depend on the batch
+    signals = [torch.nn.functional.pad(torch.from_numpy(np.array(np.asarray(waveform)[:, :distinct_num].T,
+                                                                 dtype=np.float32, order='C'))[None],
+                                       (padding, padding), mode='reflect')[0]
+               for waveform, distinct_num in zip(waveforms, distinct)]
+    lengths = [np.asarray(waveform).shape[0] for waveform in waveforms]
+    batch = torch.zeros(sum(distinct), max(signal.shape[1] for signal in signals))
+    row = 0
+    for signal in signals:
+        batch[row:row + signal.shape[0], :signal.shape[1]] = signal
+        row += signal.shape[0]
+    batch = batch.to(device)
+
+    # center=False since the clips are padded already
+    log_mel = padded_log_mel(batch, device).cpu().numpy()
+
+    features = []
+    row = 0
+    for length, channels_num, distinct_num in zip(lengths, channels, distinct):
+        clip_features = log_mel[row:row + distinct_num, :num_frames(length)]
+        row += distinct_num
+        features.append(clip_features if compact else expand_channels(clip_features, channels_num))
+    return features
+
+
+def log_mel(waveform, device='cpu', compact=False):
+    """(samples, channels) waveform -> float32 (channels, frames, mel_bins) log-mel features, see batch_log_mel"""
+    return batch_log_mel([waveform], device, compact)[0]
+
+
+class StreamingLogMel:
+    """
+    Log-mel features of a signal fed in blocks of any size, equal to log_mel of the whole signal after
+    pad_to_fft_size. Only the samples of the frames not emitted yet are kept, so memory doesn't depend on
+    the signal's length.
+        log_mel = StreamingLogMel()
+        for samples in blocks:
+            yield log_mel.push(samples)
+        yield log_mel.finish()
+    Blocks are (samples,) or (samples, channels) arrays; the features are float32 (channels, frames, mel_bins),
+    a single channel for (samples,) blocks.
+    """
+    def __init__(self, device='cpu'):
+        self.device = device
+        self.samples = 0
+        self._buffer = None      # padded signal (channels, samples) from the start of the next frame
+        self._started = False    # the reflect padding of the start is in the buffer
+
+    def push(self, samples) -> np.ndarray:
+        """Features of the frames completed by samples, possibly none"""
+        samples = np.asarray(samples, dtype=np.float32)
+        samples = samples.reshape(-1, 1) if samples.ndim == 1 else samples
+        self.samples += samples.shape[0]
+        block = samples.T
+        self._buffer = block if self._buffer is None else np.concatenate([self._buffer, block], axis=1)
+
+        padding = cfg.NFFT // 2
+        if not self._started:
+            # Reflect padding (librosa's center=True) needs the first padding + 1 samples
+            if self._buffer.shape[1] <= padding:
+                return self._empty()
+            self._buffer = np.concatenate([self._buffer[:, padding:0:-1], self._buffer], axis=1)
+            self._started = True
+        return self._emit()
+
+    def finish(self) -> np.ndarray:
+        """Features of the remaining frames, after the reflect padding of the end"""
+        features = []
+        if self.samples < cfg.NFFT:
+            # As pad_to_fft_size
+            channels = 1 if self._buffer is None else self._buffer.shape[0]
+            features.append(self.push(np.zeros((cfg.NFFT - self.samples, channels), dtype=np.float32)))
+        padding = cfg.NFFT // 2
+        self._buffer = np.concatenate([self._buffer, self._buffer[:, -2:-padding - 2:-1]], axis=1)
+        features.append(self._emit())
+        return np.concatenate(features, axis=1)
+
+    def _emit(self):
+        frames = (self._buffer.shape[1] - cfg.NFFT) // cfg.hop_size + 1
+        if frames <= 0:
+            return self._empty()
+        signals = torch.from_numpy(np.ascontiguousarray(self._buffer[:, :(frames - 1) * cfg.hop_size + cfg.NFFT]))
+        features = padded_log_mel(signals.to(self.device), self.device).cpu().numpy()
+        self._buffer = self._buffer[:, frames * cfg.hop_size:]
+        return features
+
+    def _empty(self):
+        return np.zeros((self._buffer.shape[0], 0, cfg.mel_bins), dtype=np.float32)
+
+
+def stream_log_mel(sample_blocks, device='cpu'):
+    """Yields log-mel feature blocks (channels, frames, mel_bins) of a stream of sample blocks, see StreamingLogMel"""
+    streaming = StreamingLogMel(device)
+    for samples in sample_blocks:
+        features = streaming.push(samples)
+        if features.shape[1]:
+            yield features
+    features = streaming.finish()
+    if features.shape[1]:
+        yield features
+
+
+def expand_channels(features, channels=cfg.audio_channels):
+    """
+    Broadcast compact single channel (1, frames, mel_bins) features, an array or a tensor, to all channels without copying
+    """
+    if features.shape[0] == channels:
+        return features
+    if isinstance(features, torch.Tensor):
+        return features.expand(channels, *features.shape[1:])
+    return np.broadcast_to(features, (channels,) + features.shape[1:])
@@ -9,10 +9,9 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import torch
-from dataset.dataset_utils import read_multichannel_audio
-from dataset.spectogram.preprocess import multichannel_complex_to_log_mel, multichannel_stft
 import dataset.spectogram.spectogram_configs as cfg
 from models.DcaseNet import DcaseNet_v3
+from pipeline import Stage, detection_pipeline
 import tkinter as tk
 from tkinter import ttk
 import sounddevice as sd
@@ -140,8 +139,12 @@ class LoudIntervalSelector:
         self.window.mainloop()
 
 
+# Impacts are searched for in the first seconds of a recording only
+MAX_SEARCH_SECONDS = 8.0
+
+
 def find_loud_intervals(file_path, output, detected=[], visualise=False, selector=None):
-    max_time = 8.0
+    max_time = MAX_SEARCH_SECONDS
     y, sr = librosa.load(file_path, sr=None, duration=max_time)
     hop_length = int(sr * 0.02)
     frame_length = int(sr * 0.05)
@@ -190,17 +193,16 @@ def find_loud_intervals(file_path, output, detected=[], visualise=False, selecto
 
     return loudest_interval
 
-def detect_impact_regions(model, audio_file):
-    multichannel_audio = read_multichannel_audio(audio_path=audio_file, target_fs=cfg.working_sample_rate)
-    log_mel_features = multichannel_complex_to_log_mel(multichannel_stft(multichannel_audio))
-    
-    with torch.no_grad():
-        input = torch.from_numpy(log_mel_features).to(torch.float32).to('cpu')
-        output_event = model(input.unsqueeze(0))
-    output_event = output_event.cpu()
+def detect_impact_regions(model, audio_file, max_time=MAX_SEARCH_SECONDS, trace=None):
+    # Only the searched seconds are read
+    pipeline = detection_pipeline(model, 'cpu', 0.0, max_time).replace('impact', Stage('regions', impact_regions))
+    return pipeline.run(audio_file, trace)
+
+def impact_regions(output_event):
+    """Merged (start, end) seconds of the frames of a model output above the threshold"""
     time_intervals = []
     step = cfg.frame_size - cfg.hop_size
-    for i, frame_value in enumerate(output_event[0]):
+    for i, frame_value in enumerate(output_event):
         if frame_value > 0.3:
             start_time = i * step / cfg.working_sample_rate
             end_time = start_time + cfg.frame_size / cfg.working_sample_rate
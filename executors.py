@@ -0,0 +1,105 @@
+import os
+import asyncio
+import logging
+import functools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def available_cores():
+    """Cores this process may run on: those of its CPU affinity (which serve.py sets), all of them where unknown"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+# Network and database calls: mostly waiting, so many threads are cheap
+IO_WORKERS = int(os.environ.get("IO_EXECUTOR_WORKERS", 16))
+# Audio decoding and log-mel extraction: 'process' sidesteps the GIL, 'thread' avoids pickling the results
+CPU_EXECUTOR = os.environ.get("CPU_EXECUTOR", "process").lower()
+CPU_WORKERS = int(os.environ.get("CPU_EXECUTOR_WORKERS", max(1, available_cores() // 2)))
+# Model forward passes: torch already parallelizes a single pass over its own intra-op threads
+MODEL_WORKERS = int(os.environ.get("MODEL_EXECUTOR_WORKERS", 1))
+# Live detection steps: small and latency bound, so they don't queue behind batched forward passes
+LIVE_WORKERS = int(os.environ.get("LIVE_EXECUTOR_WORKERS", 2))
+
+
+def _init_cpu_process():
+    # The pool already runs one STFT per process; torch threads per process would oversubscribe the cores
+    import torch
+    torch.set_num_threads(1)
+
+
+class PipelineExecutors:
+    """
+    Runs the blocking stages of the detection pipeline outside of the asyncio event loop:
+        - io: downloads, storage uploads and Supabase calls (thread pool)
+        - cpu: ffmpeg decoding, resampling and STFT (process or thread pool)
+        - model: DcaseNet_v3 forward passes (thread pool, torch releases the GIL)
+        - live: front-end and model steps of live detection sessions (thread pool)
+    """
+    def __init__(self, io_workers=IO_WORKERS, cpu_workers=CPU_WORKERS, cpu_executor=CPU_EXECUTOR,
+                 model_workers=MODEL_WORKERS, live_workers=LIVE_WORKERS):
+        if cpu_executor not in ['process', 'thread']:
+            raise ValueError(f"CPU executor can be 'process' or 'thread' only, '{cpu_executor}' given")
+        self.io_workers = io_workers
+        self.cpu_workers = cpu_workers
+        self.cpu_executor_kind = cpu_executor
+        self.model_workers = model_workers
+        self.live_workers = live_workers
+        self.io_executor = None
+        self.cpu_executor = None
+        self.model_executor = None
+        self.live_executor = None
+
+    def start(self):
+        self.io_executor = ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix="io")
+        if self.cpu_executor_kind == 'process':
+            # 'spawn' since forking a process that already runs torch/OpenMP threads can deadlock the child
+            self.cpu_executor = ProcessPoolExecutor(max_workers=self.cpu_workers,
+                                                    mp_context=multiprocessing.get_context('spawn'),
+                                                    initializer=_init_cpu_process)
+        else:
+            self.cpu_executor = ThreadPoolExecutor(max_workers=self.cpu_workers, thread_name_prefix="cpu")
+        self.model_executor = ThreadPoolExecutor(max_workers=self.model_workers, thread_name_prefix="model")
+        self.live_executor = ThreadPoolExecutor(max_workers=self.live_workers, thread_name_prefix="live")
+        logger.info(f"Executors started: io={self.io_workers} threads, "
+                    f"cpu={self.cpu_workers} {self.cpu_executor_kind}es, model={self.model_workers} threads, "
+                    f"live={self.live_workers} threads")
+
+    def shutdown(self):
+        for executor in [self.io_executor, self.cpu_executor, self.model_executor, self.live_executor]:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+        logger.info("Executors shut down")
+
+    async def run_io(self, fn, *args, **kwargs):
+        return await self._run(self.io_executor, fn, *args, **kwargs)
+
+    async def run_cpu(self, fn, *args, **kwargs):
+        """fn and its arguments must be picklable when the cpu executor is a process pool"""
+        return await self._run(self.cpu_executor, fn, *args, **kwargs)
+
+    async def warm_up_cpu(self, fn):
+        """
+        Run fn once per cpu worker, which starts the processes of a process pool (they are started by the tasks
+        submitted to them otherwise, i.e. by the first requests)
+        """
+        try:
+            await asyncio.gather(*[self.run_cpu(fn) for _ in range(self.cpu_workers)])
+            logger.info(f"Warmed up {self.cpu_workers} cpu workers")
+        except Exception as e:
+            logger.warning(f"Warming up the cpu workers failed: {str(e)}")
+
+    async def run_model(self, fn, *args, **kwargs):
+        return await self._run(self.model_executor, fn, *args, **kwargs)
+
+    async def run_live(self, fn, *args, **kwargs):
+        return await self._run(self.live_executor, fn, *args, **kwargs)
+
+    async def _run(self, executor, fn, *args, **kwargs):
+        if executor is None:
+            raise RuntimeError("Executors are not started")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
@@ -0,0 +1,28 @@
+import os
+import sys
+import argparse
+
+import torch
+
+from models.checkpoints import (checkpoint_version, inference_checkpoint_path, load_checkpoint, load_dcasenet,
+                                save_inference_checkpoint)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write the weights of a training checkpoint to an inference checkpoint '
+                                                 '(no optimizer state, memory-mapped when loaded) for MODEL_CHECKPOINT')
+    parser.add_argument('--ckpt', type=str, required=True)
+    parser.add_argument('--output', default=None, help='<checkpoint>-inference.pt by default')
+    args = parser.parse_args()
+
+    model = load_dcasenet(args.ckpt, 'cpu')
+    output_path = args.output or inference_checkpoint_path(args.ckpt)
+    save_inference_checkpoint(model, output_path, checkpoint_version(args.ckpt))
+
+    # Same tensors as the checkpoint it was written from
+    (expected, written) = (load_checkpoint(args.ckpt)['model'], load_checkpoint(output_path)['model'])
+    if expected.keys() != written.keys() or not all(torch.equal(expected[key], written[key]) for key in expected):
+        print(f"{output_path} differs from {args.ckpt}")
+        sys.exit(1)
+    print(f"Wrote {output_path} ({os.path.getsize(output_path) / 1e6:.1f} MB, {args.ckpt} is "
+          f"{os.path.getsize(args.ckpt) / 1e6:.1f} MB) of version {checkpoint_version(output_path)}")
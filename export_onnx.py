@@ -0,0 +1,48 @@
+import sys
+import argparse
+
+import torch
+
+from models.checkpoints import checkpoint_version, load_dcasenet
+from models.onnx_models import OnnxModel, export_onnx, onnx_parity, onnx_path
+from models.spectogram_models import DEFAULT_CHANNEL_AND_POOL, Cnn_AvgPooling
+
+
+def load_cnn(checkpoint_path, model_config):
+    model = Cnn_AvgPooling(1, model_config=model_config)
+    model.load_state_dict(torch.load(checkpoint_path, map_location='cpu')['model'])
+    return model.eval()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a checkpoint to ONNX for INFERENCE_BACKEND=onnx, infer.py '
+                                                 'and ImpactDetector')
+    parser.add_argument('--ckpt', type=str, required=True)
+    parser.add_argument('--model', default='dcasenet', choices=['dcasenet', 'cnn'])
+    parser.add_argument('--cnn_config', nargs='*', default=[f"{channels}:{pool}" for (channels, pool) in DEFAULT_CHANNEL_AND_POOL],
+                        help='channels:pool of every conv block of a cnn model')
+    parser.add_argument('--output', default=None, help='The checkpoint path with .onnx by default')
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--check', action='store_true', help='Compare per-frame outputs with the torch model')
+    parser.add_argument('--check_lengths', type=int, nargs='*', default=[241, 960, 2400, 7201])
+    parser.add_argument('--tolerance', type=float, default=1e-4)
+    args = parser.parse_args()
+
+    if args.model == 'dcasenet':
+        model = load_dcasenet(args.ckpt, 'cpu')
+        frames_per_output = 2
+    else:
+        model_config = [tuple(int(value) for value in block.split(':')) for block in args.cnn_config]
+        model = load_cnn(args.ckpt, model_config)
+        frames_per_output = 2 ** model.num_pools
+
+    output_path = args.output or onnx_path(args.ckpt)
+    export_onnx(model, output_path, frames_per_output, checkpoint_version(args.ckpt), args.opset)
+    print(f"Exported {type(model).__name__} to {output_path}")
+
+    if args.check:
+        max_diff = onnx_parity(model, OnnxModel(output_path), args.check_lengths)
+        print(f"Largest per-frame difference to the torch model over {args.check_lengths} frames: {max_diff:.2e}")
+        if max_diff > args.tolerance:
+            print(f"Parity check failed (tolerance {args.tolerance})")
+            sys.exit(1)
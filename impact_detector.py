@@ -1,37 +1,55 @@
 import torch
-from models.DcaseNet import DcaseNet_v3
+from models.checkpoints import load_dcasenet
+from models.onnx_models import OnnxModel
+from models.optimization import load_optimized, to_frame_rate
 from models.spectogram_models import *
 from dataset.spectogram import spectogram_configs as cfg
-from dataset.spectogram.preprocess import multichannel_stft, multichannel_complex_to_log_mel
-from dataset.dataset_utils import read_audio_from_video
+from dataset.spectogram import torch_frontend
+from pipeline import PipelineTrace, Stage, detection_pipeline, run_with_feature_cache
+from utils.feature_cache import file_sha256
+from video_processing import SearchWindow
 
 
 class ImpactDetector:
     def __init__(self, ckpt_path):
+        """ckpt_path: a checkpoint, or its export by export_onnx.py (.onnx) to run on ONNX Runtime"""
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-        self.model = DcaseNet_v3(1).to(self.device)
-        checkpoint = torch.load(ckpt_path, map_location=self.device)
-        self.model.load_state_dict(checkpoint['model'])
+        if ckpt_path.endswith('.onnx'):
+            self.model = OnnxModel(ckpt_path)
+        else:
+            self.model = load_optimized(load_dcasenet(ckpt_path, self.device), self.device)
         self.log_mel_features = None
-        self.output = None
-    
+        self._output = None
+        # Stages of the last detection
+        self.trace = None
+
+    @property
+    def output(self):
+        """Output of the last detection, one per input frame"""
+        if self._output is None:
+            return None
+        return to_frame_rate(self._output, self.model.frame_rate_factor)
+
 
-    def detect_impact(self, video_path):
-        multichannel_audio = read_audio_from_video(video_path)
-        log_mel_features = multichannel_complex_to_log_mel(multichannel_stft(multichannel_audio))
-        self.log_mel_features = log_mel_features
-        
-        with torch.no_grad():
-            input = torch.from_numpy(log_mel_features).to(torch.float32).to(self.device)
-            output_event = self.model(input.unsqueeze(0))
-        output_event = output_event.cpu()
-        self.output = output_event[0]
-        return self.detect_impact_time(output_event[0])
+    def detect_impact(self, video_path, search_start=0.0, search_end=None):
+        """
+        Impact time in seconds from the start of the video. With search_end only [search_start, search_end] seconds
+        of the video are decoded and searched, otherwise the first third of the video from search_start.
+        """
+        pipeline = detection_pipeline(self.model, self.device, search_start, search_end).replace('impact', Stage(
+            'impact', lambda output: search_start + self.detect_impact_time(output, whole=search_end is not None)))
+        self.trace = PipelineTrace()
+        impact_time = run_with_feature_cache(pipeline, video_path, file_sha256(video_path),
+                                             SearchWindow(search_start, search_end).key, self.trace,
+                                             keep=('log-mel', 'model'))
+        self.log_mel_features = torch_frontend.expand_channels(self.trace.outputs['log-mel'])
+        self._output = self.trace.outputs['model']
+        return impact_time
     
     
-    def detect_impact_time(self, model_output):
-        to_search = model_output[0:int(model_output.shape[0] / 3)]
-        max_frame = torch.argmax(to_search, dim=0)[0].item()
+    def detect_impact_time(self, model_output, whole=False):
+        to_search = model_output if whole else model_output[0:int(model_output.shape[0] / 3)]
+        max_frame = torch.argmax(to_search, dim=0)[0].item() * self.model.frame_rate_factor
         return max_frame / cfg.working_sample_rate * cfg.hop_size
 
     
\ No newline at end of file
@@ -2,60 +2,49 @@ import argparse
 import os
 import torch
 from models.DcaseNet import DcaseNet_v3
+from models.onnx_models import OnnxModel
 from models.spectogram_models import *
-from dataset.spectogram import spectogram_configs as cfg
-from dataset.spectogram.preprocess import multichannel_stft, multichannel_complex_to_log_mel
-from dataset.dataset_utils import read_audio_from_video, read_multichannel_audio
+from pipeline import PipelineTrace, detection_pipeline, run_with_feature_cache
 from utils.plot_utils import plot_sample_features
-
-def detect_impact_time(model_output):
-    """
-    Args:
-        model_output: torch.Tensor of shape (seq_len, num_classes)
-    """
-    max_frame = torch.argmax(model_output, dim=0)[0].item()
-    return max_frame / cfg.working_sample_rate * cfg.hop_size
+from utils.feature_cache import file_sha256
+from video_processing import SearchWindow
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Example of parser. ')
 
     # Train
     parser.add_argument('audio_file', type=str)
-    parser.add_argument('--ckpt', type=str, required=True)
+    parser.add_argument('--ckpt', type=str, required=True, help='A checkpoint, or its export by export_onnx.py (.onnx)')
     parser.add_argument('--outputs_dir', type=str, default='inference_outputs', help='Directory of your workspace.')
     parser.add_argument('--device', default='cuda:0', type=str)
+    parser.add_argument('--start', default=0.0, type=float, help='Seconds of the input to search from')
+    parser.add_argument('--end', default=None, type=float, help='Seconds of the input to search to, the end by default')
     args = parser.parse_args()
 
     device = torch.device("cuda:0" if torch.cuda.is_available() and args.device == "cuda:0" else "cpu")
 
     # model = Cnn_AvgPooling(cfg.classes_num, model_config=[(32,2), (64,2), (128,2), (128,1)]).to(device)
-    model = DcaseNet_v3(1).to(device)
-    checkpoint = torch.load(args.ckpt, map_location=device)
-    model.load_state_dict(checkpoint['model'])
-
-    print("Preprocessing audio file..")
+    if args.ckpt.endswith('.onnx'):
+        model = OnnxModel(args.ckpt)
+    else:
+        model = DcaseNet_v3(1).to(device)
+        checkpoint = torch.load(args.ckpt, map_location=device)
+        model.load_state_dict(checkpoint['model'])
+
+    print("Preprocessing audio file and inference..")
     input_path = args.audio_file
-    multichannel_audio = None
-
-    if input_path.endswith('.wav'):
-        multichannel_audio = read_multichannel_audio(audio_path=input_path, target_fs=cfg.working_sample_rate)
-    elif input_path.endswith('.mov') or input_path.endswith('.mp4'):
-        multichannel_audio = read_audio_from_video(video_path=input_path)
-
-    log_mel_features = multichannel_complex_to_log_mel(multichannel_stft(multichannel_audio))
-    
-    # cropped = log_mel_features[:, :cfg.train_crop_size, :]
-
-    print("Inference..")
-    with torch.no_grad():
-        input = torch.from_numpy(log_mel_features).to(torch.float32).to(device)
-        output_event = model(input.unsqueeze(0))
-    output_event = output_event.cpu()
+    # Features come from the feature cache when the file was processed before
+    trace = PipelineTrace()
+    impact_time = run_with_feature_cache(detection_pipeline(model, device, args.start, args.end), input_path,
+                                         file_sha256(input_path), SearchWindow(args.start, args.end).key, trace,
+                                         keep=('log-mel', 'model'))
     os.makedirs(args.outputs_dir, exist_ok=True)
-    print(detect_impact_time(output_event[0]))
+    # Seconds from the start of the input
+    print(impact_time)
+    print(trace.summary())
     
-    plot_sample_features(log_mel_features,
+    plot_sample_features(trace.outputs['log-mel'],
                          mode='Spectrogram', 
-                         output=output_event[0], 
+                         output=trace.outputs['model'], 
                          plot_path=os.path.join(args.outputs_dir, f"{os.path.splitext(os.path.basename(args.audio_file))[0]}.png")
                          )
\ No newline at end of file
@@ -0,0 +1,208 @@
+import os
+import time
+import logging
+from typing import List, Optional
+
+import numpy as np
+import torch
+
+from dataset.spectogram import spectogram_configs as cfg
+from inference_engine import MAX_BATCH_SIZE
+from models.onnx_models import MODEL_ONNX, load_onnx_dcasenet, onnx_path
+from models.optimization import load_optimized
+from models.quantization import MODEL_QUANTIZATION, load_serving_dcasenet
+from models.shared_weights import MODEL_SHARED_WEIGHTS_DIR, load_shared_dcasenet
+from utils.startup_profiler import startup_profiler
+from windowed_inference import WINDOW_SECONDS, seconds_to_frames
+
+logger = logging.getLogger(__name__)
+
+# How forward passes run: 'eager' (the model as it is), 'script' (a frozen TorchScript graph), 'compile'
+# (torch.compile) or 'onnx' (the export of the checkpoint, MODEL_ONNX, on ONNX Runtime).
+# Compiled backends pad inputs to length and batch buckets.
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "eager").lower()
+BACKENDS = ['eager', 'script', 'compile', 'onnx']
+# Input lengths of the buckets; longer inputs run on the eager model. The longest default bucket holds a window
+# of windowed inference.
+LENGTH_BUCKETS_SECONDS = [float(seconds) for seconds in
+                          os.environ.get("INFERENCE_LENGTH_BUCKETS_SECONDS", f"5,10,{WINDOW_SECONDS or 30:g}").split(',')
+                          if seconds.strip()]
+# Batch sizes of the buckets, powers of two below INFERENCE_MAX_BATCH_SIZE and itself by default
+BATCH_BUCKETS = [int(size) for size in
+                 os.environ.get("INFERENCE_BATCH_BUCKETS",
+                                ','.join(str(2 ** i) for i in range((MAX_BATCH_SIZE - 1).bit_length())) +
+                                f",{MAX_BATCH_SIZE}").split(',')
+                 if size.strip()]
+# Run every bucket at startup, so no request pays for compilation or first-call allocations
+WARMUP = os.environ.get("INFERENCE_WARMUP", "true").lower() == "true"
+# Largest difference of a bucket's outputs to the eager model's allowed at warm-up
+BUCKET_PARITY_TOLERANCE = float(os.environ.get("INFERENCE_BUCKET_PARITY_TOLERANCE", 1e-4))
+
+
+def compile_model(model, backend):
+    """The model's forward pass as a backend; None when the model runs as it is (eager, onnx)"""
+    if backend not in BACKENDS:
+        raise ValueError(f"Inference backend can be one of {BACKENDS}, '{backend}' given")
+    if backend == 'script':
+        with torch.no_grad():
+            return torch.jit.optimize_for_inference(torch.jit.script(model))
+    if backend == 'compile':
+        return torch.compile(model, dynamic=False)
+    return None
+
+
+class InferenceBackend:
+    """
+    A DcaseNet_v3 behind an inference backend, called like the model itself (by forward_batch).
+    With a compiled backend, inputs are zero padded to the smallest length and batch bucket that holds them, with
+    lengths masking the padded frames as in any padded batch, so the compiled graph only ever sees the shapes warmed
+    up at startup and its outputs are the eager model's. Inputs longer than the largest bucket run on the eager model.
+    """
+    def __init__(self, model, device, backend=INFERENCE_BACKEND, length_buckets_seconds=None, batch_buckets=None):
+        self.model = model
+        self.device = device
+        self.backend = backend
+        # Two frames more than their seconds, so the end aligned last window (one frame longer) fits its bucket
+        self.length_buckets = sorted({seconds_to_frames(seconds) + 2
+                                      for seconds in length_buckets_seconds or LENGTH_BUCKETS_SECONDS if seconds > 0})
+        self.batch_buckets = sorted(set(batch_buckets or BATCH_BUCKETS))
+        started_at = time.perf_counter()
+        self.compiled = compile_model(model, backend)
+        self.compile_seconds = time.perf_counter() - started_at
+        self.warmup = []              # cold and warm latency of every bucket
+        self.warmup_seconds = None
+        self.calls = {'bucketed': 0, 'eager': 0}
+        logger.info(f"Inference backend {backend}: length buckets {self.length_buckets} frames, "
+                    f"batch buckets {self.batch_buckets}")
+
+    @property
+    def causal(self):
+        return self.model.causal
+
+    @property
+    def frame_rate_factor(self):
+        return self.model.frame_rate_factor
+
+    def output_length(self, input_length):
+        return self.model.output_length(input_length)
+
+    def __call__(self, x, lengths: Optional[torch.Tensor] = None):
+        (batch_size, _, num_frames, _) = x.shape
+        length_bucket = bucket(self.length_buckets, num_frames)
+        batch_bucket = bucket(self.batch_buckets, batch_size)
+        if self.compiled is None or length_bucket is None or batch_bucket is None:
+            self.calls['eager'] += 1
+            return self.model(x, lengths)
+
+        self.calls['bucketed'] += 1
+        if lengths is None:
+            lengths = torch.full((batch_size,), num_frames)
+        padded = x.new_zeros((batch_bucket, x.shape[1], length_bucket, x.shape[3]))
+        padded[:batch_size, :, :num_frames] = x
+        padded_lengths = torch.cat([lengths.cpu(), torch.full((batch_bucket - batch_size,), length_bucket)])
+        return self.compiled(padded, padded_lengths)[:batch_size, :self.output_length(num_frames)]
+
+    def warm_up(self, input_channels=cfg.audio_channels, mel_bins=cfg.mel_bins,
+                parity_tolerance=BUCKET_PARITY_TOLERANCE):
+        """
+        Run every bucket twice and keep the latency of the cold and the warm pass. Raises RuntimeError when a
+        bucket's outputs differ from the eager model's by more than parity_tolerance. The eager and onnx backends
+        aren't specialized to shapes, a single second of input warms them up.
+        """
+        started_at = time.perf_counter()
+        if self.compiled is not None:
+            shapes = [(length, batch_size) for length in self.length_buckets for batch_size in self.batch_buckets]
+        else:
+            shapes = [(seconds_to_frames(1), 1)]
+        rng = np.random.default_rng(0)
+        for (length, batch_size) in shapes:
+            features = rng.standard_normal((batch_size, input_channels, length, mel_bins)).astype(np.float32) - 40
+            x = torch.from_numpy(features).to(self.device)
+            latencies = []
+            for _ in range(2):
+                pass_started_at = time.perf_counter()
+                with torch.no_grad():
+                    self(x, torch.full((batch_size,), length))
+                latencies.append(time.perf_counter() - pass_started_at)
+            max_diff = self.bucket_parity(length, batch_size, input_channels, mel_bins, rng) \
+                if self.compiled is not None else 0.0
+            self.warmup.append({'frames': length, 'batch_size': batch_size, 'cold_ms': latencies[0] * 1000,
+                                'warm_ms': latencies[1] * 1000, 'max_diff': max_diff})
+            logger.info(f"Warmed up {self.backend} backend for {batch_size}x{length} frames: "
+                        f"cold {latencies[0] * 1000:.0f} ms, warm {latencies[1] * 1000:.0f} ms, "
+                        f"difference to eager {max_diff:.1e}")
+            if max_diff > parity_tolerance:
+                raise RuntimeError(f"Outputs of the {self.backend} backend's {batch_size}x{length} bucket differ "
+                                   f"from the eager model's by {max_diff:.2e} (tolerance {parity_tolerance})")
+        self.warmup_seconds = time.perf_counter() - started_at
+
+    def bucket_parity(self, length, batch_size, input_channels, mel_bins, rng) -> float:
+        """
+        Largest output difference of a bucket, for a batch padded to it in both length and batch size, to the eager
+        model's outputs of the inputs alone
+        """
+        smaller = [size for size in self.batch_buckets if size < batch_size]
+        num_inputs = smaller[-1] + 1 if smaller else batch_size
+        num_frames = length - 1
+        lengths = torch.linspace(num_frames, num_frames // 2, num_inputs).long()
+        features = rng.standard_normal((num_inputs, input_channels, num_frames, mel_bins)).astype(np.float32) - 40
+        x = torch.from_numpy(features).to(self.device)
+        with torch.no_grad():
+            output = self(x, lengths)
+            max_diff = 0.0
+            for (i, input_length) in enumerate(lengths.tolist()):
+                expected = self.model(x[i:i + 1, :, :input_length])[0]
+                max_diff = max(max_diff, (output[i, :expected.shape[0]] - expected).abs().max().item())
+        return max_diff
+
+    def stats(self):
+        return {
+            'backend': self.backend,
+            'length_buckets_frames': self.length_buckets,
+            'batch_buckets': self.batch_buckets,
+            'compile_seconds': self.compile_seconds,
+            'warmup_seconds': self.warmup_seconds,
+            'warmup': self.warmup,
+            'calls': dict(self.calls),
+        }
+
+
+def load_inference_model(checkpoint_path, device, backend=INFERENCE_BACKEND):
+    """
+    The InferenceBackend served for a checkpoint and the version of its results. The onnx backend runs the export of
+    the checkpoint (MODEL_ONNX) and doesn't read the checkpoint itself; the others its fp32 or int8 model
+    (MODEL_QUANTIZATION), optimized for inference (MODEL_OPTIMIZE) and mapped from shared weights when shares_weights.
+    """
+    if backend == 'onnx':
+        if MODEL_QUANTIZATION != 'none':
+            raise ValueError(f"The onnx backend runs fp32 exports only, MODEL_QUANTIZATION={MODEL_QUANTIZATION} given")
+        with startup_profiler.phase('checkpoint'):
+            (model, version) = load_onnx_dcasenet(MODEL_ONNX or onnx_path(checkpoint_path))
+    elif shares_weights(backend, device):
+        # Already optimized, as all the processes sharing it use it
+        with startup_profiler.phase('checkpoint'):
+            (model, version) = load_shared_dcasenet(checkpoint_path)
+    else:
+        with startup_profiler.phase('checkpoint'):
+            (model, version) = load_serving_dcasenet(checkpoint_path, device)
+        with startup_profiler.phase('optimize'):
+            model = load_optimized(model, device)
+    with startup_profiler.phase('backend'):
+        return InferenceBackend(model, device, backend), version
+
+
+def shares_weights(backend=INFERENCE_BACKEND, device='cpu'):
+    """
+    Whether the model is mapped from shared weights (MODEL_SHARED_WEIGHTS_DIR, set by serve.py): fp32 models on the
+    CPU. An int8 model and an ONNX Runtime session hold weights of their own.
+    """
+    return bool(MODEL_SHARED_WEIGHTS_DIR) and backend != 'onnx' and MODEL_QUANTIZATION == 'none' and \
+        torch.device(device).type == 'cpu'
+
+
+def bucket(buckets: List[int], size) -> Optional[int]:
+    """The smallest bucket holding size, None when none does"""
+    for candidate in buckets:
+        if candidate >= size:
+            return candidate
+    return None
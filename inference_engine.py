@@ -0,0 +1,161 @@
+import os
+import time
+import asyncio
+import logging
+from typing import List, Optional
+
+import torch
+
+import metrics
+from dataset.spectogram import spectogram_configs as cfg
+from windowed_inference import WindowConfig, batch_parity, forward_batch, stitch_outputs
+
+logger = logging.getLogger(__name__)
+
+# Flush a batch as soon as it holds this many requests...
+MAX_BATCH_SIZE = int(os.environ.get("INFERENCE_MAX_BATCH_SIZE", 8))
+# ...or when the oldest request in it has waited this long
+MAX_WAIT_MS = float(os.environ.get("INFERENCE_MAX_WAIT_MS", 10))
+
+
+class InferenceResult:
+    def __init__(self, output, impact_time, batch_size, wait_seconds, windows=1):
+        self.output = output              # torch.Tensor (output_length, classes_num) for this request only
+        self.impact_time = impact_time
+        self.batch_size = batch_size      # number of batch items that shared the (largest) forward pass
+        self.wait_seconds = wait_seconds  # time spent queued before the (last) forward pass started
+        self.windows = windows            # number of windows the input was split into
+
+
+class _PendingRequest:
+    def __init__(self, features, future):
+        self.features = features
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class BatchingInferenceEngine:
+    """
+    Gathers log-mel inputs of concurrent requests into zero padded batches and runs one forward pass per batch.
+    A batch is flushed when it holds max_batch_size requests or when its oldest request waited max_wait_ms.
+    Compact single channel inputs (mono sources) are broadcast to the model's input_channels in the batch.
+    Inputs longer than a window of window_config are split into overlapping windows, which are batched like
+    separate requests, and their outputs are stitched.
+    """
+    def __init__(self, model, device, detect_impact_time, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS,
+                 executor=None, input_channels=cfg.audio_channels, window_config=None):
+        self.model = model
+        self.input_channels = input_channels
+        self.window_config = window_config or WindowConfig()
+        self.device = device
+        self.detect_impact_time = detect_impact_time
+        self.executor = executor  # where forward passes run; None for the loop's default executor
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue: Optional[asyncio.Queue] = None
+        self._arrived: Optional[asyncio.Event] = None  # set when requests are queued
+        self._batch: List[_PendingRequest] = []  # requests of the batch being gathered or run
+        self._worker: Optional[asyncio.Task] = None
+
+    async def start(self, parity_tolerance=1e-4):
+        """Refuses (RuntimeError) a model whose outputs in a padded batch differ from those of the inputs alone"""
+        max_diff = await asyncio.get_running_loop().run_in_executor(
+            self.executor, batch_parity, self.model, self.device, (240, 181, 64), self.input_channels)
+        if max_diff > parity_tolerance:
+            raise RuntimeError(f"Outputs in padded batches differ from the outputs of the inputs alone by {max_diff:.2e} "
+                               f"(tolerance {parity_tolerance})")
+        self._queue = asyncio.Queue()
+        self._arrived = asyncio.Event()
+        self._worker = asyncio.create_task(self._batch_loop())
+        logger.info(f"Inference engine started: max_batch_size={self.max_batch_size}, batch parity {max_diff:.1e}, "
+                    f"max_wait_ms={self.max_wait * 1000:.1f}, window_frames={self.window_config.window_frames}, "
+                    f"overlap_frames={self.window_config.overlap_frames}, stitch={self.window_config.policy}")
+
+    async def stop(self):
+        """Stop the batch loop; the requests queued or in the batch being run fail with RuntimeError"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        pending = self._batch
+        self._batch = []
+        while self._queue is not None and not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        self._queue = None
+        unfinished = [request for request in pending if not request.future.done()]
+        for request in unfinished:
+            request.future.set_exception(RuntimeError("Inference engine stopped"))
+        logger.info(f"Inference engine stopped, {len(unfinished)} unfinished requests failed")
+
+    async def infer(self, log_mel_features) -> InferenceResult:
+        """
+        Args:
+            log_mel_features: np.ndarray of shape (channels_num or 1, frames_num, mel_bins)
+        """
+        if self._queue is None:
+            raise RuntimeError("Inference engine is not started")
+        num_frames = log_mel_features.shape[1]
+        spans = self.window_config.spans(num_frames)
+        loop = asyncio.get_running_loop()
+        requests = [_PendingRequest(log_mel_features[:, start:end], loop.create_future()) for (start, end) in spans]
+        for request in requests:
+            self._queue.put_nowait(request)
+        self._arrived.set()
+        results = await asyncio.gather(*[request.future for request in requests])
+
+        output = stitch_outputs([result.output for result in results], spans,
+                                self.model.output_length(num_frames), self.window_config.policy,
+                                self.model.frame_rate_factor)
+        return InferenceResult(output=output,
+                               impact_time=self.detect_impact_time(output, self.model.frame_rate_factor),
+                               batch_size=max(result.batch_size for result in results),
+                               wait_seconds=max(result.wait_seconds for result in results),
+                               windows=len(spans))
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._batch = batch = [await self._queue.get()]
+            deadline = batch[0].enqueued_at + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                # Waits for an arrival rather than a get(): a wait_for(get()) timing out as an item arrives can
+                # drop the item (before Python 3.12), cancelling this wait drops nothing
+                self._arrived.clear()
+                try:
+                    await asyncio.wait_for(self._arrived.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+            started_at = time.monotonic()
+            metrics.inference_batch_size.observe(len(batch))
+            try:
+                outputs = await loop.run_in_executor(self.executor, self._run_batch, [r.features for r in batch])
+            except Exception as e:
+                logger.error(f"Batched inference failed for {len(batch)} requests: {str(e)}")
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+            metrics.inference_batch_seconds.observe(time.monotonic() - started_at)
+
+            for request, output in zip(batch, outputs):
+                if request.future.done():  # the caller went away
+                    continue
+                request.future.set_result(InferenceResult(output=output,
+                                                          impact_time=None,
+                                                          batch_size=len(batch),
+                                                          wait_seconds=started_at - request.enqueued_at))
+
+    def _run_batch(self, features_list) -> List[torch.Tensor]:
+        return forward_batch(self.model, features_list, self.device, self.input_channels)
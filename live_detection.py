@@ -0,0 +1,153 @@
+import os
+import logging
+from typing import List
+
+import numpy as np
+import torch
+
+from dataset.spectogram import spectogram_configs as cfg
+from dataset.spectogram.torch_frontend import StreamingLogMel, expand_channels
+from models.DcaseNet import DcaseNet_v3
+
+try:
+    import av
+except ImportError:
+    av = None
+
+logger = logging.getLogger(__name__)
+
+# Causal DcaseNet_v3 checkpoint (train.py --causal) used by live sessions; live detection is off without it
+LIVE_MODEL_CHECKPOINT = os.environ.get("LIVE_MODEL_CHECKPOINT", "")
+# An impact is reported when the output rises to this probability...
+LIVE_THRESHOLD = float(os.environ.get("LIVE_THRESHOLD", 0.5))
+# ...and the previous impact was at least this long ago
+LIVE_REFRACTORY_SECONDS = float(os.environ.get("LIVE_REFRACTORY_SECONDS", 1.0))
+
+SAMPLE_FORMATS = {'s16le': np.dtype('<i2'), 'f32le': np.dtype('<f4')}
+
+
+def algorithmic_latency_seconds():
+    """
+    Audio that has to arrive after a frame before its output can be computed: the half window of the centered STFT
+    and the lookahead of the model's convolutions, for the first frame of a GRU step
+    """
+    return ((DcaseNet_v3.CONV_LOOKAHEAD_FRAMES + 1) * cfg.hop_size + cfg.NFFT // 2) / cfg.working_sample_rate
+
+
+class PcmDecoder:
+    """
+    Interleaved PCM bytes of any sample rate and channel count -> mono float32 samples at cfg.working_sample_rate.
+    Samples split between messages and the resampler's state are carried over.
+    """
+    def __init__(self, sample_rate=cfg.working_sample_rate, channels=1, sample_format='s16le'):
+        if sample_format not in SAMPLE_FORMATS:
+            raise ValueError(f"Sample format can be one of {list(SAMPLE_FORMATS)}, '{sample_format}' given")
+        if channels < 1:
+            raise ValueError(f"At least one channel is needed, {channels} given")
+        self.dtype = SAMPLE_FORMATS[sample_format]
+        self.channels = channels
+        self.sample_rate = sample_rate
+        self._frame_bytes = self.dtype.itemsize * channels
+        self._remainder = b''
+        self._resampler = None
+        self._samples = 0
+        if sample_rate != cfg.working_sample_rate:
+            if av is None:
+                raise ValueError(f"Only {cfg.working_sample_rate}Hz audio can be resampled without PyAV, {sample_rate}Hz given")
+            self._resampler = av.AudioResampler(format='flt', layout='mono', rate=cfg.working_sample_rate)
+
+    def decode(self, data: bytes) -> np.ndarray:
+        data = self._remainder + data
+        usable = len(data) - len(data) % self._frame_bytes
+        self._remainder = data[usable:]
+        samples = np.frombuffer(data[:usable], dtype=self.dtype).reshape(-1, self.channels).mean(1, dtype=np.float32)
+        if self.dtype.kind == 'i':
+            samples /= 2 ** (8 * self.dtype.itemsize - 1)
+        return self._resample(samples)
+
+    def _resample(self, samples):
+        if self._resampler is None or samples.shape[0] == 0:
+            return samples
+        frame = av.AudioFrame.from_ndarray(samples[None], format='flt', layout='mono')
+        frame.sample_rate = self.sample_rate
+        frame.pts = self._samples
+        self._samples += samples.shape[0]
+        resampled = [out.to_ndarray()[0] for out in self._resampler.resample(frame)]
+        return np.concatenate(resampled) if resampled else np.zeros(0, dtype=np.float32)
+
+
+class LiveDetector:
+    """
+    Impact events of a live audio stream fed in chunks of any size, with a causal DcaseNet_v3.
+    The log-mel front-end and the GRU state are carried across chunks; the convolutions are recomputed over the
+    new frames and CONV_CONTEXT_FRAMES before them only. A frame's output is computed as soon as the
+    algorithmic_latency_seconds of audio after it arrived, and equals the output of the whole stream at once.
+    """
+    def __init__(self, model, device='cpu', threshold=LIVE_THRESHOLD, refractory_seconds=LIVE_REFRACTORY_SECONDS):
+        if not getattr(model, 'causal', False):
+            raise ValueError("Live detection needs a causal model (train.py --causal)")
+        self.model = model
+        self.device = device
+        self.threshold = threshold
+        self.refractory_frames = refractory_seconds * cfg.working_sample_rate / cfg.hop_size
+        self.last_probabilities = torch.zeros(0)  # outputs of the GRU steps computed by the last push, two frames each
+        self._log_mel = StreamingLogMel()
+        self._features = np.zeros((1, 0, cfg.mel_bins), dtype=np.float32)
+        self._features_start = 0  # frame of self._features[:, 0]
+        self._steps = 0           # GRU steps computed so far
+        self._hidden = None
+        self._above = False       # the last step was above the threshold
+        self._last_event_frame = None
+
+    @property
+    def frames(self):
+        """Output frames computed so far"""
+        return 2 * self._steps
+
+    @property
+    def seconds(self):
+        """Audio the outputs were computed for so far"""
+        return self.frames * cfg.hop_size / cfg.working_sample_rate
+
+    def push(self, samples) -> List[dict]:
+        """Events completed by mono float32 samples at cfg.working_sample_rate"""
+        return self._advance(self._log_mel.push(samples), final=False)
+
+    def finish(self) -> List[dict]:
+        """Events of the rest of the stream, once it ended"""
+        return self._advance(self._log_mel.finish(), final=True)
+
+    def _advance(self, features, final):
+        self._features = np.concatenate([self._features, features], axis=1)
+        num_frames = self._features_start + self._features.shape[1]
+        if final:
+            ready_steps = num_frames // 2
+        else:
+            ready_steps = max(0, (num_frames - DcaseNet_v3.CONV_LOOKAHEAD_FRAMES) // 2)
+        if ready_steps <= self._steps:
+            self.last_probabilities = torch.zeros(0)
+            return []
+
+        # Enough frames before the new steps that the zero padding of the convolutions doesn't reach them
+        start = max(0, 2 * self._steps - DcaseNet_v3.CONV_CONTEXT_FRAMES)
+        self._features = self._features[:, start - self._features_start:]
+        self._features_start = start
+        with torch.no_grad():
+            input = expand_channels(torch.from_numpy(self._features).to(self.device))
+            embeddings = self.model.embed(input.unsqueeze(0))[:, self._steps - start // 2:ready_steps - start // 2]
+            (probabilities, self._hidden) = self.model.forward_steps(embeddings, self._hidden)
+        self.last_probabilities = probabilities[0, :, 0].cpu()
+
+        events = []
+        for (i, probability) in enumerate(self.last_probabilities.tolist()):
+            frame = 2 * (self._steps + i)
+            above = probability >= self.threshold
+            if above and not self._above and (self._last_event_frame is None or
+                                              frame - self._last_event_frame >= self.refractory_frames):
+                self._last_event_frame = frame
+                events.append({'event': 'impact',
+                               'time_seconds': frame * cfg.hop_size / cfg.working_sample_rate,
+                               'probability': probability})
+            self._above = above
+        self._steps = ready_steps
+        return events
@@ -1,24 +1,43 @@
+# First, so the imports below are part of the startup profile
+from utils.startup_profiler import startup_profiler
+# Before the modules reading the settings it tunes (thread counts, batch and pool sizes) are imported
+from autotune import apply_tuned_settings
+tuned_settings = apply_tuned_settings()
 import os
 import logging
 from pydantic import BaseModel
 import torch
-import requests
 import tempfile
 import shutil
-from fastapi import FastAPI, HTTPException, status, File, UploadFile, Form, BackgroundTasks
-from fastapi.responses import JSONResponse, RedirectResponse
+import asyncio
+import hashlib
+import functools
+from fastapi import FastAPI, HTTPException, status, File, UploadFile, Form, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from contextlib import asynccontextmanager
-from models.DcaseNet import DcaseNet_v3
-from dataset.spectogram import spectogram_configs as cfg
-from dataset.spectogram.preprocess import multichannel_stft, multichannel_complex_to_log_mel
-from dataset.dataset_utils import read_audio_from_video
+from models.checkpoints import checkpoint_version, load_dcasenet
+from models.optimization import load_optimized
+from dataset.dataset_utils import NoAudioInRangeError
+from dataset.spectogram.preprocess import warm_up_log_mel
 from typing import Optional, List
 from models.task_models import Task, TaskCreate, TaskUpdate, TaskStatus
 from database import task_db
+import metrics
+from dataset.spectogram import spectogram_configs as cfg
+from live_detection import LIVE_MODEL_CHECKPOINT, LiveDetector, PcmDecoder
+from executors import PipelineExecutors
+from model_registry import ModelRegistry, ServedModel
+from pipeline import (ASYNC, CPU, IO, Pipeline, PipelineTrace, Stage, decode_stage, download_stage, log_mel_stage,
+                      output_bytes, run_with_feature_cache_async)
+from task_queue import WORKER_ID, TaskQueue, lease_expiry
+from utils.feature_cache import feature_cache
+from video_processing import LocalVideo, ResultCache, SearchWindow, VideoDownloadError, copy_file_object, detect_impact_time, download_video as fetch_video
 from dotenv import load_dotenv
 
+startup_profiler.mark('imports')
+
 # Load environment variables
 load_dotenv()
 
@@ -35,31 +54,79 @@ logging.basicConfig(
     ]
 )
 logger = logging.getLogger(__name__)
+if tuned_settings:
+    logger.info(f"Tuned settings in effect: {tuned_settings}")
+
+# 'local' processes uploaded videos in this server, 'workers' leaves them to worker.py processes
+TASK_PROCESSING = os.environ.get("TASK_PROCESSING", "local").lower()
+# Claim the unfinished tasks of servers that stopped or died into the local queue, at startup and periodically;
+# claims are atomic, so every serve.py worker does it
+TASK_RECOVERY = os.environ.get("TASK_RECOVERY", "true").lower() == "true"
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 logger.info(f"Using device: {device}")
-model = None
+model_registry = None  # versions served; a version is part of every result deduplication key
+live_model = None  # causal model of the /live sessions, loaded from LIVE_MODEL_CHECKPOINT
+result_cache = ResultCache()
+executors = PipelineExecutors()
+task_queue = None
+pending_uploads = set()  # storage uploads running alongside the processing of their tasks
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global model
+    global model_registry, live_model, task_queue
+    # Module setup and the server's own startup
+    startup_profiler.mark('server')
+    with startup_profiler.phase('executors'):
+        executors.start()
     try:
-        model = DcaseNet_v3(1).to(device)
-        checkpoint_path = os.environ.get("MODEL_CHECKPOINT", "model_checkpoint.pt")
-        if not os.path.exists(checkpoint_path):
-            error_msg = f"Model checkpoint not found at {checkpoint_path}"
-            logger.error(error_msg)
-            raise RuntimeError(error_msg)
-        
-        checkpoint = torch.load(checkpoint_path, map_location=device)
-        model.load_state_dict(checkpoint['model'])
-        model.eval()
-        logger.info(f"Model loaded successfully from {checkpoint_path}")
+        with startup_profiler.phase('model'):
+            # MODEL_CHECKPOINT or the newest checkpoint of MODEL_DIR, as INFERENCE_BACKEND and MODEL_QUANTIZATION say
+            model_registry = ModelRegistry(executors, device, detect_impact_time)
+            await model_registry.start()
+        if LIVE_MODEL_CHECKPOINT:
+            with startup_profiler.phase('live model'):
+                live_model = load_optimized(load_dcasenet(LIVE_MODEL_CHECKPOINT, device), device)
+            if not live_model.causal:
+                raise ValueError(f"{LIVE_MODEL_CHECKPOINT} is not a causal model (train.py --causal)")
+            logger.info(f"Live model version: {checkpoint_version(LIVE_MODEL_CHECKPOINT)}")
     except Exception as e:
         logger.error(f"Failed to load model: {str(e)}")
+        executors.shutdown()
         raise
+    maintenance = None
+    if TASK_PROCESSING == "local":
+        task_queue = TaskQueue(process_video_task, task_db, executors)
+        await task_queue.start()
+        metrics.task_queue_depth.fn = task_queue.depth
+        metrics.task_queue_in_flight.fn = lambda: task_queue.stats()["in_flight"]
+        # Lease heartbeats, and recovery in the background so a long backlog doesn't delay startup
+        maintenance = asyncio.create_task(task_queue.maintain(recover=TASK_RECOVERY))
+    else:
+        logger.info("Tasks are processed by external workers (worker.py)")
+    # Likewise the decoding processes, which would otherwise be started by the first requests
+    front_end_warm_up = asyncio.create_task(executors.warm_up_cpu(warm_up_log_mel))
+    event_loop_lag_probe = asyncio.create_task(metrics.probe_event_loop_lag())
+    # Under serve.py, for GET /metrics of every worker to merge those of all of them
+    metrics_dump = asyncio.create_task(metrics.dump_periodically()) if metrics.METRICS_DIR else None
+    startup_profiler.finish()
     yield
     logger.info("Application shutting down")
+    front_end_warm_up.cancel()
+    event_loop_lag_probe.cancel()
+    if maintenance is not None:
+        maintenance.cancel()
+    if task_queue is not None:
+        await task_queue.stop()
+        # Let uploads already started finish so their tasks can be recovered from storage, then hand them back
+        await asyncio.gather(*pending_uploads, return_exceptions=True)
+        await task_queue.release()
+    await model_registry.stop()
+    executors.shutdown()
+    if metrics_dump is not None:
+        # The final counts, which stay part of the sums after this worker exits
+        metrics_dump.cancel()
+        metrics.registry.dump()
     
 app = FastAPI(lifespan=lifespan)
 
@@ -70,89 +137,165 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Outermost, so CORS preflights are counted too
+app.add_middleware(metrics.MetricsMiddleware)
 
 # Mount uploads directory for serving video files
 app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
 
 class ImpactDetectionRequest(BaseModel):
     video_url: Optional[str] = None
+    # Seconds of the video searched for the impact, SEARCH_WINDOW_START_SECONDS and SEARCH_WINDOW_END_SECONDS by default
+    search_start_seconds: Optional[float] = None
+    search_end_seconds: Optional[float] = None
+
+def download_video(url, output_path, digest=None):
+    try:
+        fetch_video(url, output_path, digest)
+    except VideoDownloadError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+def request_search_window(start: Optional[float], end: Optional[float]) -> SearchWindow:
+    try:
+        return SearchWindow.from_request(start, end)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+async def save_upload(file: UploadFile, output, digest=None):
+    """
+    Stream an upload into an open binary file. Starlette spools the request body to disk
+    as it arrives, so neither step holds the whole video in memory.
+    """
+    await file.seek(0)
+    return await executors.run_io(copy_file_object, file.file, output, digest=digest)
+
+def detection_pipeline(served: ServedModel, search_window: SearchWindow) -> Pipeline:
+    """
+    decode -> log-mel (in a decoding process, the search window only) -> model (batched on the served version) ->
+    impact (seconds from the start of the video)
+    """
+    return Pipeline([
+        decode_stage(search_window.start, search_window.end, CPU),
+        log_mel_stage(CPU),
+        Stage('model', functools.partial(model_registry.infer, served), ASYNC,
+              count_bytes=lambda result: output_bytes(result.output)),
+        Stage('impact', lambda result: search_window.start + result.impact_time),
+    ])
+
+async def detect_in_window(video_path: str, content_sha256: Optional[str], search_window: SearchWindow,
+                           served: ServedModel, trace: PipelineTrace) -> float:
+    """
+    Impact time in seconds from the start of the video by the served model version, searched for in its search
+    window only. The log-mel features come from the feature cache when the content was decoded before.
+    """
+    pipeline = detection_pipeline(served, search_window)
+    if content_sha256:
+        impact_time = await run_with_feature_cache_async(pipeline, video_path, executors, content_sha256,
+                                                         search_window.key, trace, keep=('log-mel', 'model'))
+    else:
+        impact_time = await pipeline.run_async(video_path, executors, trace, keep=('log-mel', 'model'))
+    metrics.audio_seconds.inc(amount=trace.outputs['log-mel'].shape[1] * cfg.hop_size / cfg.working_sample_rate)
+    logger.debug(f"Impact detected at time: {impact_time} seconds (batch size {trace.outputs['model'].batch_size})")
+    return impact_time
 
-def detect_impact_time(model_output):
+async def find_previous_result(content_sha256: str, search_window: SearchWindow, model_version: str) -> Optional[float]:
+    """
+    Impact time of the same video content and search window detected by a model version before, None if it is new
     """
-    Args:
-        model_output: torch.Tensor of shape (seq_len, num_classes)
+    impact_time = result_cache.get(content_sha256, model_version, search_window.key)
+    if impact_time is None:
+        columns = search_window.columns()
+        previous = await executors.run_io(task_db.find_completed_task, content_sha256, model_version,
+                                          columns["search_start_seconds"], columns["search_end_seconds"])
+        if previous is not None:
+            impact_time = previous.impact_time_seconds
+            result_cache.put(content_sha256, model_version, impact_time, search_window.key)
+    if impact_time is not None:
+        logger.info(f"Reusing the result of video {content_sha256} for model {model_version}")
+    return impact_time
+
+async def upload_local_video(local_video: LocalVideo, filename: str):
+    """
+    Upload a handed-off video to storage, then release it
     """
     try:
-        max_frame = torch.argmax(model_output, dim=0)[0].item()
-        return max_frame / cfg.working_sample_rate * cfg.hop_size
+        return await executors.run_io(task_db.upload_video, local_video.path, filename)
     except Exception as e:
-        logger.error(f"Error in detect_impact_time: {str(e)}")
+        logger.error(f"Failed to upload video {filename}: {str(e)}")
         raise
+    finally:
+        local_video.release()
 
-def download_video(url, output_path):
-    try:
-        logger.info(f"Downloading video from {url}")
-        response = requests.get(url, stream=True, timeout=30)
-        if response.status_code != 200:
-            error_msg = f"Failed to download video: status code {response.status_code}"
-            logger.error(error_msg)
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=error_msg)
-        
-        with open(output_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        logger.info(f"Video downloaded successfully to {output_path}")
-    except requests.RequestException as e:
-        error_msg = f"Error downloading video: {str(e)}"
-        logger.error(error_msg)
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=error_msg)
+def upload_done(upload: asyncio.Task):
+    pending_uploads.discard(upload)
+    # Failures are logged by upload_local_video and reported by process_video_task; mark them retrieved
+    if not upload.cancelled():
+        upload.exception()
 
-async def process_video_task(task_id: str):
-    task = task_db.get_task(task_id)
-    if not task:
-        logger.error(f"Task {task_id} not found")
-        return
-    
-    # Update task status to processing
-    task_db.update_task(task_id, TaskUpdate(status=TaskStatus.PROCESSING))
-    
+async def process_video_task(task_id: str, local_video: Optional[LocalVideo] = None):
     try:
-        # Create a temporary file to download the video
-        with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as temp_file:
-            video_path = temp_file.name
-            try:
-                # Download video from Supabase URL
-                download_video(task.video_url, video_path)
-                
-                logger.debug(f"Reading audio from video: {video_path}")
-                multichannel_audio = read_audio_from_video(video_path=video_path)
-                
-                logger.debug("Extracting log-mel features")
-                log_mel_features = multichannel_complex_to_log_mel(multichannel_stft(multichannel_audio))
-                
-                logger.debug("Running inference")
-                with torch.no_grad():
-                    input_tensor = torch.from_numpy(log_mel_features).to(torch.float32).to(device)
-                    output_event = model(input_tensor.unsqueeze(0))
-                output_event = output_event.cpu()
-                
-                impact_time = detect_impact_time(output_event[0])
-                logger.debug(f"Impact detected at time: {impact_time} seconds")
-                
-                # Update task with results
-                task_db.update_task(task_id, TaskUpdate(
+        task = await executors.run_io(task_db.get_task, task_id)
+        if not task:
+            logger.error(f"Task {task_id} not found")
+            return
+        
+        # Update task status to processing, unless the lease expired while queued and another server took the task
+        if await executors.run_io(task_db.update_leased_task, task_id, WORKER_ID, TaskUpdate(
+                status=TaskStatus.PROCESSING, lease_expires_at=lease_expiry())) is None:
+            logger.warning(f"Task {task_id} was leased to another server, skipping it")
+            return
+        
+        video_path = None
+        trace = PipelineTrace()
+        try:
+            if local_video is not None:
+                # Uploaded to this server: use the file on disk while it is being uploaded to storage
+                video_path = local_video.path
+            else:
+                # Recovered task: download video from Supabase URL
+                with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as temp_file:
+                    video_path = temp_file.name
+                await Pipeline([download_stage(video_path, download_video)]).run_async(task.video_url, executors, trace)
+            
+            search_window = SearchWindow.of_task(task)
+            async with model_registry.serving() as served:
+                impact_time = await detect_in_window(video_path, task.content_sha256, search_window, served, trace)
+            
+            if local_video is not None:
+                # Complete the task only once its video can be played from storage; raises if the upload failed
+                with trace.measure('storage upload'):
+                    await local_video.upload
+            
+            logger.info(f"Task {task_id} processed: {trace.summary()}")
+            # Update task with results
+            with trace.measure('db write', IO):
+                completed = await executors.run_io(task_db.update_leased_task, task_id, WORKER_ID, TaskUpdate(
                     status=TaskStatus.COMPLETED,
-                    impact_time_seconds=float(impact_time)
+                    impact_time_seconds=float(impact_time),
+                    model_version=served.version,
+                    lease_owner=None,
+                    lease_expires_at=None,
+                    trace=trace.to_dict()
                 ))
-            except Exception as e:
-                error_msg = f"Error processing video: {str(e)}"
-                logger.error(error_msg)
-                # Update task with error
-                task_db.update_task(task_id, TaskUpdate(
+            if completed is None:
+                logger.warning(f"Task {task_id} was leased to another server, dropping the result")
+            if task.content_sha256:
+                result_cache.put(task.content_sha256, served.version, float(impact_time), search_window.key)
+        except Exception as e:
+            error_msg = f"Error processing video: {str(e)}"
+            logger.error(error_msg)
+            # Update task with error, and the stages it went through
+            with trace.measure('db write', IO):
+                await executors.run_io(task_db.update_leased_task, task_id, WORKER_ID, TaskUpdate(
                     status=TaskStatus.FAILED,
-                    error_message=error_msg
+                    error_message=error_msg,
+                    lease_owner=None,
+                    lease_expires_at=None,
+                    trace=trace.to_dict()
                 ))
-            finally:
+        finally:
+            metrics.observe_trace(trace)
+            if local_video is None and video_path is not None:
                 try:
                     os.unlink(video_path)
                     logger.debug(f"Temporary file deleted: {video_path}")
@@ -162,10 +305,15 @@ async def process_video_task(task_id: str):
         error_msg = f"Error in task processing: {str(e)}"
         logger.error(error_msg)
         # Update task with error
-        task_db.update_task(task_id, TaskUpdate(
+        await executors.run_io(task_db.update_leased_task, task_id, WORKER_ID, TaskUpdate(
             status=TaskStatus.FAILED,
-            error_message=error_msg
+            error_message=error_msg,
+            lease_owner=None,
+            lease_expires_at=None
         ))
+    finally:
+        if local_video is not None:
+            local_video.release()
 
 @app.exception_handler(Exception)
 async def global_exception_handler(request, exc):
@@ -177,14 +325,21 @@ async def global_exception_handler(request, exc):
     
 @app.post("/detect-impact")
 async def detect_impact(impact_detection_request: ImpactDetectionRequest):
-    return await detect_impact_direct(impact_detection_request=impact_detection_request, file=None)
+    search_window = request_search_window(impact_detection_request.search_start_seconds,
+                                          impact_detection_request.search_end_seconds)
+    return await detect_impact_direct(impact_detection_request=impact_detection_request, file=None,
+                                      search_window=search_window)
 
 @app.post("/detect-impact-file")
-async def detect_impact_file(file: UploadFile = File(...)):
-    return await detect_impact_direct(impact_detection_request=None, file=file)
+async def detect_impact_file(file: UploadFile = File(...),
+                             search_start_seconds: Optional[float] = Form(None),
+                             search_end_seconds: Optional[float] = Form(None)):
+    search_window = request_search_window(search_start_seconds, search_end_seconds)
+    return await detect_impact_direct(impact_detection_request=None, file=file, search_window=search_window)
 
 async def detect_impact_direct(impact_detection_request: Optional[ImpactDetectionRequest] = None, 
-                               file: Optional[UploadFile] = None):
+                               file: Optional[UploadFile] = None,
+                               search_window: Optional[SearchWindow] = None):
     """
     Direct detection without task creation - legacy endpoint
     """
@@ -195,41 +350,42 @@ async def detect_impact_direct(impact_detection_request: Optional[ImpactDetectio
             status_code=status.HTTP_400_BAD_REQUEST, 
             detail="Either video_url or file upload is required"
         )
+    search_window = search_window or SearchWindow.from_request()
     
     with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as temp_file:
+        trace = PipelineTrace()
         try:
+            digest = hashlib.sha256()
             if impact_detection_request and impact_detection_request.video_url:
                 video_url = impact_detection_request.video_url
                 logger.info(f"Using URL: {video_url}")
-                download_video(video_url, temp_file.name)
+                await Pipeline([download_stage(temp_file.name, download_video, digest)]).run_async(video_url, executors,
+                                                                                                  trace)
             elif file:
                 logger.info(f"Using uploaded file: {file.filename}")
-                content = await file.read()
-                with open(temp_file.name, 'wb') as f:
-                    f.write(content)
+                with trace.measure('receive', IO):
+                    await save_upload(file, temp_file, digest)
             
             video_path = temp_file.name
+            content_sha256 = digest.hexdigest()
             
             try:
-                logger.debug(f"Reading audio from video: {video_path}")
-                multichannel_audio = read_audio_from_video(video_path=video_path)
-                
-                logger.debug("Extracting log-mel features")
-                log_mel_features = multichannel_complex_to_log_mel(multichannel_stft(multichannel_audio))
-                
-                logger.debug("Running inference")
-                with torch.no_grad():
-                    input_tensor = torch.from_numpy(log_mel_features).to(torch.float32).to(device)
-                    output_event = model(input_tensor.unsqueeze(0))
-                output_event = output_event.cpu()
-                
-                impact_time = detect_impact_time(output_event[0])
-                logger.debug(f"Impact detected at time: {impact_time} seconds")
+                async with model_registry.serving() as served:
+                    with trace.measure('result lookup'):
+                        impact_time = await find_previous_result(content_sha256, search_window, served.version)
+                    if impact_time is None:
+                        impact_time = await detect_in_window(video_path, content_sha256, search_window, served, trace)
+                        result_cache.put(content_sha256, served.version, float(impact_time), search_window.key)
+                logger.info(f"Direct detection: {trace.summary()}")
                 
                 return {
                     "impact_time_seconds": float(impact_time),
-                    "status": "success"
+                    "status": "success",
+                    "trace": trace.to_dict()
                 }
+            except NoAudioInRangeError:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                    detail=f"Search window {search_window} starts after the end of the video's audio")
             except Exception as e:
                 error_msg = f"Error processing video: {str(e)}"
                 logger.error(error_msg)
@@ -238,6 +394,7 @@ async def detect_impact_direct(impact_detection_request: Optional[ImpactDetectio
             logger.error(f"Error in detect_impact endpoint: {str(e)}")
             raise
         finally:
+            metrics.observe_trace(trace)
             try:
                 os.unlink(temp_file.name)
                 logger.debug(f"Temporary file deleted: {temp_file.name}")
@@ -245,8 +402,19 @@ async def detect_impact_direct(impact_detection_request: Optional[ImpactDetectio
                 logger.warning(f"Failed to delete temporary file {temp_file.name}: {str(e)}")
 
 @app.post("/tasks", response_model=Task)
-async def create_task(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+async def create_task(file: UploadFile = File(...),
+                      search_start_seconds: Optional[float] = Form(None),
+                      search_end_seconds: Optional[float] = Form(None)):
     logger.info(f"Creating new task for file: {file.filename}")
+    search_window = request_search_window(search_start_seconds, search_end_seconds)
+    
+    # Reject early instead of accepting work the server has no room for
+    if task_queue is not None and task_queue.is_full():
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many videos are being processed, please try again later",
+            headers={"Retry-After": "30"}
+        )
     
     # Create unique filename
     original_filename = file.filename
@@ -259,34 +427,72 @@ async def create_task(background_tasks: BackgroundTasks, file: UploadFile = File
     try:
         # Save to temporary file
         with tempfile.NamedTemporaryFile(suffix=file_extension, delete=False) as temp_file:
+            handed_off = False
+            trace = PipelineTrace()
             try:
-                # Save the uploaded file to temp location
-                await file.seek(0)
-                content = await file.read()
-                temp_file.write(content)
-                temp_file.flush()
+                # Save the uploaded file to temp location, hashing it on the way
+                digest = hashlib.sha256()
+                with trace.measure('receive', IO):
+                    await save_upload(file, temp_file, digest)
+                content_sha256 = digest.hexdigest()
+                
+                # The same video processed by the active model version before: the task is complete right away
+                model_version = model_registry.active.version
+                with trace.measure('result lookup'):
+                    impact_time = await find_previous_result(content_sha256, search_window, model_version)
                 
-                # Upload to Supabase storage
-                video_url = task_db.upload_video(temp_file.name, filename)
+                if task_queue is None or impact_time is not None:
+                    # Workers may run on other nodes and download the video, so it must be in storage first
+                    video_url = await executors.run_io(task_db.upload_video, temp_file.name, filename)
+                else:
+                    # Processed here from the local file, in parallel with the upload to storage
+                    video_url = await executors.run_io(task_db.get_video_url, filename)
                 
                 # Create task with the Supabase storage URL
                 task = Task(
                     filename=filename,
                     original_filename=original_filename,
-                    video_url=video_url
+                    video_url=video_url,
+                    content_sha256=content_sha256,
+                    **search_window.columns()
                 )
-                task = task_db.create_task(task)
+                if impact_time is not None:
+                    task.status = TaskStatus.COMPLETED
+                    task.impact_time_seconds = impact_time
+                    task.model_version = model_version
+                    task.trace = trace.to_dict()
+                elif task_queue is not None:
+                    # Held by the local queue from the start, so recovery elsewhere leaves it alone
+                    task.lease_owner = WORKER_ID
+                    task.lease_expires_at = lease_expiry()
+                with trace.measure('db write', IO):
+                    task = await executors.run_io(task_db.create_task, task)
                 
-                # Process video in background
-                background_tasks.add_task(process_video_task, task.id)
+                # Process video in background; waits only if the queue filled up since the check above.
+                # Without a local queue the PENDING row is claimed by a worker process.
+                if task_queue is not None and impact_time is None:
+                    local_video = LocalVideo(temp_file.name, holders=2)
+                    local_video.upload = asyncio.create_task(upload_local_video(local_video, filename))
+                    handed_off = True
+                    pending_uploads.add(local_video.upload)
+                    local_video.upload.add_done_callback(upload_done)
+                    try:
+                        await task_queue.put(task.id, local_video)
+                    except BaseException:
+                        # Not queued, e.g. the client went away while waiting for a slot: the task stays
+                        # PENDING and is recovered once its lease expires, downloading the video from storage
+                        local_video.release()
+                        raise
                 
                 return task
             finally:
-                try:
-                    os.unlink(temp_file.name)
-                    logger.debug(f"Temporary file deleted: {temp_file.name}")
-                except Exception as e:
-                    logger.warning(f"Failed to delete temporary file {temp_file.name}: {str(e)}")
+                metrics.observe_trace(trace)
+                if not handed_off:
+                    try:
+                        os.unlink(temp_file.name)
+                        logger.debug(f"Temporary file deleted: {temp_file.name}")
+                    except Exception as e:
+                        logger.warning(f"Failed to delete temporary file {temp_file.name}: {str(e)}")
     except Exception as e:
         error_msg = f"Error creating task: {str(e)}"
         logger.error(error_msg)
@@ -294,30 +500,45 @@ async def create_task(background_tasks: BackgroundTasks, file: UploadFile = File
 
 @app.get("/tasks", response_model=List[Task])
 async def list_tasks():
-    return task_db.list_tasks()
+    return await executors.run_io(task_db.list_tasks)
+
+@app.get("/cache")
+async def cache_stats():
+    return feature_cache.stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    """Prometheus text format"""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/queue")
+async def queue_stats():
+    if task_queue is None:
+        return {"detail": "Tasks are processed by external workers"}
+    return task_queue.stats()
 
 @app.get("/tasks/{task_id}", response_model=Task)
 async def get_task(task_id: str):
-    task = task_db.get_task(task_id)
+    task = await executors.run_io(task_db.get_task, task_id)
     if not task:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Task not found")
     return task
 
 @app.delete("/tasks/{task_id}")
 async def delete_task(task_id: str):
-    task = task_db.get_task(task_id)
+    task = await executors.run_io(task_db.get_task, task_id)
     if not task:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Task not found")
     
     # Delete task and associated video
-    if task_db.delete_task(task_id):
+    if await executors.run_io(task_db.delete_task, task_id):
         return {"message": "Task deleted successfully"}
     else:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to delete task")
 
 @app.get("/tasks/{task_id}/video")
 async def get_task_video(task_id: str):
-    task = task_db.get_task(task_id)
+    task = await executors.run_io(task_db.get_task, task_id)
     if not task:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Task not found")
     
@@ -327,15 +548,78 @@ async def get_task_video(task_id: str):
     # Redirect to the Supabase storage URL
     return RedirectResponse(url=task.video_url)
 
+@app.websocket("/live")
+async def live_detection(websocket: WebSocket, sample_rate: int = 44100, channels: int = 1, sample_format: str = "s16le"):
+    """
+    Impacts of audio streamed as binary messages of interleaved PCM samples, sent back as
+    {"event": "impact", "time_seconds", "probability"} messages as soon as they are detected.
+    A text "end" message flushes the rest of the stream, answered by {"event": "end"}.
+    """
+    await websocket.accept()
+    if live_model is None:
+        await websocket.close(code=1011, reason="Live detection is not enabled (LIVE_MODEL_CHECKPOINT)")
+        return
+    try:
+        decoder = PcmDecoder(sample_rate, channels, sample_format)
+    except ValueError as e:
+        await websocket.close(code=1003, reason=str(e))
+        return
+    detector = LiveDetector(live_model, device)
+    logger.info(f"Live session started: {sample_rate}Hz, {channels} channels, {sample_format}")
+
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("bytes") is not None:
+                events = await executors.run_live(lambda data: detector.push(decoder.decode(data)), message["bytes"])
+                for event in events:
+                    await websocket.send_json(event)
+            elif message.get("text") == "end":
+                for event in await executors.run_live(detector.finish):
+                    await websocket.send_json(event)
+                await websocket.send_json({"event": "end"})
+                await websocket.close()
+                break
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logger.error(f"Live session failed: {str(e)}")
+        await websocket.close(code=1011, reason="Live detection failed")
+    logger.info(f"Live session ended after {detector.seconds:.1f}s of audio")
+
 @app.get("/health")
 async def health_check():
-    if model is None:
+    if model_registry is None or model_registry.active is None:
         logger.error("Health check failed: Model not loaded")
         return JSONResponse(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             content={"status": "error", "message": "Model not loaded"}
         )
-    return {"status": "healthy"}
+    return {"status": "healthy", "model_version": model_registry.active.version,
+            "inference": model_registry.active.model.stats(), "startup": startup_profiler.report(),
+            "tuned_settings": tuned_settings}
+
+@app.get("/models")
+async def list_models():
+    return model_registry.stats()
+
+@app.post("/models/promote")
+async def promote_candidate():
+    try:
+        promoted = await model_registry.promote()
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    return {"message": f"Version {promoted.version} is active"}
+
+@app.delete("/models/candidate")
+async def reject_candidate():
+    try:
+        rejected = await model_registry.reject()
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    return {"message": f"Version {rejected.version} is no longer served"}
 
 if __name__ == "__main__":
     import uvicorn
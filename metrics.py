@@ -0,0 +1,318 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Interval at which the event loop's lag (how late it wakes up a sleeping coroutine) is measured
+EVENT_LOOP_LAG_INTERVAL_SECONDS = float(os.environ.get("METRICS_EVENT_LOOP_LAG_INTERVAL_SECONDS", 0.5))
+# Directory shared by the processes of a server (the workers of serve.py, which sets it): each dumps its metrics there
+# and GET /metrics of any of them merges all; empty serves the metrics of this process only
+METRICS_DIR = os.environ.get("METRICS_DIR", "")
+# Interval at which a process dumps its metrics into METRICS_DIR
+METRICS_DUMP_INTERVAL_SECONDS = float(os.environ.get("METRICS_DUMP_INTERVAL_SECONDS", 1))
+
+# Bucket bounds in seconds: from a cache lookup to a long video's download
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60)
+# Stages of the pipeline traces (pipeline.py), whose series exist from the start
+PIPELINE_STAGES = ('receive', 'download', 'result lookup', 'feature cache', 'decode', 'log-mel', 'model', 'impact',
+                   'storage upload', 'db write')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for (name, value) in zip(names, escaped)) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A monotonically increasing value per combination of label values"""
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple, float] = {} if self.labels else {(): 0}
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        for (values, value) in list(self._values.items()):
+            yield self.name, _labels(self.labels, values), value
+
+    def dump(self):
+        return [[list(values), value] for (values, value) in list(self._values.items())]
+
+    def merged_samples(self, dumps):
+        """Samples of the sums over the dumps of all processes, finished ones included"""
+        merged = {}
+        for (pid, alive, dump) in dumps:
+            for (values, value) in dump:
+                merged[tuple(values)] = merged.get(tuple(values), 0) + value
+        for (values, value) in merged.items():
+            yield self.name, _labels(self.labels, values), value
+
+
+class Gauge:
+    """A value that goes up and down, or that fn reads when the metrics are scraped"""
+    kind = 'gauge'
+
+    def __init__(self, name, description, fn: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.description = description
+        self.fn = fn
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def samples(self):
+        if self.fn is None:
+            yield self.name, '', self.value
+            return
+        try:
+            yield self.name, '', self.fn()
+        except Exception as e:
+            logger.warning(f"Failed to read gauge {self.name}: {str(e)}")
+
+    def dump(self):
+        return [value for (_, _, value) in self.samples()]
+
+    def merged_samples(self, dumps):
+        """A sample per running process, labelled with its pid: values of different processes don't add up"""
+        for (pid, alive, dump) in dumps:
+            if alive:
+                for value in dump:
+                    yield self.name, _labels(('pid',), (pid,)), value
+
+
+class _HistogramSeries:
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self, buckets):
+        self.counts = [0] * (buckets + 1)  # per bucket, not cumulative; the last one is +Inf
+        self.sum = 0.0
+
+
+class Histogram:
+    """
+    Counts of observations per bucket (value <= bound) per combination of label values. The buckets of a series are
+    allocated when it is created, those of label_values up front, so an observation is a bisection and two additions.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS, labels=(), label_values=()):
+        self.name = name
+        self.description = description
+        self.bounds = tuple(sorted(buckets))
+        self.labels = tuple(labels)
+        if not self.labels:
+            label_values = [()]
+        self._series: Dict[Tuple, _HistogramSeries] = {
+            tuple(values): _HistogramSeries(len(self.bounds)) for values in label_values}
+
+    def observe(self, value, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = _HistogramSeries(len(self.bounds))
+        series.counts[bisect_left(self.bounds, value)] += 1
+        series.sum += value
+
+    def samples(self):
+        return self._samples(list(self._series.items()))
+
+    def dump(self):
+        return [[list(values), list(series.counts), series.sum] for (values, series) in list(self._series.items())]
+
+    def merged_samples(self, dumps):
+        """Samples of the sums over the dumps of all processes, finished ones included"""
+        merged: Dict[Tuple, _HistogramSeries] = {}
+        for (pid, alive, dump) in dumps:
+            for (values, counts, total) in dump:
+                series = merged.get(tuple(values))
+                if series is None:
+                    series = merged[tuple(values)] = _HistogramSeries(len(self.bounds))
+                series.counts = [a + b for (a, b) in zip(series.counts, counts)]
+                series.sum += total
+        return self._samples(merged.items())
+
+    def _samples(self, series_items):
+        for (values, series) in series_items:
+            cumulative = 0
+            for (bound, count) in zip(self.bounds + (float('inf'),), list(series.counts)):
+                cumulative += count
+                yield f"{self.name}_bucket", _labels(self.labels + ('le',), values + (_number(bound),)), cumulative
+            yield f"{self.name}_sum", _labels(self.labels, values), series.sum
+            yield f"{self.name}_count", _labels(self.labels, values), cumulative
+
+
+class MetricsRegistry:
+    """
+    Metrics in the Prometheus text format. They are updated without locks: the server updates them from its event
+    loop only, and renders them there too.
+    Processes sharing a directory dump their metrics into it (<pid>.json), and render the merge of all the dumps:
+    counters and histograms summed over the processes, those that exited included so that the sums never go down,
+    and a gauge per running process.
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self, directory=METRICS_DIR) -> str:
+        dumps = None
+        if directory:
+            self.dump(directory)
+            dumps = read_dumps(directory)
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            samples = metric.samples() if dumps is None else \
+                metric.merged_samples([(pid, alive, dump.get(metric.name, [])) for (pid, alive, dump) in dumps])
+            lines.extend(f"{name}{labels} {_number(value)}" for (name, labels, value) in samples)
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, directory=METRICS_DIR):
+        """Replace this process's dump in directory at once, so other processes never read half of it"""
+        path = os.path.join(directory, f"{os.getpid()}.json")
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump({metric.name: metric.dump() for metric in self.metrics}, f)
+        os.replace(f"{path}.tmp", path)
+
+
+def read_dumps(directory) -> List[Tuple[int, bool, dict]]:
+    """The pid, whether it still runs, and the metrics of every process that dumped its metrics into directory"""
+    dumps = []
+    for file_name in os.listdir(directory):
+        (pid, extension) = os.path.splitext(file_name)
+        if extension != '.json' or not pid.isdigit():
+            continue
+        try:
+            with open(os.path.join(directory, file_name)) as f:
+                dumps.append((int(pid), process_alive(int(pid)), json.load(f)))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to read metrics dump {file_name}: {str(e)}")
+    return dumps
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def resident_memory_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+# The metrics of this process, served by GET /metrics
+registry = MetricsRegistry()
+
+http_requests = registry.register(Counter(
+    'sed_http_requests_total', 'HTTP requests by method, route and status code', ('method', 'route', 'status')))
+http_request_seconds = registry.register(Histogram(
+    'sed_http_request_duration_seconds', 'HTTP request latency by method and route', labels=('method', 'route')))
+http_requests_in_flight = registry.register(Gauge(
+    'sed_http_requests_in_flight', 'HTTP requests being served'))
+stage_seconds = registry.register(Histogram(
+    'sed_pipeline_stage_seconds', 'Time of the pipeline stages of requests and tasks', labels=('stage',),
+    label_values=[(stage,) for stage in PIPELINE_STAGES]))
+audio_seconds = registry.register(Counter(
+    'sed_audio_seconds_total', 'Seconds of audio run through the model'))
+inference_batch_size = registry.register(Histogram(
+    'sed_inference_batch_size', 'Inputs (requests or windows) per forward pass', buckets=(1, 2, 4, 8, 16, 32, 64)))
+inference_batch_seconds = registry.register(Histogram(
+    'sed_inference_batch_seconds', 'Time of a batched forward pass'))
+task_queue_depth = registry.register(Gauge(
+    'sed_task_queue_depth', 'Tasks waiting in the local task queue'))
+task_queue_in_flight = registry.register(Gauge(
+    'sed_task_queue_in_flight', 'Tasks of the local task queue being processed'))
+task_queue_wait_seconds = registry.register(Histogram(
+    'sed_task_queue_wait_seconds', 'Time tasks waited in the local task queue'))
+event_loop_lag_seconds = registry.register(Histogram(
+    'sed_event_loop_lag_seconds', 'How late the event loop woke up a sleeping coroutine',
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)))
+resident_memory = registry.register(Gauge(
+    'process_resident_memory_bytes', 'Resident memory of this process (not of its decoding processes)',
+    resident_memory_bytes))
+
+
+def observe_trace(trace):
+    """Add the time of every stage a PipelineTrace recorded (skipped stages aside) to stage_seconds"""
+    for record in trace.records:
+        if 'seconds' in record:
+            stage_seconds.observe(record['seconds'], record['stage'])
+
+
+async def dump_periodically(directory=METRICS_DIR, interval=METRICS_DUMP_INTERVAL_SECONDS):
+    """Dump the metrics of this process into directory every interval seconds, until cancelled"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            registry.dump(directory)
+        except OSError as e:
+            logger.warning(f"Failed to dump metrics into {directory}: {str(e)}")
+
+
+async def probe_event_loop_lag(interval=EVENT_LOOP_LAG_INTERVAL_SECONDS):
+    """Observe how late the event loop wakes up a coroutine sleeping for interval seconds, until cancelled"""
+    while True:
+        started_at = time.perf_counter()
+        await asyncio.sleep(interval)
+        event_loop_lag_seconds.observe(max(0.0, time.perf_counter() - started_at - interval))
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware counting and timing HTTP requests by route template (e.g. /tasks/{task_id}), so that ids don't
+    become series of their own
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        status_code = 500  # unless a response starts
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        http_requests_in_flight.inc()
+        started_at = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            seconds = time.perf_counter() - started_at
+            http_requests_in_flight.dec()
+            route = getattr(scope.get('route'), 'path', 'unmatched')
+            http_requests.inc(scope['method'], route, status_code)
+            http_request_seconds.observe(seconds, scope['method'], route)
@@ -0,0 +1,337 @@
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import numpy as np
+
+from inference_backend import WARMUP, load_inference_model
+from inference_engine import BatchingInferenceEngine, InferenceResult
+from models.checkpoints import load_checkpoints
+from utils.startup_profiler import startup_profiler
+
+logger = logging.getLogger(__name__)
+
+# Directory of trainer checkpoints (iteration_<n>.pth) whose newest checkpoint is served and which is watched for
+# newer ones; empty serves MODEL_CHECKPOINT only
+MODEL_DIR = os.environ.get("MODEL_DIR", "")
+MODEL_CHECKPOINT = os.environ.get("MODEL_CHECKPOINT", "model_checkpoint.pt")
+MODEL_POLL_SECONDS = float(os.environ.get("MODEL_POLL_SECONDS", 30))
+# A checkpoint modified more recently than this may still be being written, it is left for a later poll
+MODEL_SETTLE_SECONDS = float(os.environ.get("MODEL_SETTLE_SECONDS", 10))
+# Percentage of requests routed to a newly loaded version (the candidate) until it is promoted through
+# POST /models/promote; 0 swaps new versions in as soon as they are warmed up
+MODEL_CANARY_PERCENT = float(os.environ.get("MODEL_CANARY_PERCENT", 0))
+# Run the active model on canary requests too, to compare the candidate's impact times with it
+MODEL_CANARY_COMPARE = os.environ.get("MODEL_CANARY_COMPARE", "true").lower() == "true"
+# File recording the promoted and rejected checkpoints, which every process serving MODEL_DIR (e.g. the workers of
+# serve.py) applies at its next poll; model_state.json in MODEL_DIR if unset
+MODEL_STATE_PATH = os.environ.get("MODEL_STATE_PATH", "")
+
+
+def newest_checkpoint(model_dir) -> Optional[str]:
+    checkpoints = load_checkpoints(model_dir) if os.path.isdir(model_dir) else []
+    return os.path.join(model_dir, checkpoints[-1]) if checkpoints else None
+
+
+def served_checkpoint(model_dir=MODEL_DIR, checkpoint_path=MODEL_CHECKPOINT):
+    """The checkpoint served at startup: the newest of model_dir, checkpoint_path without one"""
+    return (newest_checkpoint(model_dir) if model_dir else None) or checkpoint_path
+
+
+def read_model_state(path) -> dict:
+    """The checkpoint promoted last ('active', None before any decision) and the rejected ones recorded at path"""
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        state = {}
+    return {'active': state.get('active'), 'rejected': state.get('rejected', [])}
+
+
+def write_model_state(path, state):
+    """Replace the state at path at once, so processes polling it never read half of it"""
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(temp_path, path)
+
+
+class ServedModel:
+    """A loaded checkpoint with its batching engine, and the requests it served"""
+    def __init__(self, checkpoint_path, model, version, engine, load_seconds, history=1000):
+        self.checkpoint_path = checkpoint_path
+        self.model = model                # InferenceBackend
+        self.version = version
+        self.engine = engine              # BatchingInferenceEngine of model
+        self.load_seconds = load_seconds  # loading and warm-up
+        self.loaded_at = time.time()
+        self.in_flight = 0
+        self.retired = False              # no new requests are routed to it, stopped once in_flight drops to 0
+        self.requests = 0
+        self.failures = 0
+        self.latencies = deque(maxlen=history)
+        self.impact_differences = deque(maxlen=history)  # impact time minus the active model's, as a candidate
+
+    async def infer(self, log_mel_features) -> InferenceResult:
+        started_at = time.perf_counter()
+        try:
+            result = await self.engine.infer(log_mel_features)
+        except Exception:
+            self.failures += 1
+            raise
+        self.requests += 1
+        self.latencies.append(time.perf_counter() - started_at)
+        return result
+
+    def stats(self):
+        latencies_ms = np.array(self.latencies) * 1000
+        differences_ms = np.abs(np.array(self.impact_differences)) * 1000
+        return {
+            'version': self.version,
+            'checkpoint': self.checkpoint_path,
+            'loaded_at': self.loaded_at,
+            'load_seconds': self.load_seconds,
+            'in_flight': self.in_flight,
+            'requests': self.requests,
+            'failures': self.failures,
+            'latency_ms_p50': float(np.percentile(latencies_ms, 50)) if len(latencies_ms) else None,
+            'latency_ms_p95': float(np.percentile(latencies_ms, 95)) if len(latencies_ms) else None,
+            'compared': len(differences_ms),
+            'impact_difference_ms_mean': float(differences_ms.mean()) if len(differences_ms) else None,
+            'impact_difference_ms_p95': float(np.percentile(differences_ms, 95)) if len(differences_ms) else None,
+        }
+
+
+class ModelRegistry:
+    """
+    The model versions served: the active one and, with MODEL_CANARY_PERCENT, a candidate that gets that share of
+    the requests. With MODEL_DIR the directory is polled for a newer checkpoint, which is loaded and warmed up in the
+    background and swapped in (or made the candidate) between two requests. Requests hold the version they were
+    routed to (serving), so a replaced version keeps its engine until its in-flight requests are done.
+    Promotions and rejections are recorded at state_path and applied by every registry polling the directory, so
+    all the processes serving it route to the same versions.
+    """
+    def __init__(self, executors, device, detect_impact_time, model_dir=MODEL_DIR, checkpoint_path=MODEL_CHECKPOINT,
+                 poll_seconds=MODEL_POLL_SECONDS, settle_seconds=MODEL_SETTLE_SECONDS,
+                 canary_percent=MODEL_CANARY_PERCENT, canary_compare=MODEL_CANARY_COMPARE,
+                 state_path=MODEL_STATE_PATH):
+        if not 0 <= canary_percent <= 100:
+            raise ValueError(f"Canary percentage must be between 0 and 100, {canary_percent} given")
+        self.executors = executors
+        self.device = device
+        self.detect_impact_time = detect_impact_time
+        self.model_dir = model_dir
+        self.checkpoint_path = checkpoint_path
+        self.poll_seconds = poll_seconds
+        self.settle_seconds = settle_seconds
+        self.canary_percent = canary_percent
+        self.canary_compare = canary_compare
+        self.state_path = (state_path or os.path.join(model_dir, 'model_state.json')) if model_dir else ''
+        self.active: Optional[ServedModel] = None
+        self.candidate: Optional[ServedModel] = None
+        self._retiring = set()
+        self._seen = {}  # path -> modification time of every checkpoint loaded or tried, so it is tried only once
+        self._watcher: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self.model_dir and os.environ.get("MODEL_VERSION"):
+            raise ValueError("MODEL_VERSION would name every checkpoint of MODEL_DIR the same, unset it")
+        checkpoint_path = served_checkpoint(self.model_dir, self.checkpoint_path)
+        if self.model_dir:
+            promoted = self._read_state()['active']
+            if self.canary_percent > 0 and promoted is not None and os.path.exists(promoted):
+                # E.g. restarted while other processes serve the promoted version: start on it, a newer checkpoint
+                # becomes the candidate at the first poll
+                checkpoint_path = promoted
+            self._seen[checkpoint_path] = os.path.getmtime(checkpoint_path) if os.path.exists(checkpoint_path) else None
+        # Nothing is served yet, so warm up on the model executor, whose threads run the forward passes
+        self.active = await self._load(checkpoint_path, self.executors.run_model)
+        logger.info(f"Serving model version {self.active.version} from {checkpoint_path}")
+        if self.model_dir:
+            self._watcher = asyncio.create_task(self._watch())
+            logger.info(f"Watching {self.model_dir} for new checkpoints every {self.poll_seconds:g}s, "
+                        f"canary {self.canary_percent:g}%")
+
+    async def stop(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            try:
+                await self._watcher
+            except asyncio.CancelledError:
+                pass
+            self._watcher = None
+        for served in [self.active, self.candidate, *self._retiring]:
+            if served is not None:
+                await served.engine.stop()
+
+    def route(self) -> ServedModel:
+        if self.candidate is not None and random.random() * 100 < self.canary_percent:
+            return self.candidate
+        return self.active
+
+    def serving(self):
+        """Context of a request holding the version it is routed to, which stays loaded until the context exits"""
+        return self._hold(self.route())
+
+    async def infer(self, served: ServedModel, log_mel_features) -> InferenceResult:
+        """Result of a request on the version it was routed to; canary requests run on the active version too"""
+        if not self.canary_compare or served is not self.candidate:
+            return await served.infer(log_mel_features)
+        async with self._hold(self.active) as active:
+            (result, baseline) = await asyncio.gather(served.infer(log_mel_features), active.infer(log_mel_features),
+                                                      return_exceptions=True)
+        if isinstance(result, BaseException):
+            raise result
+        if isinstance(baseline, BaseException):
+            logger.warning(f"Comparison run of version {active.version} failed: {str(baseline)}")
+        else:
+            served.impact_differences.append(result.impact_time - baseline.impact_time)
+        return result
+
+    async def promote(self) -> ServedModel:
+        """
+        Make the candidate the active version, here and in every process serving the directory. ValueError without one.
+        """
+        if self.candidate is None:
+            raise ValueError("There is no candidate version")
+        self._record(active=self.candidate.checkpoint_path)
+        return await self._promote()
+
+    async def reject(self) -> ServedModel:
+        """
+        Stop routing requests to the candidate, here and in every process serving the directory; its checkpoint is
+        not loaded again. ValueError without one.
+        """
+        if self.candidate is None:
+            raise ValueError("There is no candidate version")
+        self._record(active=self.active.checkpoint_path, rejected=self.candidate.checkpoint_path)
+        return await self._reject()
+
+    async def sync(self, state=None):
+        """Apply a promotion or rejection of the candidate another process recorded"""
+        if self.candidate is None or not self.state_path:
+            return
+        state = state or self._read_state()
+        if state['active'] == self.candidate.checkpoint_path:
+            await self._promote()
+        elif self.candidate.checkpoint_path in state['rejected']:
+            await self._reject()
+
+    async def _promote(self):
+        (previous, self.active, self.candidate) = (self.active, self.candidate, None)
+        await self._retire(previous)
+        logger.info(f"Promoted version {self.active.version}, replacing {previous.version}")
+        return self.active
+
+    async def _reject(self):
+        (rejected, self.candidate) = (self.candidate, None)
+        await self._retire(rejected)
+        logger.info(f"Rejected candidate version {rejected.version}")
+        return rejected
+
+    def _read_state(self):
+        return read_model_state(self.state_path) if self.state_path else {'active': None, 'rejected': []}
+
+    def _record(self, active, rejected=None):
+        if not self.state_path:
+            return
+        state = self._read_state()
+        state['active'] = active
+        if rejected is not None and rejected not in state['rejected']:
+            state['rejected'].append(rejected)
+        write_model_state(self.state_path, state)
+
+    def stats(self):
+        return {
+            'model_dir': self.model_dir or None,
+            'canary_percent': self.canary_percent,
+            'active': self.active.stats() if self.active is not None else None,
+            'candidate': self.candidate.stats() if self.candidate is not None else None,
+            'retiring': [served.stats() for served in self._retiring],
+        }
+
+    async def poll(self, state=None):
+        """Load the newest checkpoint of the directory if it is new, done being written and not rejected"""
+        checkpoint_path = newest_checkpoint(self.model_dir)
+        if checkpoint_path is None:
+            return
+        modified_at = os.path.getmtime(checkpoint_path)
+        if self._seen.get(checkpoint_path) == modified_at or time.time() - modified_at < self.settle_seconds:
+            return
+        self._seen[checkpoint_path] = modified_at
+        if checkpoint_path in (state or self._read_state())['rejected']:
+            logger.info(f"Checkpoint {checkpoint_path} was rejected, it is not loaded")
+            return
+        try:
+            # Requests keep running on the model executor while this one warms up on an io thread
+            served = await self._load(checkpoint_path, self.executors.run_io)
+        except Exception as e:
+            logger.error(f"Failed to load checkpoint {checkpoint_path}: {str(e)}")
+            return
+        if served.version in [self.active.version, getattr(self.candidate, 'version', None)]:
+            logger.info(f"Checkpoint {checkpoint_path} is version {served.version}, which is already served")
+            await served.engine.stop()
+            return
+        await self._install(served)
+
+    async def _install(self, served):
+        if self.canary_percent > 0:
+            if self.candidate is not None:
+                await self._retire(self.candidate)
+            self.candidate = served
+            logger.info(f"Version {served.version} is the candidate for {self.canary_percent:g}% of the requests")
+        else:
+            (previous, self.active) = (self.active, served)
+            await self._retire(previous)
+            logger.info(f"Swapped in version {served.version}, replacing {previous.version}")
+
+    async def _load(self, checkpoint_path, run_warm_up) -> ServedModel:
+        started_at = time.perf_counter()
+        with startup_profiler.phase('load'):
+            (model, version) = await self.executors.run_io(load_inference_model, checkpoint_path, self.device)
+        if WARMUP:
+            with startup_profiler.phase('warm-up'):
+                await run_warm_up(model.warm_up)
+        engine = BatchingInferenceEngine(model, self.device, self.detect_impact_time,
+                                         executor=self.executors.model_executor)
+        await engine.start()
+        load_seconds = time.perf_counter() - started_at
+        logger.info(f"Loaded version {version} from {checkpoint_path} in {load_seconds:.1f}s")
+        return ServedModel(checkpoint_path, model, version, engine, load_seconds)
+
+    async def _retire(self, served):
+        served.retired = True
+        self._retiring.add(served)
+        if served.in_flight == 0:
+            await self._stop_retired(served)
+
+    async def _stop_retired(self, served):
+        self._retiring.discard(served)
+        await served.engine.stop()
+        logger.info(f"Version {served.version} unloaded")
+
+    @asynccontextmanager
+    async def _hold(self, served):
+        served.in_flight += 1
+        try:
+            yield served
+        finally:
+            served.in_flight -= 1
+            if served.retired and served.in_flight == 0 and served in self._retiring:
+                await self._stop_retired(served)
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.poll_seconds)
+            try:
+                state = self._read_state()
+                await self.poll(state)
+                await self.sync(state)
+            except Exception as e:
+                logger.error(f"Polling {self.model_dir} failed: {str(e)}")
@@ -1,4 +1,5 @@
 import pdb
+from typing import Optional
 
 import numpy as np
 import torch
@@ -10,7 +11,16 @@ from models.spectogram_models import ConvBlock
 from utils.common import count_parameters, human_format
 
 class DcaseNet_v3(nn.Module):
-    def __init__(self, class_num=1, pool_type='avg', pool_size=(2,2)):
+    # Input frames before and after the two frames of a GRU time step that its conv features depend on
+    # (six 3x3 convolutions, time pooled by 2 after the first two)
+    CONV_CONTEXT_FRAMES = 10
+    CONV_LOOKAHEAD_FRAMES = 10
+
+    def __init__(self, class_num=1, pool_type='avg', pool_size=(2,2), causal=False):
+        '''
+        causal: a unidirectional GRU, so outputs depend only on the past and CONV_LOOKAHEAD_FRAMES of the future
+            and can be computed on live audio (see live_detection.py)
+        '''
         super().__init__()
 
         #####
@@ -18,6 +28,13 @@ class DcaseNet_v3(nn.Module):
         #####
         self.pool_type = pool_type
         self.pool_size = pool_size
+        self.causal = causal
+        # Input frames per output step: 1 repeats the outputs of the GRU time steps to the frame rate of the input,
+        # 2 (optimize_for_inference) leaves them at the rate of the time steps
+        self.frame_rate_factor = 1
+        # Conv blocks zero the padding of padded batches; False for conv blocks that can't (int8), whose padded
+        # batches run one sample at a time
+        self.masks_padding = True
         
         self.conv_block1 = ConvBlock(in_channels=2, out_channels=64)
         self.conv_block2 = ConvBlock(in_channels=64, out_channels=128, pool_size=(2, 1))
@@ -25,7 +42,11 @@ class DcaseNet_v3(nn.Module):
         # self.conv_block4_1 = ConvBlock(in_channels=256, out_channels=256)
         # self.conv_block4_2 = ConvBlock(in_channels=256, out_channels=256)
 
-        self.gru_2 = nn.GRU(input_size=128, hidden_size=64, num_layers=1, batch_first=True, bidirectional=True)
+        if causal:
+            # Same output width for event_fc as the bidirectional GRU
+            self.gru_2 = nn.GRU(input_size=128, hidden_size=128, num_layers=1, batch_first=True, bidirectional=False)
+        else:
+            self.gru_2 = nn.GRU(input_size=128, hidden_size=64, num_layers=1, batch_first=True, bidirectional=True)
         self.event_fc = nn.Linear(128, class_num, bias=True)
 
         #####
@@ -37,16 +58,78 @@ class DcaseNet_v3(nn.Module):
         init_gru(self.gru_2)
         init_layer(self.event_fc)
 
-    def forward(self, x):
-        d_return = {}   # dictionary to return
+    def forward(self, x, lengths: Optional[torch.Tensor] = None):
+        '''
+        Input: (batch_size, channels_num, times_steps, mel_bins)
+        lengths: optional (batch_size,) number of valid time steps per sample when x is a zero padded batch; the
+            output of every sample is then the output it has on its own
+        '''
+        if lengths is None:
+            (x_2, _) = self.gru_2(self.embed(x))
+            return self.event_output(x_2)
+        if not self.masks_padding:
+            return self.forward_each(x, lengths)
+        x = self.embed(x, lengths)
+        # Pack the padded batch so the backward direction of the GRU starts at each sample's real last frame
+        seq_lengths = torch.div(lengths, 2, rounding_mode='floor').clamp(min=1).cpu()
+        packed = nn.utils.rnn.pack_padded_sequence(x, seq_lengths, batch_first=True, enforce_sorted=False)
+        (x_2, _) = self.gru_2(packed)
+        (x_2, _) = nn.utils.rnn.pad_packed_sequence(x_2, batch_first=True, total_length=x.shape[1])
+        return self.event_output(x_2)
+
+    def forward_each(self, x, lengths: torch.Tensor):
+        '''
+        forward of a padded batch one sample at a time, for conv blocks that take no time mask (int8, see
+        models/quantization.py); outputs past a sample's length are zero
+        '''
+        outputs = []
+        for i in range(x.shape[0]):
+            (x_2, _) = self.gru_2(self.embed(x[i:i + 1, :, :int(lengths[i])]))
+            outputs.append(self.event_output(x_2))
+        output = x.new_zeros((x.shape[0], self.output_length(x.shape[2]), outputs[0].shape[2]))
+        for i in range(x.shape[0]):
+            output[i, :outputs[i].shape[1]] = outputs[i][0]
+        return output
+
+    def event_output(self, x_2):
+        out_SED = x_2
+        #out_SED = self.layer_SED(x)
+        out_SED = torch.sigmoid(self.event_fc(out_SED))
+        if self.frame_rate_factor == 1:
+            out_SED = out_SED.repeat_interleave(repeats=2, dim=1)
+        return out_SED
+
+    def forward_steps(self, x, hidden=None):
+        '''
+        Causal model only: outputs (batch_size, steps, class_num) of GRU time steps (two frames each) continuing a
+        sequence from its GRU state hidden, and the new state
+        x: (batch_size, steps, 128) features from embed
+        '''
+        assert self.causal, "Only a causal model can be run step by step"
+        (x_2, hidden) = self.gru_2(x, hidden)
+        return torch.sigmoid(self.event_fc(x_2)), hidden
+
+    def embed(self, x, lengths: Optional[torch.Tensor] = None):
+        '''
+        Conv features of the GRU time steps, (batch_size, times_steps // 2, 128)
+        lengths: as in forward; the features of the padded time steps are then zero
+        '''
         #x: (#bs, #ch, #seq, #mel)
         x = x.transpose(2, 3)
 
         #x: (#bs, #ch, #mel, #seq)
         #forward frame-level
-        x = self.conv_block1(x)
-        x = self.conv_block2(x)
-        x = self.conv_block3(x)
+        if lengths is None:
+            x = self.conv_block1(x)
+            x = self.conv_block2(x)
+            x = self.conv_block3(x)
+        else:
+            x = self.conv_block1(x, time_mask(lengths, x))
+            # Time is pooled by 2 in conv_block1 only; the odd last frame is dropped, as in a forward pass of its own
+            steps_mask = time_mask(torch.div(lengths, 2, rounding_mode='floor'), x)
+            x = self.conv_block2(x, steps_mask)
+            x = self.conv_block3(x, steps_mask)
+            x = x * steps_mask
         # x = self.conv_block4_1(x)   #common branch
         # x_2 = self.conv_block4_2(x, self.pool_type, pool_size=(2, 2))   #task specific branch
         #x: (#bs, #filt, #mel, #seq)
@@ -59,18 +142,20 @@ class DcaseNet_v3(nn.Module):
         #x: (#bs, #filt,#seq)
         x = x.transpose(1,2)
         #x: (#bs, #seq, #filt)
-        (x_2, _) = self.gru_2(x)
-        
-
-        out_SED = x_2
-        #out_SED = self.layer_SED(x)
-        out_SED = torch.sigmoid(self.event_fc(out_SED))
-        out_SED = out_SED.repeat_interleave(repeats=2, dim=1)
-        return out_SED
+        return x
     
+    def output_length(self, input_length: int) -> int:
+        '''
+        Number of outputs produced for an input of input_length frames (time is pooled by 2 in conv_block1),
+        each for frame_rate_factor frames
+        '''
+        return (input_length // 2) * 2 // self.frame_rate_factor
+
     def model_description(self):
         print(f"DcaseNet_v3 has {human_format(count_parameters(self))} parameters")
 
 
-if __name__ == '__main__':
-    pass
\ No newline at end of file
+def time_mask(lengths: torch.Tensor, x: torch.Tensor) -> torch.Tensor:
+    '''(batch_size, 1, 1, times_steps) mask of the first lengths time steps of every sample of x (#bs, #filt, #mel, #seq)'''
+    steps = torch.arange(x.shape[3], device=x.device)
+    return (steps[None, :] < lengths.to(x.device)[:, None]).to(x.dtype)[:, None, None, :]
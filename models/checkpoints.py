@@ -0,0 +1,86 @@
+import os
+import re
+import hashlib
+import logging
+
+import torch
+
+from models.DcaseNet import DcaseNet_v3
+
+logger = logging.getLogger(__name__)
+
+# Checkpoints written by trainer.train, e.g. iteration_12000.pth
+epoch_regex = re.compile(r'.*_(\d+)\.pth(\.tar)?')
+
+
+def load_checkpoint(checkpoint_path, device='cpu'):
+    """
+    The contents of a checkpoint, memory-mapped: tensors are read from the file as they are used, so the optimizer
+    state of a training checkpoint is never read. Only tensors and plain values are loaded, no pickled objects.
+    """
+    return torch.load(checkpoint_path, map_location=device, mmap=True, weights_only=True)
+
+
+def load_dcasenet(checkpoint_path, device):
+    """
+    Build a DcaseNet_v3 in eval mode from a checkpoint written by trainer.train or export_inference_checkpoint.py;
+    causal (train.py --causal) when its GRU has no reverse direction
+    """
+    if not os.path.exists(checkpoint_path):
+        error_msg = f"Model checkpoint not found at {checkpoint_path}"
+        logger.error(error_msg)
+        raise RuntimeError(error_msg)
+
+    checkpoint = load_checkpoint(checkpoint_path, device)
+    causal = not any(key.endswith('_reverse') for key in checkpoint['model'])
+    # Copied out of the file's mapping, so the model doesn't depend on the file once loaded
+    model = DcaseNet_v3(1, causal=causal).to(device)
+    model.load_state_dict(checkpoint['model'])
+    model.eval()
+    logger.info(f"Model loaded successfully from {checkpoint_path}")
+    return model
+
+
+def checkpoint_version(checkpoint_path):
+    """
+    Identity of the weights in a checkpoint: MODEL_VERSION if set, otherwise a prefix of the file's SHA-256, or of the
+    file an inference checkpoint was written from. Stored with every result so results of another checkpoint are
+    never reused.
+    """
+    if os.environ.get("MODEL_VERSION"):
+        return os.environ["MODEL_VERSION"]
+    source_version = load_checkpoint(checkpoint_path).get('source_version')
+    if source_version:
+        return source_version
+    digest = hashlib.sha256()
+    with open(checkpoint_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def inference_checkpoint_path(checkpoint_path):
+    return f"{os.path.splitext(checkpoint_path)[0]}-inference.pt"
+
+
+def save_inference_checkpoint(model, path, source_version):
+    """
+    Write the weights of a model alone, without the optimizer state of a training checkpoint, for load_dcasenet.
+    It keeps the version of the checkpoint they came from, so results of either are reused for the other.
+    """
+    state_dict = {key: tensor.detach().cpu().contiguous() for (key, tensor) in model.state_dict().items()}
+    torch.save({'model': state_dict, 'source_version': source_version}, path)
+
+
+def get_epoch(path):
+    matches = epoch_regex.match(path)
+    if matches is not None:
+        return int(matches.group(1))
+    return 0
+
+
+def load_checkpoints(path):
+    """File names of the checkpoints in a directory, oldest (lowest iteration) first"""
+    checkpoints = list(filter(lambda p: epoch_regex.match(p), os.listdir(path)))
+    checkpoints.sort(key=get_epoch)
+    return checkpoints
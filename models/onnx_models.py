@@ -0,0 +1,136 @@
+import os
+import logging
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from dataset.spectogram import spectogram_configs as cfg
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+logger = logging.getLogger(__name__)
+
+# Model served by INFERENCE_BACKEND=onnx, written by export_onnx.py; the checkpoint path with .onnx by default
+MODEL_ONNX = os.environ.get("MODEL_ONNX", "")
+# ONNX Runtime intra-op threads, 0 for its default
+ONNX_THREADS = int(os.environ.get("ONNX_THREADS", 0))
+
+INPUT_NAME = 'log_mel'
+OUTPUT_NAME = 'event'
+
+
+def onnx_path(checkpoint_path):
+    return f"{os.path.splitext(checkpoint_path)[0]}.onnx"
+
+
+class _Probabilities(nn.Module):
+    """The probabilities output of a model, which is what the server uses, as its only forward"""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        if hasattr(self.model, 'logits'):
+            return self.model.logits(x)  # Cnn_AvgPooling: sigmoid of forward
+        return self.model(x)
+
+
+def export_onnx(model, path, frames_per_output, source_version, opset=17):
+    """
+    Export a DcaseNet_v3 or Cnn_AvgPooling to ONNX, with dynamic batch and time axes.
+    Padded batches are exported without lengths (ONNX has no packed sequences); OnnxModel runs their samples
+    one by one instead.
+        frames_per_output: input frames per output step (the time pooling), which gives output_length
+        source_version: checkpoint_version of the weights, the version of the served results
+    """
+    import onnx
+
+    model = model.cpu().eval()
+    example = torch.zeros(1, cfg.audio_channels, 8 * frames_per_output, cfg.mel_bins)
+    torch.onnx.export(_Probabilities(model), (example,), path, input_names=[INPUT_NAME], output_names=[OUTPUT_NAME],
+                      opset_version=opset, dynamo=False,
+                      dynamic_axes={INPUT_NAME: {0: 'batch', 2: 'frames'}, OUTPUT_NAME: {0: 'batch', 1: 'output_frames'}})
+
+    exported = onnx.load(path)
+    metadata = {'model_class': type(model).__name__,
+                'frames_per_output': str(frames_per_output),
+                'causal': str(getattr(model, 'causal', False)),
+                'frame_rate_factor': str(getattr(model, 'frame_rate_factor', 1)),
+                'source_version': source_version}
+    for (key, value) in metadata.items():
+        exported.metadata_props.add(key=key, value=value)
+    onnx.checker.check_model(exported)
+    onnx.save(exported, path)
+
+
+class OnnxModel:
+    """
+    A model exported by export_onnx.py, run by ONNX Runtime and called like the torch model (by forward_batch):
+    (batch_size, channels_num, frames, mel_bins) tensors in, (batch_size, output_frames, classes_num) tensors out
+    """
+    def __init__(self, path, threads=ONNX_THREADS):
+        if ort is None:
+            raise RuntimeError("ONNX models need onnxruntime (pip install onnxruntime)")
+        if not os.path.exists(path):
+            error_msg = f"ONNX model not found at {path}, run export_onnx.py"
+            logger.error(error_msg)
+            raise RuntimeError(error_msg)
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        providers = [provider for provider in ['CUDAExecutionProvider', 'CPUExecutionProvider']
+                     if provider in ort.get_available_providers()]
+        self.session = ort.InferenceSession(path, options, providers=providers)
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.model_class = metadata['model_class']
+        self.frames_per_output = int(metadata['frames_per_output'])
+        self.causal = metadata['causal'] == 'True'
+        self.frame_rate_factor = int(metadata.get('frame_rate_factor', 1))
+        self.version = metadata['source_version']
+        logger.info(f"ONNX model loaded from {path}: {self.model_class} of version {self.version}, "
+                    f"providers {self.session.get_providers()}")
+
+    def output_length(self, input_length):
+        return (input_length // self.frames_per_output) * self.frames_per_output // self.frame_rate_factor
+
+    def run(self, x: np.ndarray) -> np.ndarray:
+        return self.session.run([OUTPUT_NAME], {INPUT_NAME: np.ascontiguousarray(x, dtype=np.float32)})[0]
+
+    def __call__(self, x, lengths=None):
+        x = x.cpu().numpy() if isinstance(x, torch.Tensor) else x
+        if lengths is None or bool((lengths == x.shape[2]).all()):
+            return torch.from_numpy(self.run(x))
+        # Without packed sequences the padding would reach the GRU: run every sample at its own length
+        outputs = []
+        for (i, length) in enumerate(lengths.tolist()):
+            outputs.append(self.run(x[i:i + 1, :, :length]))
+        output = np.zeros((x.shape[0], self.output_length(x.shape[2]), outputs[0].shape[2]), dtype=np.float32)
+        for (i, sample_output) in enumerate(outputs):
+            output[i, :sample_output.shape[1]] = sample_output[0]
+        return torch.from_numpy(output)
+
+
+def load_onnx_dcasenet(path):
+    """The OnnxModel at path and the version of the checkpoint it was exported from"""
+    model = OnnxModel(path)
+    return model, model.version
+
+
+def onnx_parity(model, onnx_model, lengths, batch_size=2, seed=0):
+    """Largest per-frame output difference of an exported model to its torch model over random inputs of lengths"""
+    rng = np.random.default_rng(seed)
+    max_diff = 0.0
+    for length in lengths:
+        x = rng.standard_normal((batch_size, cfg.audio_channels, length, cfg.mel_bins)).astype(np.float32)
+        with torch.no_grad():
+            expected = _Probabilities(model.cpu().eval())(torch.from_numpy(x))
+        output = onnx_model(torch.from_numpy(x))
+        if output.shape != expected.shape:
+            raise ValueError(f"ONNX output shape {tuple(output.shape)} differs from {tuple(expected.shape)} "
+                             f"for {length} frames")
+        max_diff = max(max_diff, (output - expected).abs().max().item())
+    return max_diff
@@ -0,0 +1,89 @@
+import os
+import copy
+import logging
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from dataset.spectogram import spectogram_configs as cfg
+from models.DcaseNet import DcaseNet_v3
+from models.spectogram_models import ConvBlock
+
+logger = logging.getLogger(__name__)
+
+# Serve models through optimize_for_inference
+MODEL_OPTIMIZE = os.environ.get("MODEL_OPTIMIZE", "true").lower() == "true"
+# Compare an optimized model with the original on a random input when loading it, and refuse it if they differ
+MODEL_OPTIMIZE_VERIFY = os.environ.get("MODEL_OPTIMIZE_VERIFY", "true").lower() == "true"
+
+
+def fold_batch_norms(model):
+    """
+    Fold the batch norms of every ConvBlock into the convolutions before them, in place (eval mode only).
+    A folded block runs conv -> in-place ReLU twice; conv+ReLU fusion is left to backends that have it, e.g.
+    torch.jit.optimize_for_inference (INFERENCE_BACKEND=script) with MKLDNN or the int8 convolutions of quantize.py.
+    """
+    for module in model.modules():
+        if isinstance(module, ConvBlock) and not isinstance(module.bn1, nn.Identity):
+            module.conv1 = fuse_conv_bn_eval(module.conv1, module.bn1)
+            module.conv2 = fuse_conv_bn_eval(module.conv2, module.bn2)
+            module.bn1 = nn.Identity()
+            module.bn2 = nn.Identity()
+    return model
+
+
+def optimize_for_inference(model):
+    """
+    An inference copy of a model of ConvBlocks, e.g. DcaseNet_v3, with its batch norms folded into the convolutions.
+    A DcaseNet_v3 also stops repeating its outputs to the frame rate: they stay one per GRU time step and
+    frame_rate_factor (2) says how many input frames each stands for.
+    """
+    model = fold_batch_norms(copy.deepcopy(model).eval())
+    if isinstance(model, DcaseNet_v3):
+        model.frame_rate_factor = 2
+    return model
+
+
+def to_frame_rate(output, frame_rate_factor, dim=0):
+    """Outputs of a model repeated to one per input frame"""
+    if frame_rate_factor == 1:
+        return output
+    return output.repeat_interleave(repeats=frame_rate_factor, dim=dim)
+
+
+def verify_optimized(model, optimized, num_frames=240, tolerance=1e-4, device='cpu'):
+    """
+    Largest per-frame output difference of an optimized model to the original on a random input (a second by
+    default, as it runs at every startup); RuntimeError when it is above tolerance
+    """
+    rng = np.random.default_rng(0)
+    features = rng.standard_normal((2, cfg.audio_channels, num_frames, cfg.mel_bins)).astype(np.float32)
+    x = torch.from_numpy(features).to(device)
+    lengths = torch.tensor([num_frames, num_frames - num_frames // 4])
+    # A padded batch too, for models that take lengths
+    calls = [{}, {'lengths': lengths}] if isinstance(model, DcaseNet_v3) else [{}]
+    max_diff = 0.0
+    with torch.no_grad():
+        for kwargs in calls:
+            expected = to_frame_rate(model(x, **kwargs), getattr(model, 'frame_rate_factor', 1), dim=1)
+            output = to_frame_rate(optimized(x, **kwargs), getattr(optimized, 'frame_rate_factor', 1), dim=1)
+            if output.shape != expected.shape:
+                raise RuntimeError(f"Optimized model output shape {tuple(output.shape)} differs from "
+                                   f"{tuple(expected.shape)}")
+            max_diff = max(max_diff, (output - expected).abs().max().item())
+    if max_diff > tolerance:
+        raise RuntimeError(f"Optimized model differs from the original by {max_diff:.2e} (tolerance {tolerance})")
+    return max_diff
+
+
+def load_optimized(model, device='cpu', optimize=MODEL_OPTIMIZE, verify=MODEL_OPTIMIZE_VERIFY):
+    """The model to serve: optimize_for_inference(model), verified against it, unless MODEL_OPTIMIZE is off"""
+    if not optimize:
+        return model
+    optimized = optimize_for_inference(model)
+    if verify:
+        max_diff = verify_optimized(model, optimized, device=device)
+        logger.info(f"Optimized model verified: largest output difference {max_diff:.2e}")
+    return optimized
@@ -0,0 +1,158 @@
+import os
+import copy
+import logging
+from typing import List
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from dataset.spectogram import spectogram_configs as cfg
+from models.DcaseNet import DcaseNet_v3
+from models.checkpoints import checkpoint_version, load_dcasenet
+
+logger = logging.getLogger(__name__)
+
+# 'none' serves the fp32 checkpoint, 'int8' its quantized version written by quantize.py (CPU only)
+MODEL_QUANTIZATION = os.environ.get("MODEL_QUANTIZATION", "none").lower()
+QUANTIZATIONS = ['none', 'int8']
+# Quantized model served with MODEL_QUANTIZATION=int8; the checkpoint path with an -int8 suffix by default
+MODEL_QUANTIZED_CHECKPOINT = os.environ.get("MODEL_QUANTIZED_CHECKPOINT", "")
+# A quantized model is refused when, evaluated against its fp32 checkpoint by quantize.py, its mean AP dropped more
+# than this...
+QUANTIZATION_MAX_AP_DROP = float(os.environ.get("QUANTIZATION_MAX_AP_DROP", 0.02))
+# ...or the 95th percentile of its impact time differences is larger than this
+QUANTIZATION_MAX_IMPACT_ERROR_MS = float(os.environ.get("QUANTIZATION_MAX_IMPACT_ERROR_MS", 10))
+
+CONV_BLOCKS = ['conv_block1', 'conv_block2', 'conv_block3']
+
+
+def quantized_checkpoint_path(checkpoint_path):
+    (stem, extension) = os.path.splitext(checkpoint_path)
+    return f"{stem}-int8{extension}"
+
+
+def _fusable(block):
+    """A ConvBlock as a graph with its in-place ReLUs made out-of-place, which quantization fuses with the convs"""
+    # Without a time mask: padded batches of int8 models run one sample at a time (DcaseNet_v3.masks_padding)
+    graph_module = torch.fx.symbolic_trace(block, concrete_args={'time_mask': None})
+    for node in list(graph_module.graph.nodes):
+        if node.op == 'call_function' and node.target in (torch.relu_, F.relu_):
+            node.target = F.relu
+        elif node.op == 'call_function' and 'assert_is_none' in getattr(node.target, '__name__', ''):
+            # The check of the concrete time_mask, which prepare_fx can't trace again; then its input goes too
+            graph_module.graph.erase_node(node)
+    for node in list(graph_module.graph.nodes):
+        if node.op == 'placeholder' and node.target == 'time_mask' and not node.users:
+            graph_module.graph.erase_node(node)
+    graph_module.recompile()
+    return graph_module
+
+
+def prepare_int8(model, engine):
+    """
+    A copy of an fp32 DcaseNet_v3 with observers in its conv blocks; run it on calibration inputs, then convert_int8
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    qconfig_mapping = get_default_qconfig_mapping(engine)
+    # (batch_size, channels_num, mel_bins, times_steps), as the conv blocks see it
+    x = torch.zeros(1, cfg.audio_channels, cfg.mel_bins, 64)
+    with torch.no_grad():
+        for name in CONV_BLOCKS:
+            block = getattr(model, name)
+            setattr(model, name, prepare_fx(_fusable(block), qconfig_mapping, example_inputs=(x,)))
+            x = block(x)
+    return model
+
+
+def convert_int8(prepared):
+    """Static int8 conv blocks from the observed ranges, dynamic int8 gru_2 and event_fc"""
+    for name in CONV_BLOCKS:
+        setattr(prepared, name, convert_fx(getattr(prepared, name)))
+    prepared.masks_padding = False
+    return quantize_dynamic(prepared, {nn.GRU, nn.Linear}, dtype=torch.qint8)
+
+
+def quantize_dcasenet(model, calibration_inputs, engine=None):
+    """
+    int8 DcaseNet_v3 for CPU serving: post-training static quantization of the ConvBlock convolutions (fused with
+    their batch norms and ReLUs), calibrated on calibration_inputs ((1, channels_num, frames, mel_bins) tensors),
+    and dynamic quantization of gru_2 and event_fc
+    """
+    engine = engine or torch.backends.quantized.engine
+    torch.backends.quantized.engine = engine
+    prepared = prepare_int8(model, engine)
+    with torch.no_grad():
+        for input in calibration_inputs:
+            prepared(input)
+    return convert_int8(prepared)
+
+
+def save_quantized(model, path, checkpoint_path, evaluation):
+    """evaluation: the comparison with the fp32 checkpoint (see quantize.py) that loading gates on"""
+    torch.save({'model': model.state_dict(),
+                'engine': torch.backends.quantized.engine,
+                'causal': model.causal,
+                'fp32_version': checkpoint_version(checkpoint_path),
+                'evaluation': evaluation}, path)
+
+
+def quantization_regressions(evaluation, max_ap_drop=QUANTIZATION_MAX_AP_DROP,
+                             max_impact_error_ms=QUANTIZATION_MAX_IMPACT_ERROR_MS) -> List[str]:
+    """Why a quantized model with this evaluation must not be served; empty when it may"""
+    if not evaluation:
+        return ["it was not evaluated against its fp32 checkpoint"]
+    regressions = []
+    if evaluation.get('ap_drop') is not None and evaluation['ap_drop'] > max_ap_drop:
+        regressions.append(f"mean AP dropped by {evaluation['ap_drop']:.4f} (max {max_ap_drop})")
+    if evaluation['impact_error_ms_p95'] > max_impact_error_ms:
+        regressions.append(f"95th percentile impact time error is {evaluation['impact_error_ms_p95']:.1f} ms "
+                           f"(max {max_impact_error_ms})")
+    return regressions
+
+
+def load_quantized_dcasenet(quantized_path, checkpoint_path):
+    """
+    The int8 model written by quantize.py for checkpoint_path, on the CPU. Refused (RuntimeError) when it was made
+    from another checkpoint or its evaluation regressed beyond QUANTIZATION_MAX_AP_DROP or
+    QUANTIZATION_MAX_IMPACT_ERROR_MS.
+    """
+    if not os.path.exists(quantized_path):
+        error_msg = f"Quantized model not found at {quantized_path}, run quantize.py --ckpt {checkpoint_path}"
+        logger.error(error_msg)
+        raise RuntimeError(error_msg)
+
+    quantized = torch.load(quantized_path, map_location='cpu', weights_only=False)
+    if quantized['fp32_version'] != checkpoint_version(checkpoint_path):
+        raise RuntimeError(f"Quantized model {quantized_path} was not made from {checkpoint_path}")
+    regressions = quantization_regressions(quantized['evaluation'])
+    if regressions:
+        raise RuntimeError(f"Refusing quantized model {quantized_path}: {'; '.join(regressions)}")
+    if quantized['engine'] not in torch.backends.quantized.supported_engines:
+        raise RuntimeError(f"Quantized model {quantized_path} needs the {quantized['engine']} engine, "
+                           f"{torch.backends.quantized.supported_engines} are supported")
+
+    torch.backends.quantized.engine = quantized['engine']
+    # Quantized modules with the observed ranges of quantize.py, restored from the state dict
+    model = convert_int8(prepare_int8(DcaseNet_v3(1, causal=quantized['causal']), quantized['engine']))
+    model.load_state_dict(quantized['model'])
+    model.eval()
+    logger.info(f"Quantized model loaded from {quantized_path}, evaluation: {quantized['evaluation']}")
+    return model
+
+
+def load_serving_dcasenet(checkpoint_path, device, quantization=MODEL_QUANTIZATION):
+    """
+    The model served for a checkpoint, fp32 or int8 (MODEL_QUANTIZATION), and its version. An int8 model has a
+    version of its own, so results of the two are never reused for each other.
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Model quantization can be one of {QUANTIZATIONS}, '{quantization}' given")
+    if quantization == 'none':
+        return load_dcasenet(checkpoint_path, device), checkpoint_version(checkpoint_path)
+    if torch.device(device).type != 'cpu':
+        raise ValueError(f"Quantized models run on the CPU only, {device} given")
+    quantized_path = MODEL_QUANTIZED_CHECKPOINT or quantized_checkpoint_path(checkpoint_path)
+    return load_quantized_dcasenet(quantized_path, checkpoint_path), f"{checkpoint_version(checkpoint_path)}-int8"
@@ -0,0 +1,57 @@
+import os
+import logging
+
+import torch
+import torch.nn as nn
+
+from models.DcaseNet import DcaseNet_v3
+from models.checkpoints import checkpoint_version, load_dcasenet
+from models.optimization import fold_batch_norms, load_optimized
+
+logger = logging.getLogger(__name__)
+
+# Directory of the weights the worker processes of serve.py share (it sets it, e.g. in /dev/shm): every process maps
+# the same file instead of holding a copy of the model. Empty: every process loads its own.
+MODEL_SHARED_WEIGHTS_DIR = os.environ.get("MODEL_SHARED_WEIGHTS_DIR", "")
+
+
+def shared_weights_path(directory, version):
+    return os.path.join(directory, f"dcasenet-{version}.pt")
+
+
+def write_shared_weights(model, path):
+    """Write the weights of a served fp32 DcaseNet_v3 (optimized or not); replaced atomically, never in place"""
+    weights = {'model': {key: tensor.detach().cpu().contiguous() for (key, tensor) in model.state_dict().items()},
+               'causal': model.causal,
+               'folded': any(isinstance(module, nn.Identity) for module in model.modules()),
+               'frame_rate_factor': model.frame_rate_factor}
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(weights, temp_path)
+    os.replace(temp_path, path)
+
+
+def map_shared_weights(path):
+    """The DcaseNet_v3 of write_shared_weights, in eval mode, its parameters mapped from the file"""
+    weights = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    model = DcaseNet_v3(1, causal=weights['causal']).eval()
+    if weights['folded']:
+        fold_batch_norms(model)
+    model.frame_rate_factor = weights['frame_rate_factor']
+    # The mapped tensors become the parameters, so every process mapping the file shares its pages
+    model.load_state_dict(weights['model'], assign=True)
+    return model
+
+
+def load_shared_dcasenet(checkpoint_path, directory=MODEL_SHARED_WEIGHTS_DIR):
+    """
+    The served fp32 model of a checkpoint (optimized as MODEL_OPTIMIZE says) on the CPU, mapped from the shared
+    weights of its version, and the version. The first process to load a version writes its shared weights.
+    """
+    version = checkpoint_version(checkpoint_path)
+    path = shared_weights_path(directory, version)
+    if not os.path.exists(path):
+        write_shared_weights(load_optimized(load_dcasenet(checkpoint_path, 'cpu'), 'cpu'), path)
+        logger.info(f"Shared weights of version {version} written to {path}")
+    model = map_shared_weights(path)
+    logger.info(f"Model of version {version} mapped from {path}")
+    return model, version
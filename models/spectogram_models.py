@@ -1,3 +1,5 @@
+from typing import Optional
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -150,9 +152,18 @@ class ConvBlock(nn.Module):
         init_bn(self.bn1)
         init_bn(self.bn2)
 
-    def forward(self, input):
+    def forward(self, input, time_mask: Optional[torch.Tensor] = None):
+        """
+        time_mask: optional (batch_size, 1, 1, times_steps) 1 for the valid and 0 for the padded time steps of a
+            zero padded batch. The padding is zeroed before every convolution, so it reads as the zeros a shorter
+            input is padded with and no sample depends on the others.
+        """
         x = input
+        if time_mask is not None:
+            x = x * time_mask
         x = F.relu_(self.bn1(self.conv1(x)))
+        if time_mask is not None:
+            x = x * time_mask
         x = F.relu_(self.bn2(self.conv2(x)))
 
         x = F.avg_pool2d(x, kernel_size=self.pool_size)
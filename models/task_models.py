@@ -1,5 +1,5 @@
-from pydantic import BaseModel, Field
-from typing import Optional
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Any, Dict, Optional
 from datetime import datetime
 from enum import Enum
 import uuid
@@ -11,6 +11,9 @@ class TaskStatus(str, Enum):
     FAILED = "failed"
 
 class Task(BaseModel):
+    # Allows the model_version field
+    model_config = ConfigDict(protected_namespaces=())
+    
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     filename: str
     original_filename: str
@@ -19,6 +22,16 @@ class Task(BaseModel):
     impact_time_seconds: Optional[float] = None
     error_message: Optional[str] = None
     video_url: Optional[str] = None
+    attempts: int = 0
+    lease_owner: Optional[str] = None
+    lease_expires_at: Optional[datetime] = None
+    content_sha256: Optional[str] = None
+    model_version: Optional[str] = None
+    # Seconds of the video searched for the impact, None for its start and end
+    search_start_seconds: Optional[float] = None
+    search_end_seconds: Optional[float] = None
+    # Time, output size and peak memory of every stage of the processing (PipelineTrace.to_dict)
+    trace: Optional[Dict[str, Any]] = None
     
 class TaskCreate(BaseModel):
     filename: str
@@ -26,7 +39,13 @@ class TaskCreate(BaseModel):
     video_url: Optional[str] = None
     
 class TaskUpdate(BaseModel):
+    model_config = ConfigDict(protected_namespaces=())
+    
     status: Optional[TaskStatus] = None
     impact_time_seconds: Optional[float] = None
     error_message: Optional[str] = None
-    video_url: Optional[str] = None 
\ No newline at end of file
+    video_url: Optional[str] = None
+    lease_owner: Optional[str] = None
+    lease_expires_at: Optional[datetime] = None
+    model_version: Optional[str] = None
+    trace: Optional[Dict[str, Any]] = None
@@ -0,0 +1,358 @@
+import os
+import time
+import logging
+import functools
+import itertools
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+
+from dataset.spectogram import spectogram_configs as cfg
+from dataset.spectogram import torch_frontend
+from dataset.dataset_utils import read_audio_from_video, read_multichannel_audio, stream_audio
+from utils.feature_cache import LOG_MEL, feature_cache
+from video_processing import detect_impact_time
+
+logger = logging.getLogger(__name__)
+
+# Where a stage runs: in the caller (inline), on an executor of PipelineExecutors (io, cpu, model), or awaited on
+# the event loop (async: a coroutine function, e.g. a forward pass batched by the inference engine). Consecutive
+# stages running on the same executor are submitted together, so their intermediate outputs stay in that process.
+INLINE = 'inline'
+IO = 'io'
+CPU = 'cpu'
+MODEL = 'model'
+ASYNC = 'async'
+RUNS_ON = [INLINE, IO, CPU, MODEL, ASYNC]
+
+
+def output_bytes(value) -> Optional[int]:
+    """Size of a stage's output: arrays, tensors, bytes and files (paths) by their size, sequences by their items'"""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, str) and os.path.isfile(value):
+        return os.path.getsize(value)
+    if isinstance(value, (list, tuple)):
+        sizes = [output_bytes(item) for item in value]
+        return sum(sizes) if sizes and None not in sizes else None
+    return None
+
+
+def reset_peak_rss() -> bool:
+    """Reset this process's peak RSS (Linux); False where it can't be"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb() -> Optional[float]:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class Stage:
+    """
+    A step of a Pipeline: fn(input) -> output, where it runs (RUNS_ON), and how the size of its output is counted.
+    A streaming stage returns an iterator that is consumed by the next stages; its time is the time spent producing
+    the items, and its size theirs. Stages run in a process pool are pickled, so their functions are module level
+    functions (or functools.partial of them) there.
+    """
+    def __init__(self, name, fn, runs_on=INLINE, count_bytes=output_bytes, streaming=False):
+        if runs_on not in RUNS_ON:
+            raise ValueError(f"A stage runs on one of {RUNS_ON}, '{runs_on}' given")
+        self.name = name
+        self.fn = fn
+        self.runs_on = runs_on
+        self.count_bytes = count_bytes
+        self.streaming = streaming
+
+    def __repr__(self):
+        return f"Stage({self.name}, {self.runs_on})"
+
+
+class TimedStream:
+    """
+    Iterator over a streaming stage's output, adding the time spent producing each item (less the time its input
+    stream took) and the item's size to the stage's record
+    """
+    def __init__(self, items, record, count_bytes, upstream=None):
+        self.items = iter(items)
+        self.record = record
+        self.count_bytes = count_bytes
+        self.upstream = upstream
+        self.seconds = 0.0  # including the input stream's
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started_at = time.perf_counter()
+        upstream_seconds = self.upstream.seconds if self.upstream is not None else 0.0
+        try:
+            item = next(self.items)
+        finally:
+            elapsed = time.perf_counter() - started_at
+            self.seconds += elapsed
+            self.record['seconds'] += elapsed - ((self.upstream.seconds if self.upstream is not None else 0.0) -
+                                                 upstream_seconds)
+        size = self.count_bytes(item)
+        if size is not None:
+            self.record['bytes'] = (self.record['bytes'] or 0) + size
+        return item
+
+
+def stage_record(name, runs_on, seconds=0.0, size=None, peak_memory_mb=None):
+    return {'stage': name, 'runs_on': runs_on, 'seconds': seconds, 'bytes': size, 'peak_rss_mb': peak_memory_mb,
+            'pid': os.getpid()}
+
+
+def run_stage(stage, value):
+    """Run a stage in this process: (its output, its record)"""
+    if stage.streaming:
+        record = stage_record(stage.name, stage.runs_on)
+        upstream = value if isinstance(value, TimedStream) else None
+        return TimedStream(stage.fn(value), record, stage.count_bytes, upstream), record
+    upstream_seconds = value.seconds if isinstance(value, TimedStream) else 0.0
+    measures_memory = reset_peak_rss()
+    started_at = time.perf_counter()
+    output = stage.fn(value)
+    seconds = time.perf_counter() - started_at
+    if isinstance(value, TimedStream):
+        # The time its input stream took to produce what it consumed is that stream's
+        seconds -= value.seconds - upstream_seconds
+    return output, stage_record(stage.name, stage.runs_on, seconds, stage.count_bytes(output),
+                                peak_rss_mb() if measures_memory else None)
+
+
+def run_stages(stages, value, keep=()):
+    """
+    Run stages one after the other in this process: (the last output, their records, the outputs of the stages
+    named in keep). Module level, so that a process pool can run a group of stages.
+    """
+    (records, kept) = ([], {})
+    for stage in stages:
+        (value, record) = run_stage(stage, value)
+        records.append(record)
+        if stage.name in keep:
+            kept[stage.name] = value
+    return value, records, kept
+
+
+class PipelineTrace:
+    """
+    What a request went through: time, output size and peak RSS of every stage, in order. Peak RSS is the peak of
+    the process running the stage while it ran (concurrent stages of the same process included), None for stages
+    awaited on the event loop and streaming stages. Outputs kept by Pipeline.run are in outputs.
+    """
+    def __init__(self):
+        self.records: List[Dict] = []
+        self.outputs = {}
+        self._started_at = time.perf_counter()
+
+    def add(self, records, outputs=None):
+        self.records.extend(records)
+        self.outputs.update(outputs or {})
+
+    @contextmanager
+    def measure(self, name, runs_on=INLINE):
+        """Record a step that isn't a pipeline stage, e.g. a cache lookup or waiting for an upload"""
+        record = stage_record(name, runs_on)
+        self.records.append(record)
+        started_at = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - started_at
+
+    def skip(self, names, reason):
+        self.records.extend({'stage': name, 'skipped': reason} for name in names)
+
+    @property
+    def total_seconds(self):
+        return time.perf_counter() - self._started_at
+
+    def to_dict(self):
+        return {'total_seconds': self.total_seconds, 'stages': [dict(record) for record in self.records]}
+
+    def summary(self):
+        return ', '.join(f"{record['stage']} {record['seconds'] * 1000:.0f} ms" if 'seconds' in record else
+                         f"{record['stage']} skipped ({record['skipped']})" for record in self.records)
+
+
+class Pipeline:
+    """
+    Stages run one after the other, each on the output of the previous one, recording a PipelineTrace. run runs
+    every stage in the caller, run_async runs them where they say (RUNS_ON) through PipelineExecutors.
+    Pipelines are immutable: replace, until and after return new ones.
+    """
+    def __init__(self, stages: List[Stage]):
+        self.stages = list(stages)
+        names = self.names
+        if len(set(names)) != len(names):
+            raise ValueError(f"Stage names must be unique, {names} given")
+
+    @property
+    def names(self):
+        return [stage.name for stage in self.stages]
+
+    def _index(self, name):
+        if name not in self.names:
+            raise ValueError(f"No stage {name} in {self.names}")
+        return self.names.index(name)
+
+    def replace(self, name, stage) -> 'Pipeline':
+        index = self._index(name)
+        return Pipeline(self.stages[:index] + [stage] + self.stages[index + 1:])
+
+    def until(self, name) -> 'Pipeline':
+        """The stages up to and including name"""
+        return Pipeline(self.stages[:self._index(name) + 1])
+
+    def after(self, name) -> 'Pipeline':
+        """The stages after name"""
+        return Pipeline(self.stages[self._index(name) + 1:])
+
+    def run(self, value, trace: Optional[PipelineTrace] = None, keep=()):
+        """The last stage's output; the outputs of the stages named in keep are kept in trace.outputs"""
+        if any(stage.runs_on == ASYNC for stage in self.stages):
+            raise ValueError("Async stages run in run_async only")
+        (value, records, kept) = run_stages(self.stages, value, keep)
+        for record in records:
+            record['runs_on'] = INLINE
+        if trace is not None:
+            trace.add(records, kept)
+        return value
+
+    async def run_async(self, value, executors, trace: Optional[PipelineTrace] = None, keep=()):
+        """run, with every group of consecutive stages running on the same executor submitted to it at once"""
+        run_on = {IO: executors.run_io, CPU: executors.run_cpu, MODEL: executors.run_model}
+        trace = trace if trace is not None else PipelineTrace()
+        for (runs_on, group) in itertools.groupby(self.stages, key=lambda stage: stage.runs_on):
+            group = list(group)
+            if runs_on == INLINE:
+                (value, records, kept) = run_stages(group, value, keep)
+                trace.add(records, kept)
+            elif runs_on == ASYNC:
+                for stage in group:
+                    with trace.measure(stage.name, ASYNC) as record:
+                        value = await stage.fn(value)
+                    record['bytes'] = stage.count_bytes(value)
+                    if stage.name in keep:
+                        trace.outputs[stage.name] = value
+            else:
+                (value, records, kept) = await run_on[runs_on](run_stages, group, value, keep)
+                trace.add(records, kept)
+        return value
+
+
+def run_with_feature_cache(pipeline, path, content_sha256, search_window_key='', trace=None, keep=()):
+    """
+    pipeline.run on a file whose log-mel features come from the feature cache when its content was decoded before:
+    then the stages up to 'log-mel' are skipped, otherwise the features are cached on the way
+    """
+    trace = trace if trace is not None else PipelineTrace()
+    with trace.measure('feature cache'):
+        features = feature_cache.get(LOG_MEL, content_sha256, search_window_key)
+    if features is None:
+        features = pipeline.until('log-mel').run(path, trace, keep)
+        feature_cache.put(LOG_MEL, content_sha256, features, search_window_key)
+    else:
+        trace.skip(pipeline.until('log-mel').names, 'cached')
+        trace.outputs['log-mel'] = features
+    return pipeline.after('log-mel').run(features, trace, keep)
+
+
+async def run_with_feature_cache_async(pipeline, path, executors, content_sha256, search_window_key='', trace=None,
+                                       keep=()):
+    """run_with_feature_cache, through the executors"""
+    trace = trace if trace is not None else PipelineTrace()
+    with trace.measure('feature cache', IO):
+        features = await executors.run_io(feature_cache.get, LOG_MEL, content_sha256, search_window_key)
+    if features is None:
+        features = await pipeline.until('log-mel').run_async(path, executors, trace, keep)
+        await executors.run_io(feature_cache.put, LOG_MEL, content_sha256, features, search_window_key)
+    else:
+        trace.skip(pipeline.until('log-mel').names, 'cached')
+        trace.outputs['log-mel'] = features
+    return await pipeline.after('log-mel').run_async(features, executors, trace, keep)
+
+
+# Stage functions, module level so that they can run in a process pool
+
+def fetch_to(output_path, fetch, digest, url):
+    """Download url to output_path through fetch(url, output_path, digest); the path"""
+    fetch(url, output_path, digest)
+    return output_path
+
+
+def decode_audio(path, start=0.0, end=None):
+    """(samples, cfg.audio_channels) float32 audio at cfg.working_sample_rate of a video or a .wav file"""
+    if path.endswith('.wav'):
+        return read_multichannel_audio(audio_path=path, target_fs=cfg.working_sample_rate, start=start, end=end)
+    return read_audio_from_video(path, start, end)
+
+
+def forward_features(model, device, log_mel_features) -> torch.Tensor:
+    """(output_length, classes_num) output of a forward pass over (channels or 1, frames, mel_bins) features"""
+    with torch.no_grad():
+        x = torch_frontend.expand_channels(torch.from_numpy(log_mel_features).to(torch.float32).to(device))
+        return model(x.unsqueeze(0))[0].cpu()
+
+
+def impact_time_of(frame_rate_factor, offset, model_output):
+    return offset + detect_impact_time(model_output, frame_rate_factor)
+
+
+# The stages of the detection pipeline: download -> decode -> log-mel -> model -> impact
+
+def download_stage(output_path, fetch, digest=None, runs_on=IO):
+    return Stage('download', functools.partial(fetch_to, output_path, fetch, digest), runs_on)
+
+
+def decode_stage(start=0.0, end=None, runs_on=INLINE):
+    return Stage('decode', functools.partial(decode_audio, start=start, end=end), runs_on)
+
+
+def log_mel_stage(runs_on=INLINE):
+    return Stage('log-mel', functools.partial(torch_frontend.log_mel, compact=True), runs_on)
+
+
+def streaming_decode_stage(start=0.0, end=None, block_seconds=5):
+    """decode_stage yielding mono blocks of about block_seconds as they are decoded"""
+    return Stage('decode', functools.partial(stream_audio, block_samples=int(block_seconds * cfg.working_sample_rate),
+                                             start=start, end=end), streaming=True)
+
+
+def streaming_log_mel_stage():
+    """log_mel_stage over the blocks of streaming_decode_stage, yielding compact features in blocks"""
+    return Stage('log-mel', torch_frontend.stream_log_mel, streaming=True)
+
+
+def model_stage(model, device, runs_on=MODEL):
+    return Stage('model', functools.partial(forward_features, model, device), runs_on)
+
+
+def impact_stage(frame_rate_factor=1, offset=0.0):
+    """Impact time in seconds from the start of the video, offset being the start of the decoded part"""
+    return Stage('impact', functools.partial(impact_time_of, frame_rate_factor, offset))
+
+
+def detection_pipeline(model, device, start=0.0, end=None) -> Pipeline:
+    """Impact time of a file (a video or a .wav file) found by the model in its [start, end] seconds"""
+    return Pipeline([decode_stage(start, end), log_mel_stage(), model_stage(model, device),
+                     impact_stage(model.frame_rate_factor, start)])
@@ -0,0 +1,108 @@
+import sys
+import time
+import pickle
+import argparse
+
+import numpy as np
+import torch
+
+from dataset.spectogram.spectograms_dataset import create_event_matrix
+from dataset.spectogram.torch_frontend import expand_channels
+from models.checkpoints import load_dcasenet
+from models.quantization import (quantization_regressions, quantize_dcasenet, quantized_checkpoint_path,
+                                 save_quantized)
+from utils.metric_utils import calculate_metrics
+from video_processing import detect_impact_time
+from windowed_inference import windowed_forward
+
+
+def load_clips(feature_paths, video_paths):
+    """(name, log-mel features, event matrix or None) of preprocessed feature files and videos"""
+    clips = []
+    for path in feature_paths:
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        features = np.asarray(data['features'], dtype=np.float32)
+        events = None
+        if 'start_times' in data:
+            events = create_event_matrix(features.shape[1], data['start_times'], data['end_times'])
+        clips.append((path, features, events))
+    if video_paths:
+        from dataset.spectogram.preprocess import extract_log_mel_from_video
+        clips += [(path, extract_log_mel_from_video(path), None) for path in video_paths]
+    return clips
+
+
+def evaluate(model, clips):
+    """Outputs of the served (windowed) inference path, their AP where labeled, and the time per clip"""
+    outputs, aps = [], []
+    start = time.perf_counter()
+    for (_, features, events) in clips:
+        output = windowed_forward(model, features, 'cpu')
+        outputs.append(output)
+        if events is not None:
+            aps.append(calculate_metrics(output.numpy(), events)[2])
+    return outputs, aps, (time.perf_counter() - start) / len(clips)
+
+
+def compare(fp32_results, int8_results):
+    (fp32_outputs, fp32_aps, fp32_seconds) = fp32_results
+    (int8_outputs, int8_aps, int8_seconds) = int8_results
+    impact_errors_ms = np.array([abs(detect_impact_time(q) - detect_impact_time(f)) * 1000
+                                 for (f, q) in zip(fp32_outputs, int8_outputs)])
+    return {
+        'clips': len(fp32_outputs),
+        'labeled_clips': len(fp32_aps),
+        'ap_fp32': float(np.mean(fp32_aps)) if fp32_aps else None,
+        'ap_int8': float(np.mean(int8_aps)) if int8_aps else None,
+        'ap_drop': float(np.mean(fp32_aps) - np.mean(int8_aps)) if fp32_aps else None,
+        'impact_error_ms_mean': float(impact_errors_ms.mean()),
+        'impact_error_ms_p95': float(np.percentile(impact_errors_ms, 95)),
+        'impact_error_ms_max': float(impact_errors_ms.max()),
+        'max_output_diff': max(float((f - q).abs().max()) for (f, q) in zip(fp32_outputs, int8_outputs)),
+        'seconds_per_clip_fp32': fp32_seconds,
+        'seconds_per_clip_int8': int8_seconds,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quantize a DcaseNet_v3 checkpoint to int8 for CPU serving '
+                                                 '(MODEL_QUANTIZATION=int8) and evaluate it against the fp32 model')
+    parser.add_argument('--ckpt', type=str, required=True)
+    parser.add_argument('--features', nargs='*', default=[], help='Feature files written by preprocess_data; '
+                                                                 'their events are used for AP')
+    parser.add_argument('--videos', nargs='*', default=[], help='Unlabeled videos, compared by impact time only')
+    parser.add_argument('--calibration_clips', type=int, default=16,
+                        help='Clips used for calibration; the others are used for evaluation')
+    parser.add_argument('--engine', default=None, help='Quantized engine, x86/fbgemm or qnnpack; '
+                                                       'the platform default by default')
+    parser.add_argument('--output', default=None, help='The checkpoint path with an -int8 suffix by default')
+    args = parser.parse_args()
+    torch.set_num_threads(1)
+
+    clips = load_clips(args.features, args.videos)
+    if not clips:
+        parser.error("No clips to calibrate on, give --features or --videos")
+    calibration_clips = clips[:args.calibration_clips]
+    eval_clips = clips[args.calibration_clips:]
+    if not eval_clips:
+        print(f"Only {len(clips)} clips: evaluating on the calibration clips too")
+        eval_clips = clips
+
+    model = load_dcasenet(args.ckpt, 'cpu')
+    print(f"Calibrating on {len(calibration_clips)} clips")
+    quantized = quantize_dcasenet(model, [expand_channels(torch.from_numpy(features))[None]
+                                          for (_, features, _) in calibration_clips], args.engine)
+
+    print(f"Evaluating on {len(eval_clips)} clips")
+    evaluation = compare(evaluate(model, eval_clips), evaluate(quantized, eval_clips))
+    for (name, value) in evaluation.items():
+        print(f"  {name}: {value if value is None or isinstance(value, int) else f'{value:.4f}'}")
+
+    output_path = args.output or quantized_checkpoint_path(args.ckpt)
+    save_quantized(quantized, output_path, args.ckpt, evaluation)
+    print(f"Saved to {output_path}")
+    regressions = quantization_regressions(evaluation)
+    if regressions:
+        print(f"The server will refuse it: {'; '.join(regressions)}")
+        sys.exit(1)
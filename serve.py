@@ -0,0 +1,222 @@
+import os
+import sys
+import time
+import shutil
+import signal
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger("serve")
+
+HOST = os.environ.get("HOST", "0.0.0.0")
+PORT = int(os.environ.get("PORT", 8080))
+# Cores the server runs on: those of its CPU affinity
+CORES = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+# Intra-op threads of the forward passes of a worker process
+THREADS_PER_WORKER = int(os.environ.get("SERVE_THREADS_PER_WORKER", 1))
+# Worker processes serving requests on the same socket; one per SERVE_THREADS_PER_WORKER cores by default
+WORKERS = int(os.environ.get("SERVE_WORKERS", max(1, len(CORES) // THREADS_PER_WORKER)))
+# Pin every worker (and its decoding processes) to SERVE_THREADS_PER_WORKER cores of its own
+CPU_AFFINITY = os.environ.get("SERVE_CPU_AFFINITY", "true").lower() == "true"
+# Map the fp32 model weights of all workers from one file in shared memory instead of a copy per worker
+SHARED_WEIGHTS = os.environ.get("SERVE_SHARED_WEIGHTS", "true").lower() == "true"
+# Wait before restarting a worker that exited, doubled for every exit within SERVE_STABLE_SECONDS of its start
+RESTART_DELAY_SECONDS = float(os.environ.get("SERVE_RESTART_DELAY_SECONDS", 1))
+MAX_RESTART_DELAY_SECONDS = float(os.environ.get("SERVE_MAX_RESTART_DELAY_SECONDS", 30))
+STABLE_SECONDS = float(os.environ.get("SERVE_STABLE_SECONDS", 60))
+# Time workers get to finish their requests at shutdown before they are killed
+SHUTDOWN_TIMEOUT_SECONDS = float(os.environ.get("SERVE_SHUTDOWN_TIMEOUT_SECONDS", 30))
+
+
+def worker_cores(index, threads=THREADS_PER_WORKER, cores=CORES):
+    return [cores[(index * threads + i) % len(cores)] for i in range(threads)]
+
+
+def run_worker(fd, threads, cpus):
+    """A worker process: main:app on the supervisor's socket, its torch threads on its own cores"""
+    # First, so its clock starts before the imports below
+    from utils.startup_profiler import startup_profiler
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    import torch
+    torch.set_num_threads(threads)
+    import uvicorn
+    startup_profiler.mark('worker imports')
+    server = uvicorn.Server(uvicorn.Config("main:app", timeout_graceful_shutdown=SHUTDOWN_TIMEOUT_SECONDS))
+    server.run(sockets=[socket.socket(fileno=fd)])
+
+
+def preload(cpus):
+    """
+    Once for all the workers, before they start: tune the settings of a worker (AUTOTUNE=startup, on a worker's
+    cores) and write the shared weights of the served checkpoint
+    """
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    from autotune import apply_tuned_settings
+    apply_tuned_settings()
+
+    import torch
+    from inference_backend import INFERENCE_BACKEND, shares_weights
+    from model_registry import served_checkpoint
+    from models.shared_weights import load_shared_dcasenet
+
+    device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    if shares_weights(INFERENCE_BACKEND, device):
+        load_shared_dcasenet(served_checkpoint())
+
+
+class WorkerSlot:
+    def __init__(self, index, cores):
+        self.index = index
+        self.cores = cores
+        self.process = None
+        self.started_at = None
+        self.starts = 0
+        self.restart_delay = 0.0
+        self.restart_at = 0.0
+
+
+class Supervisor:
+    """
+    Runs the worker processes on a socket they share, and restarts a worker that exits while the server runs,
+    waiting longer after every exit in a row.
+    """
+    def __init__(self, sock, workers=WORKERS, threads=THREADS_PER_WORKER, cpu_affinity=CPU_AFFINITY,
+                 shared_weights_dir=None, metrics_dir=None):
+        self.sock = sock
+        self.threads = threads
+        self.shared_weights_dir = shared_weights_dir
+        self.metrics_dir = metrics_dir
+        self.slots = [WorkerSlot(index, worker_cores(index, threads) if cpu_affinity else [])
+                      for index in range(workers)]
+        self._stopping = threading.Event()
+
+    def stop(self, *args):
+        logger.info("Server stopping")
+        self._stopping.set()
+
+    def environment(self, slot):
+        env = dict(os.environ)
+        threads = str(self.threads)
+        env.update(OMP_NUM_THREADS=threads, MKL_NUM_THREADS=threads, TORCH_THREADS=threads)
+        env.setdefault("ONNX_THREADS", threads)
+        # Leases of tasks are held per worker
+        if "WORKER_ID" in os.environ:
+            env["WORKER_ID"] = f"{os.environ['WORKER_ID']}-{slot.index}"
+        if self.shared_weights_dir:
+            env["MODEL_SHARED_WEIGHTS_DIR"] = self.shared_weights_dir
+        if self.metrics_dir:
+            env["METRICS_DIR"] = self.metrics_dir
+        return env
+
+    def start_worker(self, slot):
+        command = [sys.executable, os.path.abspath(__file__), '--worker', '--fd', str(self.sock.fileno()),
+                   '--threads', str(self.threads), '--cpus', ','.join(str(core) for core in slot.cores)]
+        slot.process = subprocess.Popen(command, env=self.environment(slot), pass_fds=[self.sock.fileno()])
+        slot.started_at = time.monotonic()
+        slot.starts += 1
+        logger.info(f"Worker {slot.index} started (pid {slot.process.pid}), {self.threads} threads"
+                    f"{f' on cores {slot.cores}' if slot.cores else ''}")
+
+    def run(self):
+        for slot in self.slots:
+            self.start_worker(slot)
+        while not self._stopping.wait(0.5):
+            now = time.monotonic()
+            for slot in self.slots:
+                if slot.process is not None and slot.process.poll() is not None:
+                    uptime = now - slot.started_at
+                    if uptime >= STABLE_SECONDS:
+                        slot.restart_delay = RESTART_DELAY_SECONDS
+                    else:
+                        slot.restart_delay = min(max(slot.restart_delay * 2, RESTART_DELAY_SECONDS),
+                                                 MAX_RESTART_DELAY_SECONDS)
+                    logger.error(f"Worker {slot.index} (pid {slot.process.pid}) exited with code "
+                                 f"{slot.process.returncode} after {uptime:.0f}s, restarting in "
+                                 f"{slot.restart_delay:g}s")
+                    slot.process = None
+                    slot.restart_at = now + slot.restart_delay
+                if slot.process is None and now >= slot.restart_at:
+                    self.start_worker(slot)
+        self.shutdown()
+
+    def shutdown(self):
+        running = [slot.process for slot in self.slots if slot.process is not None]
+        for process in running:
+            process.terminate()
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT_SECONDS
+        for process in running:
+            try:
+                process.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logger.warning(f"Worker pid {process.pid} didn't stop in time, killing it")
+                process.kill()
+                process.wait()
+        self.sock.close()
+        logger.info("Server stopped")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve main:app from several worker processes')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--fd', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--threads', type=int, default=THREADS_PER_WORKER, help=argparse.SUPPRESS)
+    parser.add_argument('--cpus', default='', help=argparse.SUPPRESS)
+    parser.add_argument('--preload', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.fd, args.threads, [int(core) for core in args.cpus.split(',') if core])
+        sys.exit(0)
+
+    # Workers log as main.py configures it
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.StreamHandler(),
+            logging.FileHandler("serve.log")
+        ]
+    )
+    if args.preload:
+        preload([int(core) for core in args.cpus.split(',') if core])
+        sys.exit(0)
+
+    sock = socket.create_server((HOST, PORT), backlog=2048)
+    sock.set_inheritable(True)
+    # Removed at exit unless set by the environment
+    shared_weights_dir = None
+    if SHARED_WEIGHTS:
+        shared_weights_dir = os.environ.get("MODEL_SHARED_WEIGHTS_DIR") or \
+            tempfile.mkdtemp(prefix='sed-weights-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    # Where the workers dump their metrics, which GET /metrics of any worker merges
+    metrics_dir = os.environ.get("METRICS_DIR") or tempfile.mkdtemp(prefix='sed-metrics-')
+
+    supervisor = Supervisor(sock, shared_weights_dir=shared_weights_dir, metrics_dir=metrics_dir)
+    first_slot = supervisor.slots[0]
+    preload_command = [sys.executable, os.path.abspath(__file__), '--preload',
+                       '--cpus', ','.join(str(core) for core in first_slot.cores)]
+    signal.signal(signal.SIGTERM, supervisor.stop)
+    signal.signal(signal.SIGINT, supervisor.stop)
+    try:
+        if subprocess.run(preload_command, env=supervisor.environment(first_slot)).returncode != 0:
+            logger.error("Failed to load the model")
+            sys.exit(1)
+        logger.info(f"Serving on {HOST}:{PORT} with {len(supervisor.slots)} workers of {THREADS_PER_WORKER} threads, "
+                    f"CPU affinity {'on' if CPU_AFFINITY else 'off'}, shared weights in {shared_weights_dir or 'none'}")
+        supervisor.run()
+    finally:
+        if shared_weights_dir and not os.environ.get("MODEL_SHARED_WEIGHTS_DIR"):
+            shutil.rmtree(shared_weights_dir, ignore_errors=True)
+        if not os.environ.get("METRICS_DIR"):
+            shutil.rmtree(metrics_dir, ignore_errors=True)
@@ -0,0 +1,229 @@
+import os
+import json
+import shutil
+import logging
+import sqlite3
+import datetime
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, List
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+SQLITE_DB_PATH = os.getenv("SQLITE_DB_PATH", "tasks.db")
+LOCAL_STORAGE_DIR = os.getenv("LOCAL_STORAGE_DIR", "storage")
+
+# Columns of the tasks table, mirroring supabase_migrations.sql. Columns added here are added to existing databases.
+TASK_COLUMNS = {
+    "id": "TEXT PRIMARY KEY",
+    "filename": "TEXT NOT NULL",
+    "original_filename": "TEXT NOT NULL",
+    "created_at": "TEXT NOT NULL",
+    "status": "TEXT NOT NULL DEFAULT 'pending'",
+    "impact_time_seconds": "REAL",
+    "error_message": "TEXT",
+    "video_url": "TEXT",
+    "attempts": "INTEGER NOT NULL DEFAULT 0",
+    "lease_owner": "TEXT",
+    "lease_expires_at": "TEXT",
+    "content_sha256": "TEXT",
+    "model_version": "TEXT",
+    "search_start_seconds": "REAL",
+    "search_end_seconds": "REAL",
+    "trace": "TEXT",
+}
+# Tasks nobody holds, given the current time twice: PENDING ones without a live lease (servers lease the tasks they
+# queue) and those whose lease expired
+CLAIMABLE = ("((status = 'pending' AND (lease_expires_at IS NULL OR lease_expires_at < ?)) "
+             "OR (status = 'processing' AND lease_expires_at < ?))")
+# Columns holding JSON documents (JSONB in Supabase), stored as text
+JSON_COLUMNS = {"trace"}
+
+
+def _serialize(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return json.dumps(value)
+    return value
+
+
+def _task(row):
+    task = dict(row)
+    for column in JSON_COLUMNS:
+        if task.get(column) is not None:
+            task[column] = json.loads(task[column])
+    return task
+
+
+def _utc_now(offset_seconds=0):
+    return (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=offset_seconds)).isoformat()
+
+
+class SqliteClient:
+    """
+    Stand-in for SupabaseClient backed by a SQLite file and a local storage directory.
+    Used for running the API and worker.py on a single machine and in tests.
+    Several processes may share the database file; claims are serialized by SQLite's write lock.
+    """
+    def __init__(self, db_path=SQLITE_DB_PATH, storage_dir=LOCAL_STORAGE_DIR):
+        self.db_path = db_path
+        self.storage_dir = os.path.abspath(storage_dir)
+        os.makedirs(self.storage_dir, exist_ok=True)
+
+        with self._connect() as conn:
+            columns = ", ".join(f"{name} {definition}" for name, definition in TASK_COLUMNS.items())
+            conn.execute(f"CREATE TABLE IF NOT EXISTS tasks ({columns})")
+            existing = {row["name"] for row in conn.execute("PRAGMA table_info(tasks)")}
+            for name, definition in TASK_COLUMNS.items():
+                if name not in existing:
+                    conn.execute(f"ALTER TABLE tasks ADD COLUMN {name} {definition}")
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_status_idx ON tasks (status)")
+            # Tasks of servers from before local leases: recoverable once the servers had time to finish them
+            conn.execute("UPDATE tasks SET lease_expires_at = ? WHERE status = 'processing' AND lease_expires_at IS NULL",
+                         (_utc_now(600),))
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_content_idx ON tasks (content_sha256, model_version) "
+                         "WHERE status = 'completed'")
+        logger.info(f"SQLite task database initialized at {self.db_path}, storage at {self.storage_dir}")
+
+    @contextmanager
+    def _connect(self):
+        # Autocommit mode; claim_task opens its own transaction
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    # Task Database Operations
+    def create_task(self, task_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Create a new task in the database"""
+        try:
+            data = {key: _serialize(value) for key, value in task_data.items() if key in TASK_COLUMNS}
+            with self._connect() as conn:
+                conn.execute(f"INSERT INTO tasks ({', '.join(data)}) VALUES ({', '.join('?' * len(data))})",
+                             list(data.values()))
+            logger.info(f"Task created with ID: {data['id']}")
+            return self.get_task(data["id"])
+        except Exception as e:
+            logger.error(f"Failed to create task: {str(e)}")
+            raise
+
+    def get_task(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """Get a task by ID"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        return _task(row) if row else None
+
+    def update_task(self, task_id: str, update_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Update a task by ID"""
+        return self._update(task_id, update_data)
+
+    def delete_task(self, task_id: str) -> bool:
+        """Delete a task by ID"""
+        with self._connect() as conn:
+            deleted = conn.execute("DELETE FROM tasks WHERE id = ?", (task_id,)).rowcount
+        if deleted:
+            logger.info(f"Task {task_id} deleted successfully")
+        return deleted > 0
+
+    def list_tasks(self) -> List[Dict[str, Any]]:
+        """List all tasks"""
+        with self._connect() as conn:
+            return [_task(row) for row in conn.execute("SELECT * FROM tasks ORDER BY created_at DESC")]
+
+    def list_tasks_by_status(self, statuses: List[str]) -> List[Dict[str, Any]]:
+        """List tasks with any of the given statuses, oldest first"""
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT * FROM tasks WHERE status IN ({', '.join('?' * len(statuses))}) "
+                                f"ORDER BY created_at", list(statuses))
+            return [_task(row) for row in rows]
+
+    def find_completed_task(self, content_sha256: str, model_version: str, search_start_seconds: Optional[float] = None,
+                            search_end_seconds: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """Latest completed task of the same video content and search window processed by the same model version"""
+        with self._connect() as conn:
+            # IS matches NULL (the start or end of the video) as well as values
+            row = conn.execute("SELECT * FROM tasks WHERE content_sha256 = ? AND model_version = ? AND status = 'completed' "
+                               "AND search_start_seconds IS ? AND search_end_seconds IS ? "
+                               "ORDER BY created_at DESC LIMIT 1",
+                               (content_sha256, model_version, search_start_seconds, search_end_seconds)).fetchone()
+        return _task(row) if row else None
+
+    # Task Leasing Operations
+    def claim_task(self, worker_id: str, lease_seconds: int, max_attempts: int) -> Optional[Dict[str, Any]]:
+        """Atomically lease the oldest claimable task to worker_id, same rules as claim_task in supabase_migrations.sql"""
+        with self._connect() as conn:
+            # Take the write lock up front so two workers can't select the same row
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = _utc_now()
+                conn.execute("UPDATE tasks SET status = 'failed', error_message = 'Gave up after ' || attempts || ' attempts', "
+                             f"lease_owner = NULL, lease_expires_at = NULL WHERE {CLAIMABLE} AND attempts >= ?",
+                             (now, now, max_attempts))
+                row = conn.execute(f"SELECT id FROM tasks WHERE {CLAIMABLE} AND attempts < ? "
+                                   "ORDER BY created_at LIMIT 1", (now, now, max_attempts)).fetchone()
+                if row is not None:
+                    conn.execute("UPDATE tasks SET status = 'processing', lease_owner = ?, lease_expires_at = ?, "
+                                 "attempts = attempts + 1 WHERE id = ?",
+                                 (worker_id, _utc_now(lease_seconds), row["id"]))
+                    row = conn.execute("SELECT * FROM tasks WHERE id = ?", (row["id"],)).fetchone()
+                conn.execute("COMMIT")
+            except Exception as e:
+                conn.execute("ROLLBACK")
+                logger.error(f"Failed to claim task for {worker_id}: {str(e)}")
+                raise
+
+        if row is None:
+            return None
+        logger.info(f"Task {row['id']} leased to {worker_id}")
+        return _task(row)
+
+    def renew_task_lease(self, task_id: str, worker_id: str, lease_seconds: int) -> bool:
+        """Extend the lease of a task; False if worker_id no longer owns it"""
+        with self._connect() as conn:
+            renewed = conn.execute("UPDATE tasks SET lease_expires_at = ? "
+                                   "WHERE id = ? AND lease_owner = ? AND status IN ('pending', 'processing')",
+                                   (_utc_now(lease_seconds), task_id, worker_id)).rowcount
+        return renewed > 0
+
+    def update_leased_task(self, task_id: str, worker_id: str, update_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Update a task only while worker_id still holds its lease"""
+        return self._update(task_id, update_data, lease_owner=worker_id)
+
+    def _update(self, task_id, update_data, lease_owner=None):
+        try:
+            data = {key: _serialize(value) for key, value in update_data.items()}
+            query = f"UPDATE tasks SET {', '.join(f'{key} = ?' for key in data)} WHERE id = ?"
+            params = list(data.values()) + [task_id]
+            if lease_owner is not None:
+                query += " AND lease_owner = ?"
+                params.append(lease_owner)
+            with self._connect() as conn:
+                updated = conn.execute(query, params).rowcount
+            if not updated:
+                return None
+            logger.info(f"Task {task_id} updated successfully")
+            return self.get_task(task_id)
+        except Exception as e:
+            logger.error(f"Failed to update task {task_id}: {str(e)}")
+            raise
+
+    # Storage Operations
+    def upload_video(self, file_path: str, file_name: str) -> str:
+        """Copy a video into the local storage directory and return its file:// URL"""
+        shutil.copyfile(file_path, os.path.join(self.storage_dir, file_name))
+        logger.info(f"Video stored locally: {file_name}")
+        return self.get_video_url(file_name)
+
+    def get_video_url(self, file_name: str) -> str:
+        return f"file://{os.path.join(self.storage_dir, file_name)}"
+
+    def delete_video(self, file_name: str) -> bool:
+        os.remove(os.path.join(self.storage_dir, file_name))
+        logger.info(f"Video {file_name} deleted successfully")
+        return True
@@ -158,6 +158,99 @@ class SupabaseClient:
             logger.error(f"Failed to list tasks: {str(e)}")
             raise
     
+    def list_tasks_by_status(self, statuses: List[str]) -> List[Dict[str, Any]]:
+        """List tasks with any of the given statuses, oldest first"""
+        try:
+            # Use service client if available
+            client_to_use = self.service_client if self.service_client else self.client
+            
+            response = client_to_use.table("tasks").select("*").in_("status", statuses).order("created_at").execute()
+            return response.data
+        except Exception as e:
+            logger.error(f"Failed to list tasks by status {statuses}: {str(e)}")
+            raise
+    
+    def find_completed_task(self, content_sha256: str, model_version: str, search_start_seconds: Optional[float] = None,
+                            search_end_seconds: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """Latest completed task of the same video content and search window processed by the same model version"""
+        try:
+            # Use service client if available
+            client_to_use = self.service_client if self.service_client else self.client
+            
+            query = (client_to_use.table("tasks").select("*")
+                     .eq("content_sha256", content_sha256)
+                     .eq("model_version", model_version)
+                     .eq("status", "completed"))
+            # NULL is the start or end of the video
+            for column, value in [("search_start_seconds", search_start_seconds), ("search_end_seconds", search_end_seconds)]:
+                query = query.is_(column, "null") if value is None else query.eq(column, value)
+            response = query.order("created_at", desc=True).limit(1).execute()
+            if response.data and len(response.data) > 0:
+                return response.data[0]
+            return None
+        except Exception as e:
+            logger.error(f"Failed to find completed task for {content_sha256}: {str(e)}")
+            raise
+    
+    # Task Leasing Operations
+    def claim_task(self, worker_id: str, lease_seconds: int, max_attempts: int) -> Optional[Dict[str, Any]]:
+        """Atomically lease the oldest claimable task to worker_id, see claim_task in supabase_migrations.sql"""
+        try:
+            # Use service client if available
+            client_to_use = self.service_client if self.service_client else self.client
+            
+            response = client_to_use.rpc("claim_task", {
+                "p_worker_id": worker_id,
+                "p_lease_seconds": lease_seconds,
+                "p_max_attempts": max_attempts
+            }).execute()
+            if response.data and len(response.data) > 0:
+                logger.info(f"Task {response.data[0]['id']} leased to {worker_id}")
+                return response.data[0]
+            return None
+        except Exception as e:
+            logger.error(f"Failed to claim task for {worker_id}: {str(e)}")
+            raise
+    
+    def renew_task_lease(self, task_id: str, worker_id: str, lease_seconds: int) -> bool:
+        """Extend the lease of a task; False if worker_id no longer owns it"""
+        try:
+            # Use service client if available
+            client_to_use = self.service_client if self.service_client else self.client
+            
+            response = client_to_use.rpc("renew_task_lease", {
+                "p_task_id": task_id,
+                "p_worker_id": worker_id,
+                "p_lease_seconds": lease_seconds
+            }).execute()
+            return bool(response.data)
+        except Exception as e:
+            logger.error(f"Failed to renew lease of task {task_id}: {str(e)}")
+            raise
+    
+    def update_leased_task(self, task_id: str, worker_id: str, update_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Update a task only while worker_id still holds its lease"""
+        try:
+            # Serialize datetime objects to ISO format strings
+            serialized_data = {}
+            for key, value in update_data.items():
+                if isinstance(value, (datetime.datetime, datetime.date)):
+                    serialized_data[key] = value.isoformat()
+                else:
+                    serialized_data[key] = value
+            
+            # Use service client if available
+            client_to_use = self.service_client if self.service_client else self.client
+            
+            response = client_to_use.table("tasks").update(serialized_data).eq("id", task_id).eq("lease_owner", worker_id).execute()
+            if response.data and len(response.data) > 0:
+                logger.info(f"Leased task {task_id} updated successfully")
+                return response.data[0]
+            return None
+        except Exception as e:
+            logger.error(f"Failed to update leased task {task_id}: {str(e)}")
+            raise
+    
     # Storage Operations
     def upload_video(self, file_path: str, file_name: str) -> str:
         """
@@ -165,21 +258,20 @@ class SupabaseClient:
         Returns the public URL of the uploaded file
         """
         try:
-            with open(file_path, "rb") as f:
-                file_content = f.read()
-            
             # Use service client for upload if available
             client_to_use = self.service_client if self.service_client else self.client
             logger.info(f"Using {'service role' if self.service_client else 'public'} client for upload")
             logger.info(f"Uploading to bucket: {BUCKET_NAME}, file: {file_name}")
             
-            # Try upload with bucket name
+            # Try upload with bucket name. Passing the open file rather than its bytes lets
+            # the HTTP client stream it in chunks instead of holding the whole video in memory.
             bucket = BUCKET_NAME.strip()
-            response = client_to_use.storage.from_(bucket).upload(
-                path=file_name,
-                file=file_content,
-                file_options={"content-type": "video/mov"}
-            )
+            with open(file_path, "rb") as f:
+                response = client_to_use.storage.from_(bucket).upload(
+                    path=file_name,
+                    file=f,
+                    file_options={"content-type": "video/mov"}
+                )
             
             # Get public URL with the same bucket name
             file_url = self.client.storage.from_(bucket).get_public_url(file_name)
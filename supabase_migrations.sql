@@ -36,4 +36,83 @@ CREATE POLICY "Allow full access for authenticated users" ON tasks
 -- or via the Supabase Management API, not SQL
 
 -- Function comment
-COMMENT ON TABLE tasks IS 'Stores video processing tasks for sound event detection'; 
\ No newline at end of file
+COMMENT ON TABLE tasks IS 'Stores video processing tasks for sound event detection'; 
+
+-- Task leasing: worker.py processes and servers (for recovery) claim PENDING tasks nobody holds, and tasks whose
+-- lease expired, atomically. Servers lease the tasks they queue themselves. Safe to run on an existing database,
+-- and to re-run when the functions change.
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS lease_owner TEXT;
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS tasks_claimable_idx ON tasks (created_at)
+  WHERE status IN ('pending', 'processing');
+
+-- Tasks of servers from before they leased their tasks: recoverable once the servers had time to finish them
+UPDATE tasks
+SET lease_expires_at = NOW() + interval '600 seconds'
+WHERE status = 'processing'
+  AND lease_expires_at IS NULL;
+
+-- Claim the oldest claimable task for p_worker_id. Tasks whose lease expired after p_max_attempts
+-- attempts are failed instead of being handed out again.
+CREATE OR REPLACE FUNCTION claim_task(p_worker_id TEXT, p_lease_seconds INTEGER, p_max_attempts INTEGER)
+RETURNS SETOF tasks
+LANGUAGE sql
+AS $$
+  UPDATE tasks
+  SET status = 'failed',
+      error_message = 'Gave up after ' || attempts || ' attempts',
+      lease_owner = NULL,
+      lease_expires_at = NULL
+  WHERE ((status = 'pending' AND (lease_expires_at IS NULL OR lease_expires_at < NOW()))
+      OR (status = 'processing' AND lease_expires_at < NOW()))
+    AND attempts >= p_max_attempts;
+
+  UPDATE tasks
+  SET status = 'processing',
+      lease_owner = p_worker_id,
+      lease_expires_at = NOW() + make_interval(secs => p_lease_seconds),
+      attempts = attempts + 1
+  WHERE id = (
+    SELECT id FROM tasks
+    WHERE attempts < p_max_attempts
+      AND ((status = 'pending' AND (lease_expires_at IS NULL OR lease_expires_at < NOW()))
+        OR (status = 'processing' AND lease_expires_at < NOW()))
+    ORDER BY created_at
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED
+  )
+  RETURNING *;
+$$;
+
+-- Heartbeat: extend the lease of a task still owned by p_worker_id, queued or running. Returns no row once the lease
+-- was lost.
+CREATE OR REPLACE FUNCTION renew_task_lease(p_task_id UUID, p_worker_id TEXT, p_lease_seconds INTEGER)
+RETURNS SETOF tasks
+LANGUAGE sql
+AS $$
+  UPDATE tasks
+  SET lease_expires_at = NOW() + make_interval(secs => p_lease_seconds)
+  WHERE id = p_task_id
+    AND lease_owner = p_worker_id
+    AND status IN ('pending', 'processing')
+  RETURNING *;
+$$;
+
+-- Result deduplication: tasks remember the SHA-256 of their video and the version of the model that processed it,
+-- so re-uploads of the same clip reuse the stored result. Safe to run on an existing database.
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS content_sha256 TEXT;
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS model_version TEXT;
+
+CREATE INDEX IF NOT EXISTS tasks_content_idx ON tasks (content_sha256, model_version)
+  WHERE status = 'completed';
+
+-- Search windows: the seconds of the video that were searched for the impact, NULL for its start and end.
+-- Part of the deduplication key. Safe to run on an existing database.
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS search_start_seconds DOUBLE PRECISION;
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS search_end_seconds DOUBLE PRECISION;
+
+-- Pipeline traces: time, output size and peak memory of every processing stage of a task, for finding out whether
+-- a slow task was bound by the network, decoding, feature extraction or the model. Safe to run on an existing database.
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS trace JSONB;
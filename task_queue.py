@@ -0,0 +1,186 @@
+import os
+import time
+import socket
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+import metrics
+from models.task_models import TaskStatus, TaskUpdate
+
+logger = logging.getLogger(__name__)
+
+QUEUE_MAX_SIZE = int(os.environ.get("TASK_QUEUE_MAX_SIZE", 32))
+QUEUE_WORKERS = int(os.environ.get("TASK_QUEUE_WORKERS", 2))
+# Owner of the leases of the tasks this process holds: a worker.py process, or a server's queued and running tasks
+WORKER_ID = os.environ.get("WORKER_ID", f"{socket.gethostname()}-{os.getpid()}")
+# A task whose lease was not renewed for this long is handed to another worker or server
+LEASE_SECONDS = int(os.environ.get("TASK_LEASE_SECONDS", 120))
+HEARTBEAT_SECONDS = float(os.environ.get("TASK_HEARTBEAT_SECONDS", LEASE_SECONDS / 3))
+MAX_ATTEMPTS = int(os.environ.get("TASK_MAX_ATTEMPTS", 3))
+# Interval at which a server claims the tasks whose leases expired (their server or worker died) into its queue
+RECOVERY_INTERVAL_SECONDS = float(os.environ.get("TASK_RECOVERY_INTERVAL_SECONDS", 60))
+
+
+def lease_expiry():
+    """Expiry of a lease taken or renewed now"""
+    return datetime.now(timezone.utc) + timedelta(seconds=LEASE_SECONDS)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class TaskQueue:
+    """
+    Bounded in-process queue of task ids drained by a fixed number of worker coroutines.
+    A task can carry a LocalVideo of its upload, so it is processed without downloading the video again.
+    The queue holds the leases of its tasks, queued or running, under WORKER_ID: maintain() renews them, so only the
+    tasks of a server that died become claimable by recover() of any server, and stop() hands them back.
+    """
+    def __init__(self, process_task, task_db, executors, max_size=QUEUE_MAX_SIZE, workers=QUEUE_WORKERS,
+                 wait_history=100):
+        self.process_task = process_task  # async callable taking a task id and an optional LocalVideo
+        self.task_db = task_db
+        self.executors = executors
+        self.max_size = max_size
+        self.num_workers = max(1, workers)
+        self._queue = None
+        self._workers = []
+        self._in_flight = 0
+        self._held = set()  # ids of the tasks queued or running, whose leases are renewed
+        self._processed = 0
+        self._wait_seconds = deque(maxlen=wait_history)
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_size)
+        self._workers = [asyncio.create_task(self._worker(i)) for i in range(self.num_workers)]
+        logger.info(f"Task queue started: max_size={self.max_size}, workers={self.num_workers}")
+
+    async def stop(self):
+        """Stop the workers and drop the queued tasks; their leases are kept until release()"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        queued = self.depth()
+        while not self._queue.empty():
+            (task_id, local_video, enqueued_at) = self._queue.get_nowait()
+            if local_video is not None:
+                local_video.release()
+        logger.info(f"Task queue stopped with {queued} tasks still queued")
+
+    async def release(self):
+        """
+        Hand the tasks that were queued or interrupted by stop() back as PENDING, so the next recovery of any server
+        claims them without waiting for their leases to expire
+        """
+        released = 0
+        for task_id in list(self._held):
+            update = TaskUpdate(status=TaskStatus.PENDING, lease_owner=None, lease_expires_at=None)
+            try:
+                if await self.executors.run_io(self.task_db.update_leased_task, task_id, WORKER_ID, update):
+                    released += 1
+            except Exception as e:
+                # Claimable anyway once its lease expires
+                logger.warning(f"Failed to release task {task_id}: {str(e)}")
+        self._held.clear()
+        logger.info(f"Released {released} unfinished tasks")
+
+    def is_full(self):
+        return self._queue.full()
+
+    def depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def submit(self, task_id, local_video=None):
+        """Enqueue a task leased to WORKER_ID without waiting; raises QueueFullError when the queue is at capacity"""
+        try:
+            self._queue.put_nowait((task_id, local_video, time.monotonic()))
+        except asyncio.QueueFull:
+            raise QueueFullError(f"Task queue is full ({self.max_size} tasks waiting)")
+        self._held.add(task_id)
+
+    async def put(self, task_id, local_video=None):
+        """Enqueue a task leased to WORKER_ID, waiting for a free slot if the queue is at capacity"""
+        self._held.add(task_id)
+        try:
+            await self._queue.put((task_id, local_video, time.monotonic()))
+        except BaseException:
+            self._held.discard(task_id)
+            raise
+
+    async def recover(self):
+        """
+        Claim the tasks nobody holds while the queue has room: PENDING tasks without a live lease (released at a
+        shutdown, or not queued after all) and tasks whose lease expired with their server or worker. Claims are
+        atomic, so any number of servers can recover at the same time.
+        """
+        recovered = 0
+        while not self.is_full():
+            task = await self.executors.run_io(self.task_db.claim_task, WORKER_ID, LEASE_SECONDS, MAX_ATTEMPTS)
+            if task is None:
+                break
+            self.submit(task.id)
+            recovered += 1
+        if recovered:
+            logger.info(f"Recovered {recovered} unfinished tasks into the queue")
+
+    async def maintain(self, recover=True):
+        """
+        Renew the leases of the held tasks every HEARTBEAT_SECONDS and, with recover, recover tasks now and every
+        RECOVERY_INTERVAL_SECONDS, until cancelled
+        """
+        next_recovery = time.monotonic() if recover else float('inf')
+        while True:
+            if time.monotonic() >= next_recovery:
+                try:
+                    await self.recover()
+                except Exception as e:
+                    logger.error(f"Task recovery failed: {str(e)}")
+                next_recovery = time.monotonic() + RECOVERY_INTERVAL_SECONDS
+            await asyncio.sleep(min(HEARTBEAT_SECONDS, max(0.0, next_recovery - time.monotonic())))
+            await self._renew_leases()
+
+    async def _renew_leases(self):
+        for task_id in list(self._held):
+            try:
+                renewed = await self.executors.run_io(self.task_db.renew_lease, task_id, WORKER_ID, LEASE_SECONDS)
+            except Exception as e:
+                # Keep trying, the lease is only lost once it expires
+                logger.warning(f"Heartbeat of task {task_id} failed: {str(e)}")
+                continue
+            if not renewed and task_id in self._held:
+                # Finished meanwhile, or claimed by another server after the lease expired
+                logger.debug(f"Task {task_id} is no longer leased to {WORKER_ID}")
+
+    def stats(self):
+        waits = list(self._wait_seconds)
+        return {
+            "depth": self.depth(),
+            "max_size": self.max_size,
+            "workers": self.num_workers,
+            "in_flight": self._in_flight,
+            "processed": self._processed,
+            "avg_wait_seconds": sum(waits) / len(waits) if waits else 0.0,
+            "max_wait_seconds": max(waits) if waits else 0.0,
+        }
+
+    async def _worker(self, index):
+        while True:
+            (task_id, local_video, enqueued_at) = await self._queue.get()
+            wait_seconds = time.monotonic() - enqueued_at
+            self._wait_seconds.append(wait_seconds)
+            metrics.task_queue_wait_seconds.observe(wait_seconds)
+            self._in_flight += 1
+            try:
+                await self.process_task(task_id, local_video)
+            except Exception as e:
+                logger.error(f"Queue worker {index} failed on task {task_id}: {str(e)}")
+            finally:
+                self._in_flight -= 1
+                self._processed += 1
+                self._queue.task_done()
+            # Not reached when stop() cancels the task, which stays held for release()
+            self._held.discard(task_id)
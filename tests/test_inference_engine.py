@@ -0,0 +1,68 @@
+import sys
+import os
+import time
+import asyncio
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dataset.spectogram import spectogram_configs as cfg
+from inference_engine import BatchingInferenceEngine
+
+
+class MeanModel(torch.nn.Module):
+    """One output per frame: the mean of its features, after sleeping for delay seconds per forward pass"""
+    frame_rate_factor = 1
+
+    def __init__(self, delay=0.0):
+        super().__init__()
+        self.delay = delay
+
+    def forward(self, x, lengths=None):
+        time.sleep(self.delay)
+        return x.mean(dim=(1, 3)).unsqueeze(-1)
+
+    def output_length(self, input_length):
+        return input_length
+
+
+def features(value, frames=50):
+    return np.full((cfg.audio_channels, frames, cfg.mel_bins), value, dtype=np.float32)
+
+
+def engine(model, **kwargs):
+    return BatchingInferenceEngine(model, 'cpu', lambda output, frame_rate_factor: 0.0, **kwargs)
+
+
+def test_concurrent_requests_get_their_own_outputs():
+    async def run():
+        batching = engine(MeanModel(delay=0.001), max_batch_size=4, max_wait_ms=1)
+        await batching.start()
+        try:
+            return await asyncio.gather(*[batching.infer(features(i, frames=10 + i)) for i in range(64)])
+        finally:
+            await batching.stop()
+
+    results = asyncio.run(run())
+    for (i, result) in enumerate(results):
+        assert result.output.shape == (10 + i, 1)
+        assert torch.all(result.output == i)
+        assert 1 <= result.batch_size <= 4
+
+
+def test_stop_fails_unfinished_requests():
+    async def run():
+        batching = engine(MeanModel(delay=0.2), max_batch_size=2, max_wait_ms=1)
+        await batching.start()
+        requests = [asyncio.ensure_future(batching.infer(features(i))) for i in range(5)]
+        await asyncio.sleep(0.05)
+        await batching.stop()
+        return await asyncio.wait_for(asyncio.gather(*requests, return_exceptions=True), 1)
+
+    results = asyncio.run(run())
+    assert len(results) == 5
+    for result in results:
+        assert isinstance(result, RuntimeError)
+        assert "stopped" in str(result)
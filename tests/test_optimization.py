@@ -0,0 +1,77 @@
+import sys
+import os
+
+import numpy as np
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dataset.spectogram import spectogram_configs as cfg
+from models.DcaseNet import DcaseNet_v3
+from models.optimization import optimize_for_inference, to_frame_rate, verify_optimized
+from windowed_inference import batch_parity, forward_batch
+
+# The tolerance of batch_parity and verify_optimized
+TOLERANCE = 1e-4
+
+
+@pytest.fixture(scope='module')
+def models():
+    """A DcaseNet_v3 with random batch norm statistics, which folding has to carry over, and its optimized copy"""
+    torch.manual_seed(0)
+    model = DcaseNet_v3(1)
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, torch.nn.BatchNorm2d):
+                module.running_mean.uniform_(-0.5, 0.5)
+                module.running_var.uniform_(0.5, 2.0)
+                module.weight.uniform_(0.5, 1.5)
+                module.bias.uniform_(-0.5, 0.5)
+    model.eval()
+    return model, optimize_for_inference(model)
+
+
+def features(lengths, seed=0):
+    rng = np.random.default_rng(seed)
+    return [rng.standard_normal((cfg.audio_channels, length, cfg.mel_bins)).astype(np.float32) - 40
+            for length in lengths]
+
+
+@pytest.mark.parametrize('length', [64, 181, 240, 481])
+def test_optimized_matches_original(models, length):
+    (model, optimized) = models
+    [x] = features([length])
+    [expected] = forward_batch(model, [x], 'cpu')
+    [output] = forward_batch(optimized, [x], 'cpu')
+    output = to_frame_rate(output, optimized.frame_rate_factor)
+    assert output.shape == expected.shape
+    assert (output - expected).abs().max().item() <= TOLERANCE
+
+
+@pytest.mark.parametrize('lengths', [(240, 181, 64), (481, 240), (100, 99, 3)])
+def test_optimized_matches_original_in_padded_batches(models, lengths):
+    (model, optimized) = models
+    features_list = features(lengths, seed=1)
+    expected = forward_batch(model, features_list, 'cpu')
+    outputs = forward_batch(optimized, features_list, 'cpu')
+    for (output, expected_output) in zip(outputs, expected):
+        output = to_frame_rate(output, optimized.frame_rate_factor)
+        assert output.shape == expected_output.shape
+        assert (output - expected_output).abs().max().item() <= TOLERANCE
+    assert batch_parity(optimized, 'cpu', lengths) <= TOLERANCE
+
+
+@pytest.mark.parametrize('num_frames', [64, 240, 481])
+def test_verify_optimized(models, num_frames):
+    (model, optimized) = models
+    assert verify_optimized(model, optimized, num_frames=num_frames) <= TOLERANCE
+
+
+def test_verify_optimized_refuses_a_different_model(models):
+    (model, optimized) = models
+    broken = optimize_for_inference(model)
+    with torch.no_grad():
+        broken.conv_block1.conv1.bias.add_(0.1)
+    with pytest.raises(RuntimeError):
+        verify_optimized(model, broken)
@@ -0,0 +1,65 @@
+import sys
+import os
+
+import numpy as np
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dataset.spectogram import spectogram_configs as cfg
+from models.DcaseNet import DcaseNet_v3
+from models.quantization import QUANTIZATION_MAX_IMPACT_ERROR_MS, quantize_dcasenet
+from video_processing import detect_impact_time
+from windowed_inference import batch_parity, forward_batch
+
+pytestmark = pytest.mark.skipif(torch.backends.quantized.engine == 'none',
+                                reason="No quantized engine in this build of torch")
+
+# Largest output difference of the int8 model to fp32: outputs are probabilities, int8 rounds them by a few percent
+MAX_OUTPUT_DIFF = 0.1
+
+
+def features(lengths, seed=0):
+    """Random log-mel features with a loud burst a fifth into each clip"""
+    rng = np.random.default_rng(seed)
+    features_list = []
+    for length in lengths:
+        x = rng.standard_normal((cfg.audio_channels, length, cfg.mel_bins)).astype(np.float32) - 40
+        x[:, length // 5:length // 5 + 4] += 30
+        features_list.append(x)
+    return features_list
+
+
+@pytest.fixture(scope='module')
+def models():
+    torch.manual_seed(0)
+    model = DcaseNet_v3(1).eval()
+    calibration_inputs = [torch.from_numpy(x[None]) for x in features([240] * 8, seed=1)]
+    return model, quantize_dcasenet(model, calibration_inputs)
+
+
+@pytest.mark.parametrize('length', [64, 240, 481])
+def test_int8_agrees_with_fp32(models, length):
+    (model, quantized) = models
+    [x] = features([length])
+    [expected] = forward_batch(model, [x], 'cpu')
+    [output] = forward_batch(quantized, [x], 'cpu')
+    assert output.shape == expected.shape
+    assert (output - expected).abs().max().item() <= MAX_OUTPUT_DIFF
+    impact_error_ms = abs(detect_impact_time(output) - detect_impact_time(expected)) * 1000
+    assert impact_error_ms <= QUANTIZATION_MAX_IMPACT_ERROR_MS
+
+
+def test_int8_padded_batches(models):
+    """int8 models don't mask padding (masks_padding False): forward_each runs the items of a batch one by one"""
+    (model, quantized) = models
+    assert not quantized.masks_padding
+    lengths = (240, 181, 64)
+    features_list = features(lengths, seed=2)
+    expected = forward_batch(model, features_list, 'cpu')
+    outputs = forward_batch(quantized, features_list, 'cpu')
+    for (output, expected_output) in zip(outputs, expected):
+        assert output.shape == expected_output.shape
+        assert (output - expected_output).abs().max().item() <= MAX_OUTPUT_DIFF
+    assert batch_parity(quantized, 'cpu', lengths) <= 1e-4
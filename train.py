@@ -35,7 +35,7 @@ def get_spectogram_dataset_model_and_criterion(args):
     # Define the model
     # model = Cnn_AvgPooling(cfg.classes_num, model_config=[(32,2), (64,2), (128,2), (128,1)])
     # model = MobileNetV1(cfg.classes_num)
-    model = DcaseNet_v3(cfg.classes_num)
+    model = DcaseNet_v3(cfg.classes_num, causal=args.causal)
     if args.ckpt != '':
         checkpoint = torch.load(args.ckpt, map_location=device)
         model.load_state_dict(checkpoint['model'])
@@ -95,6 +95,8 @@ if __name__ == '__main__':
     # Spectogram only arguments
     parser.add_argument('--preprocess_mode', type=str, default='Complex', help='logMel or Complex; relevant only for Spectogram features')
     parser.add_argument('--force_preprocess', action='store_true', default=False, help='relevant only for Spectogram features')
+    parser.add_argument('--causal', action='store_true', default=False,
+                        help='Unidirectional GRU, for live detection; relevant only for Spectogram features')
 
     # Train
     parser.add_argument('--outputs_root', type=str, default='training_dir')
@@ -136,6 +138,8 @@ if __name__ == '__main__':
         train_name += "_BC"
     if args.augment_data:
         train_name += "_AD"
+    if args.causal:
+        train_name += "_causal"
 
     train(
         model, 
@@ -1,6 +1,5 @@
 import os
 import numpy as np
-from matplotlib import pyplot as plt
 
 from torch import tensor
 from torch.nn.functional import binary_cross_entropy_with_logits
@@ -61,6 +60,7 @@ class ProgressPlotter:
         # self.plot_roc(os.path.join(outputs_dir, 'ROC_plots', f"Roc-iteration-{self.iterations[-1]}.png"))
 
     def plot_train_eval_losses(self, plot_path):
+        from matplotlib import pyplot as plt
         self.train_avgs += [np.mean(self.train_buffer)]
         self.train_buffer = []
 
@@ -75,6 +75,7 @@ class ProgressPlotter:
         plt.clf()
 
     def plot_metrics(self, plot_path):
+        from matplotlib import pyplot as plt
         plt.plot(np.arange(len(self.f1_score_avgs)), self.f1_score_avgs, color='blue', label='Max f1 scroe')
         plt.plot(np.arange(len(self.f5_score_avgs)), self.f5_score_avgs, color='green', label='Max f5 scroe')
         plt.plot(np.arange(len(self.AP_avgs)), self.AP_avgs, color='orange', label='Average precision')
@@ -86,6 +87,7 @@ class ProgressPlotter:
         plt.clf()
 
     def plot_roc(self, plot_path):
+        from matplotlib import pyplot as plt
         os.makedirs(os.path.dirname(plot_path), exist_ok=True)
         plt.plot(self.last_recal_vals, self.last_precision_vals)
         plt.xticks([0, 0.25, 0.5, 0.75, 1])
@@ -0,0 +1,201 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from dataset.spectogram import spectogram_configs as cfg
+
+logger = logging.getLogger(__name__)
+
+FEATURE_CACHE_DIR = os.environ.get("FEATURE_CACHE_DIR", "feature_cache")
+# Byte budgets of the two tiers, 0 disables a tier
+FEATURE_CACHE_MEMORY_MB = float(os.environ.get("FEATURE_CACHE_MEMORY_MB", 256))
+FEATURE_CACHE_DISK_MB = float(os.environ.get("FEATURE_CACHE_DISK_MB", 2048))
+
+# Kinds of cached arrays
+AUDIO = 'audio'      # decoded audio (samples, channels) at cfg.working_sample_rate
+LOG_MEL = 'log_mel'  # multichannel_complex_to_log_mel output (channels, frames, mel_bins)
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FeatureCache:
+    """
+    Two tier LRU cache of decoded audio and log-mel features, keyed by the content hash of the source file,
+    the part of the file (section, e.g. a search window) and the front-end configuration (cfg.cfg_descriptor),
+    so files with the same name never collide and features of another configuration are never returned.
+    Arrays are stored as float32, so a hit returns exactly what a miss computes, in an in-memory tier and as .npy
+    files in an on-disk tier, each within a byte budget. The disk tier can be shared by several processes; writes are atomic and each process
+    evicts by its own view of the least recently used files.
+    """
+    def __init__(self, cache_dir=FEATURE_CACHE_DIR, memory_bytes=FEATURE_CACHE_MEMORY_MB * 2 ** 20,
+                 disk_bytes=FEATURE_CACHE_DISK_MB * 2 ** 20, descriptor=cfg.cfg_descriptor):
+        self.cache_dir = cache_dir
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.descriptor = descriptor
+        self._memory = OrderedDict()  # key -> float32 array
+        self._memory_used = 0
+        self._disk = None  # key -> file size, scanned on first use
+        self._disk_used = 0
+        self._lock = threading.Lock()
+        self._stats = {f"{tier}_{event}": 0 for tier in ['memory', 'disk'] for event in ['hits', 'evictions']}
+        self._stats['misses'] = 0
+
+    def key(self, kind, content_sha256, section=''):
+        if section:
+            return f"{kind}-{content_sha256}-{section}-{self.descriptor}"
+        return f"{kind}-{content_sha256}-{self.descriptor}"
+
+    def get(self, kind, content_sha256, section=''):
+        """A copy of the cached float32 array, None on a miss"""
+        key = self.key(kind, content_sha256, section)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._stats['memory_hits'] += 1
+                return self._memory[key].copy()
+
+        array = self._read_disk(key)
+        if array is None:
+            with self._lock:
+                self._stats['misses'] += 1
+            return None
+        with self._lock:
+            self._stats['disk_hits'] += 1
+            self._put_memory(key, array)
+        return array.copy()
+
+    def put(self, kind, content_sha256, array, section=''):
+        key = self.key(kind, content_sha256, section)
+        array = np.array(array, dtype=np.float32)
+        with self._lock:
+            self._put_memory(key, array)
+        self._write_disk(key, array)
+
+    def get_or_compute(self, kind, content_sha256, compute, section=''):
+        array = self.get(kind, content_sha256, section)
+        if array is None:
+            array = compute()
+            self.put(kind, content_sha256, array, section)
+        return array
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats,
+                        memory_entries=len(self._memory), memory_bytes=self._memory_used,
+                        memory_budget_bytes=int(self.memory_bytes),
+                        disk_entries=len(self._disk or {}), disk_bytes=self._disk_used,
+                        disk_budget_bytes=int(self.disk_bytes))
+
+    def _put_memory(self, key, array):
+        # Called with the lock held
+        if array.nbytes > self.memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_used -= self._memory.pop(key).nbytes
+        self._memory[key] = array
+        self._memory_used += array.nbytes
+        while self._memory_used > self.memory_bytes:
+            (_, evicted) = self._memory.popitem(last=False)
+            self._memory_used -= evicted.nbytes
+            self._stats['memory_evictions'] += 1
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def _scan_disk(self):
+        # Called with the lock held
+        if self._disk is not None:
+            return
+        self._disk = OrderedDict()
+        if self.disk_bytes <= 0 or not os.path.isdir(self.cache_dir):
+            return
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npy'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-len('.npy')], stat.st_size))
+        for (_, key, size) in sorted(entries):
+            self._disk[key] = size
+            self._disk_used += size
+        logger.info(f"Feature cache found {len(self._disk)} files ({self._disk_used / 2 ** 20:.1f}MB) in {self.cache_dir}")
+
+    def _read_disk(self, key):
+        if self.disk_bytes <= 0:
+            return None
+        with self._lock:
+            self._scan_disk()
+            if key not in self._disk and not os.path.exists(self._path(key)):
+                return None
+        try:
+            array = np.load(self._path(key))
+            if array.dtype != np.float32:
+                raise ValueError(f"{array.dtype} array, written by a version of the cache storing float16")
+            # Recency for the LRU order of other processes sharing the directory
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            # Evicted by another process
+            with self._lock:
+                self._forget_disk(key, remove=False)
+            return None
+        except Exception as e:
+            logger.warning(f"Failed to read cached features {key}: {str(e)}")
+            with self._lock:
+                self._forget_disk(key)
+            return None
+        with self._lock:
+            if key not in self._disk:
+                # Written by another process
+                self._disk[key] = os.path.getsize(self._path(key))
+                self._disk_used += self._disk[key]
+            self._disk.move_to_end(key)
+        return array
+
+    def _write_disk(self, key, array):
+        if self.disk_bytes <= 0 or array.nbytes > self.disk_bytes:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'wb') as f:
+                np.save(f, array)
+            os.replace(temp_path, self._path(key))
+        except Exception as e:
+            logger.warning(f"Failed to write cached features {key}: {str(e)}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+
+        with self._lock:
+            self._scan_disk()
+            self._forget_disk(key, remove=False)
+            self._disk[key] = os.path.getsize(self._path(key))
+            self._disk_used += self._disk[key]
+            while self._disk_used > self.disk_bytes and len(self._disk) > 1:
+                evicted = next(iter(self._disk))
+                self._forget_disk(evicted)
+                self._stats['disk_evictions'] += 1
+
+    def _forget_disk(self, key, remove=True):
+        # Called with the lock held
+        if key in self._disk:
+            self._disk_used -= self._disk.pop(key)
+        if remove:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+
+# Shared by the server, infer.py, ImpactDetector and the training preprocessing
+feature_cache = FeatureCache()
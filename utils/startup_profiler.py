@@ -0,0 +1,85 @@
+import os
+import time
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Startup time the server and workers are expected to stay within; a longer startup is logged as a warning. 0: none.
+STARTUP_BUDGET_SECONDS = float(os.environ.get("STARTUP_BUDGET_SECONDS", 0))
+
+
+def process_age_seconds():
+    """Seconds since this process started (Linux), None where /proc doesn't tell"""
+    try:
+        with open('/proc/self/stat') as f:
+            # The command name may hold spaces, the fields after it don't; starttime is field 22
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/stat') as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith('btime'))
+        return time.time() - (boot_time + start_ticks / os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError, StopIteration):
+        return None
+
+
+class StartupProfiler:
+    """
+    Time spent in each phase of a process's startup, until finish(). Phases are marked (the time since the previous
+    phase ended) or timed (a context); phases timed within another are named parent/child.
+    """
+    def __init__(self, budget_seconds=STARTUP_BUDGET_SECONDS):
+        self.budget_seconds = budget_seconds
+        self.created_at = time.perf_counter()
+        self.interpreter_seconds = process_age_seconds()  # before this module was imported: interpreter start-up
+        self.phases = []  # (name, start, seconds), start relative to created_at
+        self.total_seconds = None
+        self._stack = []
+        self._last = self.created_at
+
+    def mark(self, name):
+        """Record the time since the previous phase ended as a phase"""
+        if self.total_seconds is not None:
+            return
+        now = time.perf_counter()
+        self.phases.append((name, self._last - self.created_at, now - self._last))
+        self._last = now
+
+    @contextmanager
+    def phase(self, name):
+        if self.total_seconds is not None:
+            yield
+            return
+        self._stack.append(name)
+        full_name = '/'.join(self._stack)
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            now = time.perf_counter()
+            self.phases.append((full_name, started_at - self.created_at, now - started_at))
+            if not self._stack:
+                self._last = now
+
+    def finish(self):
+        """End the startup: later phases aren't recorded. Logs the phases, and a warning when over budget."""
+        if self.total_seconds is not None:
+            return
+        self.total_seconds = (self.interpreter_seconds or 0) + time.perf_counter() - self.created_at
+        phases = ', '.join(f"{name} {seconds:.2f}s" for (name, _, seconds) in sorted(self.phases, key=lambda p: p[1]))
+        logger.info(f"Started in {self.total_seconds:.2f}s: interpreter {self.interpreter_seconds or 0:.2f}s, {phases}")
+        if self.budget_seconds and self.total_seconds > self.budget_seconds:
+            logger.warning(f"Startup took {self.total_seconds:.2f}s, over its budget of {self.budget_seconds:g}s")
+
+    def report(self):
+        return {
+            'total_seconds': self.total_seconds,
+            'budget_seconds': self.budget_seconds or None,
+            'interpreter_seconds': self.interpreter_seconds,
+            'phases': [{'phase': name, 'start_seconds': start, 'seconds': seconds}
+                       for (name, start, seconds) in sorted(self.phases, key=lambda p: p[1])],
+        }
+
+
+# The startup of this process; imported first so that imports are timed too
+startup_profiler = StartupProfiler()
@@ -0,0 +1,170 @@
+import os
+import logging
+from collections import OrderedDict
+
+import requests
+import torch
+
+from dataset.spectogram import spectogram_configs as cfg
+
+logger = logging.getLogger(__name__)
+
+# Videos are copied between the request body, disk and storage in chunks of this size, never as a whole
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+# Number of (content hash, model version) -> impact time results kept in memory
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 1024))
+# Seconds of a clip decoded and searched for the impact when a request doesn't say; an empty end is the end of the clip
+SEARCH_WINDOW_START_SECONDS = float(os.environ.get("SEARCH_WINDOW_START_SECONDS", 0))
+SEARCH_WINDOW_END_SECONDS = (float(os.environ["SEARCH_WINDOW_END_SECONDS"])
+                             if os.environ.get("SEARCH_WINDOW_END_SECONDS") else None)
+
+
+class VideoDownloadError(Exception):
+    pass
+
+
+def detect_impact_time(model_output, frame_rate_factor=1):
+    """
+    Args:
+        model_output: torch.Tensor of shape (seq_len, num_classes)
+        frame_rate_factor: input frames per output of the model
+    """
+    try:
+        max_frame = torch.argmax(model_output, dim=0)[0].item() * frame_rate_factor
+        return max_frame / cfg.working_sample_rate * cfg.hop_size
+    except Exception as e:
+        logger.error(f"Error in detect_impact_time: {str(e)}")
+        raise
+
+
+def download_video(url, output_path, digest=None):
+    """
+    Download a video to output_path; digest (e.g. hashlib.sha256()) is updated with its content on the way
+    """
+    if url.startswith("file://"):
+        # Videos kept in local storage by the SQLite task backend
+        with open(url[len("file://"):], 'rb') as source, open(output_path, 'wb') as destination:
+            copy_file_object(source, destination, digest=digest)
+        return
+    try:
+        logger.info(f"Downloading video from {url}")
+        response = requests.get(url, stream=True, timeout=30)
+        if response.status_code != 200:
+            error_msg = f"Failed to download video: status code {response.status_code}"
+            logger.error(error_msg)
+            raise VideoDownloadError(error_msg)
+
+        with open(output_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=UPLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+        logger.info(f"Video downloaded successfully to {output_path}")
+    except requests.RequestException as e:
+        error_msg = f"Error downloading video: {str(e)}"
+        logger.error(error_msg)
+        raise VideoDownloadError(error_msg)
+
+
+def copy_file_object(source, destination, chunk_size=UPLOAD_CHUNK_SIZE, digest=None):
+    """
+    Copy between two binary file objects one chunk at a time; returns the number of bytes copied.
+    digest (e.g. hashlib.sha256()) is updated with every chunk, hashing the content without reading it twice.
+    """
+    copied = 0
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        destination.write(chunk)
+        if digest is not None:
+            digest.update(chunk)
+        copied += len(chunk)
+    destination.flush()
+    return copied
+
+
+class LocalVideo:
+    """
+    An uploaded video still on this server's disk, handed from create_task to the task queue so the task
+    is processed from the local file while the same file is uploaded to storage.
+    The file is deleted when the last of its holders releases it. Used from the event loop only.
+    """
+    def __init__(self, path, holders=2):
+        self.path = path
+        self.upload = None  # asyncio.Task uploading the file to storage, set by the owner
+        self._holders = holders
+
+    def release(self):
+        self._holders -= 1
+        if self._holders > 0:
+            return
+        try:
+            os.unlink(self.path)
+            logger.debug(f"Temporary file deleted: {self.path}")
+        except Exception as e:
+            logger.warning(f"Failed to delete temporary file {self.path}: {str(e)}")
+
+
+class SearchWindow:
+    """
+    [start, end] seconds of a clip that are decoded, turned into features and searched for the impact;
+    end None for the end of the clip. Impact times stay relative to the start of the clip.
+    """
+    def __init__(self, start=0.0, end=None):
+        self.start = float(start or 0.0)
+        self.end = None if end is None else float(end)
+        if self.start < 0:
+            raise ValueError(f"Search window start must not be negative, {self.start} given")
+        if self.end is not None and self.end <= self.start:
+            raise ValueError(f"Search window end ({self.end}) must be after its start ({self.start})")
+
+    @classmethod
+    def from_request(cls, start=None, end=None):
+        """The window asked for by a request, SEARCH_WINDOW_START_SECONDS and SEARCH_WINDOW_END_SECONDS by default"""
+        return cls(SEARCH_WINDOW_START_SECONDS if start is None else start,
+                   SEARCH_WINDOW_END_SECONDS if end is None else end)
+
+    @classmethod
+    def of_task(cls, task):
+        return cls(task.search_start_seconds, task.search_end_seconds)
+
+    @property
+    def key(self):
+        """Part of cache and deduplication keys, empty for the whole clip so those keys stay as they were"""
+        if not self.start and self.end is None:
+            return ''
+        return f"{self.start:g}-{'' if self.end is None else f'{self.end:g}'}"
+
+    def columns(self):
+        """Values of the task columns, NULL for the defaults so whole clip tasks match rows that predate windows"""
+        return {'search_start_seconds': self.start or None, 'search_end_seconds': self.end}
+
+    def __repr__(self):
+        return f"[{self.start:g}, {'end' if self.end is None else f'{self.end:g}'}]s"
+
+
+class ResultCache:
+    """
+    LRU of impact times keyed by (content SHA-256, model version, search window), so repeated clips skip
+    decoding and inference
+    """
+    def __init__(self, max_entries=RESULT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._results = OrderedDict()
+
+    def get(self, content_sha256, model_version, search_window_key=''):
+        key = (content_sha256, model_version, search_window_key)
+        if key not in self._results:
+            return None
+        self._results.move_to_end(key)
+        return self._results[key]
+
+    def put(self, content_sha256, model_version, impact_time, search_window_key=''):
+        if self.max_entries <= 0:
+            return
+        key = (content_sha256, model_version, search_window_key)
+        self._results[key] = impact_time
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
@@ -0,0 +1,203 @@
+import os
+import logging
+from typing import List, Tuple
+
+import numpy as np
+import torch
+
+from dataset.spectogram import spectogram_configs as cfg
+
+logger = logging.getLogger(__name__)
+
+# Inputs longer than one window are split into overlapping windows that run as a batch. 0 (the default until windowed
+# outputs have been evaluated against whole-clip outputs on held-out recordings) disables windowing.
+WINDOW_SECONDS = float(os.environ.get("INFERENCE_WINDOW_SECONDS", 0))
+WINDOW_OVERLAP_SECONDS = float(os.environ.get("INFERENCE_WINDOW_OVERLAP_SECONDS", 4))
+# How outputs of overlapping windows are combined: 'center', 'mean' or 'max'
+STITCH_POLICY = os.environ.get("INFERENCE_STITCH_POLICY", "center").lower()
+STITCH_POLICIES = ['center', 'mean', 'max']
+
+
+def seconds_to_frames(seconds):
+    # Even, so every window starts on the same 2-frame pooling grid as the whole clip
+    return 2 * int(round(seconds * cfg.frames_per_second / 2))
+
+
+class WindowConfig:
+    def __init__(self, window_seconds=WINDOW_SECONDS, overlap_seconds=WINDOW_OVERLAP_SECONDS, policy=STITCH_POLICY):
+        if policy not in STITCH_POLICIES:
+            raise ValueError(f"Stitch policy can be one of {STITCH_POLICIES}, '{policy}' given")
+        self.window_frames = seconds_to_frames(window_seconds)
+        self.overlap_frames = seconds_to_frames(overlap_seconds)
+        self.policy = policy
+        if self.window_frames and self.overlap_frames >= self.window_frames:
+            raise ValueError(f"Window overlap ({overlap_seconds}s) must be shorter than the window ({window_seconds}s)")
+
+    def spans(self, num_frames):
+        return window_spans(num_frames, self.window_frames, self.overlap_frames)
+
+
+def window_spans(num_frames, window_frames, overlap_frames) -> List[Tuple[int, int]]:
+    """
+    (start, end) input frames of overlapping windows covering num_frames; a single span when it fits one window.
+    Starts are even, the last window is aligned to the end of the input (and may be one frame longer).
+    """
+    if not window_frames or num_frames <= window_frames:
+        return [(0, num_frames)]
+    hop = window_frames - overlap_frames
+    starts = list(range(0, num_frames - window_frames, hop))
+    last_start = (num_frames - window_frames) // 2 * 2
+    if last_start > starts[-1]:
+        starts.append(last_start)
+    return [(start, min(start + window_frames, num_frames)) for start in starts[:-1]] + [(starts[-1], num_frames)]
+
+
+def stitch_outputs(outputs, spans, output_length, policy, frame_rate_factor=1) -> torch.Tensor:
+    """
+    Combine per-window outputs (frames / frame_rate_factor, classes_num) of input frame spans into the output of
+    the whole input.
+        center: each frame comes from the window it is most central in, i.e. overlaps are split in the middle
+        mean: overlapping frames are averaged
+        max: overlapping frames take the maximum
+    """
+    if len(outputs) == 1:
+        return outputs[0][:output_length]
+    classes_num = outputs[0].shape[1]
+    if policy == 'max':
+        stitched = torch.full((output_length, classes_num), float('-inf'))
+    else:
+        stitched = torch.zeros(output_length, classes_num)
+    counts = torch.zeros(output_length, 1)
+    # Spans in outputs; window starts are even, so they fall on the outputs of frame_rate_factor 2 models
+    spans = [(start // frame_rate_factor, end // frame_rate_factor) for (start, end) in spans]
+
+    for i, (output, (start, _)) in enumerate(zip(outputs, spans)):
+        end = min(start + output.shape[0], output_length)
+        output = output[:end - start]
+        if policy == 'center':
+            # Keep from the middle of the overlap with the previous window to the middle of the one with the next
+            keep_from = 0 if i == 0 else (spans[i - 1][1] + start) // 2
+            keep_to = end if i == len(outputs) - 1 else (end + spans[i + 1][0]) // 2
+            stitched[keep_from:keep_to] = output[keep_from - start:keep_to - start]
+        elif policy == 'mean':
+            stitched[start:end] += output
+            counts[start:end] += 1
+        else:
+            stitched[start:end] = torch.maximum(stitched[start:end], output)
+
+    if policy == 'mean':
+        stitched /= counts.clamp(min=1)
+    return stitched
+
+
+def pad_batch(features_list, input_channels=cfg.audio_channels):
+    """
+    Zero pad (channels or 1, frames, mel_bins) features to one (batch, input_channels, max_frames, mel_bins) array;
+    single channel features are broadcast over the channels
+    """
+    lengths = [f.shape[1] for f in features_list]
+    mel_bins = features_list[0].shape[2]
+    batch = np.zeros((len(features_list), input_channels, max(lengths), mel_bins), dtype=np.float32)
+    for i, features in enumerate(features_list):
+        batch[i, :, :features.shape[1]] = features
+    return batch, lengths
+
+
+def forward_batch(model, features_list, device, input_channels=cfg.audio_channels) -> List[torch.Tensor]:
+    """
+    One forward pass over a zero padded batch; returns the (model.output_length(frames), classes_num) output of each
+    item without padding
+    """
+    (batch, lengths) = pad_batch(features_list, input_channels)
+    with torch.no_grad():
+        input_tensor = torch.from_numpy(batch).to(device)
+        if len(features_list) == 1:
+            output_event = model(input_tensor)
+        else:
+            output_event = model(input_tensor, lengths=torch.tensor(lengths))
+    output_event = output_event.cpu()
+
+    # Drop the frames that only exist because of the padding
+    return [output_event[i, :model.output_length(length)] for i, length in enumerate(lengths)]
+
+
+def batch_parity(model, device, lengths=(240, 181, 64), input_channels=cfg.audio_channels, seed=0) -> float:
+    """
+    Largest output difference of the items of a padded batch of random features of lengths frames to their forward
+    passes on their own; anything but rounding means one item's output depends on the others in its batch
+    """
+    rng = np.random.default_rng(seed)
+    features_list = [rng.standard_normal((input_channels, length, cfg.mel_bins)).astype(np.float32) - 40
+                     for length in lengths]
+    batched = forward_batch(model, features_list, device, input_channels)
+    return max((forward_batch(model, [features], device, input_channels)[0] - output).abs().max().item()
+               for (features, output) in zip(features_list, batched))
+
+
+def windowed_forward(model, log_mel_features, device, window_config=None, max_batch_size=8) -> torch.Tensor:
+    """
+    Run the model over (channels or 1, frames, mel_bins) features in overlapping windows, max_batch_size windows
+    per forward pass, and stitch the outputs. Memory stays bounded by the batch of windows instead of the clip length.
+    """
+    return windowed_forward_stream(model, [log_mel_features], device, window_config, max_batch_size)
+
+
+def windowed_forward_stream(model, feature_blocks, device, window_config=None, max_batch_size=8) -> torch.Tensor:
+    """
+    windowed_forward over features arriving in (channels or 1, frames, mel_bins) blocks, e.g. from
+    stream_log_mel_from_video. Windows run as soon as a batch of them is complete, so only the features of
+    the windows not run yet are held, whatever the length of the input. Without windowing (window_frames 0) the
+    whole input is held and runs at once.
+    """
+    window_config = window_config or WindowConfig()
+    window_frames = window_config.window_frames
+    if not window_frames:
+        # One window of the whole input: concatenate the blocks once, not the input so far with every block
+        blocks = list(feature_blocks)
+        feature_blocks = [np.concatenate(blocks, axis=1)] if len(blocks) > 1 else blocks
+    hop = window_frames - window_config.overlap_frames
+    buffer = None     # features from the start of the last cut window
+    buffer_start = 0  # frame of buffer[:, 0]
+    spans = []
+    windows = []      # features of the cut windows that didn't run yet
+    outputs = []
+
+    def run(count):
+        nonlocal windows
+        for i in range(0, count, max_batch_size):
+            outputs.extend(forward_batch(model, windows[i:min(i + max_batch_size, count)], device))
+        windows = windows[count:]
+
+    for block in feature_blocks:
+        buffer = block if buffer is None else np.concatenate([buffer, block], axis=1)
+        next_start = spans[-1][0] + hop if spans else 0
+        # A window is cut once a frame past it arrived: window_spans ends with a window aligned to the input's end
+        while window_frames and buffer_start + buffer.shape[1] > next_start + window_frames:
+            spans.append((next_start, next_start + window_frames))
+            windows.append(buffer[:, next_start - buffer_start:next_start - buffer_start + window_frames])
+            buffer = buffer[:, next_start - buffer_start:]
+            buffer_start = next_start
+            next_start += hop
+        # The last cut window may still be extended or followed by one aligned to the end
+        if len(windows) > max_batch_size:
+            run(len(windows) - 1 - (len(windows) - 1) % max_batch_size)
+        if window_frames:
+            # Copy, so the blocks the windows were views of can be freed
+            buffer = buffer.copy()
+
+    if buffer is None:
+        raise ValueError("No features to run the model on")
+    num_frames = buffer_start + buffer.shape[1]
+    if not spans:
+        spans.append((0, num_frames))
+        windows.append(buffer)
+    else:
+        last_start = (num_frames - window_frames) // 2 * 2
+        if last_start > spans[-1][0]:
+            spans.append((last_start, num_frames))
+            windows.append(buffer[:, last_start - buffer_start:])
+        else:
+            spans[-1] = (spans[-1][0], num_frames)
+            windows[-1] = buffer[:, spans[-1][0] - buffer_start:]
+    run(len(windows))
+    return stitch_outputs(outputs, spans, model.output_length(num_frames), window_config.policy, model.frame_rate_factor)
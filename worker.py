@@ -0,0 +1,159 @@
+# First, so the imports below are part of the startup profile
+from utils.startup_profiler import startup_profiler
+# Before the modules reading the settings it tunes (thread counts, batch and pool sizes) are imported
+from autotune import apply_tuned_settings
+tuned_settings = apply_tuned_settings()
+import os
+import signal
+import logging
+import tempfile
+import functools
+import threading
+
+import torch
+from dotenv import load_dotenv
+
+from database import task_db
+from inference_backend import WARMUP, load_inference_model
+from models.task_models import TaskUpdate, TaskStatus
+from pipeline import (INLINE, Pipeline, PipelineTrace, Stage, download_stage, impact_stage, streaming_decode_stage,
+                      streaming_log_mel_stage)
+from task_queue import HEARTBEAT_SECONDS, LEASE_SECONDS, MAX_ATTEMPTS, WORKER_ID
+from video_processing import SearchWindow, download_video
+from windowed_inference import windowed_forward_stream
+
+startup_profiler.mark('imports')
+
+# Load environment variables
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.StreamHandler(),
+        logging.FileHandler("worker.log")
+    ]
+)
+logger = logging.getLogger("worker")
+if tuned_settings:
+    logger.info(f"Tuned settings in effect: {tuned_settings}")
+
+POLL_SECONDS = float(os.environ.get("WORKER_POLL_SECONDS", 2))
+
+
+class LeaseHeartbeat(threading.Thread):
+    """
+    Renews the lease of a task every HEARTBEAT_SECONDS while the task is processed
+    """
+    def __init__(self, task_id):
+        super().__init__(daemon=True)
+        self.task_id = task_id
+        self.lost = threading.Event()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(HEARTBEAT_SECONDS):
+            try:
+                if not task_db.renew_lease(self.task_id, WORKER_ID, LEASE_SECONDS):
+                    logger.warning(f"Lost the lease of task {self.task_id}")
+                    self.lost.set()
+                    return
+            except Exception as e:
+                # Keep trying, the lease is only lost once it expires
+                logger.warning(f"Heartbeat of task {self.task_id} failed: {str(e)}")
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class Worker:
+    def __init__(self, model, device, model_version):
+        self.model = model
+        self.device = device
+        self.model_version = model_version
+        self._stopping = threading.Event()
+
+    def stop(self, *args):
+        logger.info("Worker stopping after the current task")
+        self._stopping.set()
+
+    def run(self):
+        logger.info(f"Worker {WORKER_ID} started: lease={LEASE_SECONDS}s, max_attempts={MAX_ATTEMPTS}")
+        while not self._stopping.is_set():
+            try:
+                task = task_db.claim_task(WORKER_ID, LEASE_SECONDS, MAX_ATTEMPTS)
+            except Exception as e:
+                logger.error(f"Failed to claim a task: {str(e)}")
+                task = None
+
+            if task is None:
+                self._stopping.wait(POLL_SECONDS)
+                continue
+            self.process_task(task)
+        logger.info(f"Worker {WORKER_ID} stopped")
+
+    def process_task(self, task):
+        logger.info(f"Processing task {task.id} (attempt {task.attempts}/{MAX_ATTEMPTS})")
+        heartbeat = LeaseHeartbeat(task.id)
+        heartbeat.start()
+        trace = PipelineTrace()
+        try:
+            impact_time = self.detect_impact(task.video_url, SearchWindow.of_task(task), trace)
+            update = TaskUpdate(status=TaskStatus.COMPLETED, impact_time_seconds=float(impact_time),
+                                model_version=self.model_version, lease_owner=None, lease_expires_at=None,
+                                trace=trace.to_dict())
+        except Exception as e:
+            error_msg = f"Error processing video: {str(e)}"
+            logger.error(error_msg)
+            # Hand the task back for another attempt, possibly on another worker
+            retry = task.attempts < MAX_ATTEMPTS
+            update = TaskUpdate(status=TaskStatus.PENDING if retry else TaskStatus.FAILED, error_message=error_msg,
+                                lease_owner=None, lease_expires_at=None, trace=trace.to_dict())
+        finally:
+            heartbeat.stop()
+        logger.info(f"Task {task.id} pipeline: {trace.summary()}")
+
+        try:
+            if task_db.update_leased_task(task.id, WORKER_ID, update) is None:
+                logger.warning(f"Task {task.id} was leased to another worker, dropping the result")
+        except Exception as e:
+            # The lease expires and the task gets picked up again
+            logger.error(f"Failed to store the result of task {task.id}: {str(e)}")
+
+    def detect_impact(self, video_url, search_window, trace=None):
+        """Impact time in seconds from the start of the video, searched for in search_window only"""
+        with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as temp_file:
+            video_path = temp_file.name
+        try:
+            # Audio is decoded into features and long recordings run in overlapping windows as the features
+            # arrive, so memory doesn't grow with the video's duration
+            pipeline = Pipeline([
+                download_stage(video_path, download_video, runs_on=INLINE),
+                streaming_decode_stage(search_window.start, search_window.end),
+                streaming_log_mel_stage(),
+                Stage('model', functools.partial(windowed_forward_stream, self.model, device=self.device)),
+                impact_stage(self.model.frame_rate_factor, search_window.start),
+            ])
+            return pipeline.run(video_url, trace)
+        finally:
+            try:
+                os.unlink(video_path)
+            except Exception as e:
+                logger.warning(f"Failed to delete temporary file {video_path}: {str(e)}")
+
+if __name__ == '__main__':
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    checkpoint_path = os.environ.get("MODEL_CHECKPOINT", "model_checkpoint.pt")
+    with startup_profiler.phase('model'):
+        (model, model_version) = load_inference_model(checkpoint_path, device)
+    if WARMUP:
+        with startup_profiler.phase('warm-up'):
+            model.warm_up()
+    startup_profiler.finish()
+
+    worker = Worker(model, device, model_version)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.run()